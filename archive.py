@@ -0,0 +1,402 @@
+"""
+消息存档（服务端使用）
+
+服务端转发的文字消息和群消息按会话存档，换一台电脑登录也能取回完整的聊天记录。
+每个会话一个目录（两人私聊按用户名排序后拼接，群聊为 #群名），消息按到达顺序追加写入分段日志
+（00000001.seg ...），每条记录为 | 时间戳 8B | 负载长度 4B | 发送者|内容 |。
+写满 SEGMENT_SIZE 的分段封存，摘要（大小、条数、首末时间）记在 index.json 中，
+同一会话内时间戳递增，按时间定位只需在摘要上二分，再从该分段开头顺序读。
+
+客户端用 HISTORY 请求：
+  list|起始时间                       → list|{会话对象: [条数, 最后时间]}（JSON），只列出起始时间之后有消息的会话
+  fetch|会话对象|起始时间|结束时间|游标 → page|会话对象|下一页游标|[[时间, 发送者, 内容], ...]（JSON）
+每页最多 PAGE_BYTES 字节的记录，游标为“分段号:偏移”，下一页从上一页读到的位置接着顺序读，
+新设备同步只需按会话逐页拉取，不需要对方重新发送。下一页游标为空表示已取完。
+图片和文件不存档（只在传输双方保存）。
+
+转发线程/协程只把消息放进队列（record 不碰磁盘、不拿全局锁），由唯一的后台写线程攒批后
+按会话每批一次 write；各会话当前分段的文件保持打开（最多 MAX_OPEN_SEGMENTS 个）。
+"""
+import json
+import os
+import queue
+import struct
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from urllib.parse import quote
+
+from protocol import HISTORY, NOTICE, pack_fields
+
+ARCHIVE_DIR = "archive"
+SEGMENT_SIZE = 1024 * 1024  # 分段大小（超过后新开分段）
+PAGE_BYTES = 256 * 1024  # 每页最多读出的记录字节数
+RECORD = struct.Struct("!dI")
+INDEX_FILE = "index.json"
+SEGMENT_SUFFIX = ".seg"
+USERS_DIR = "users"  # 每个用户参与过的私聊会话列表
+GROUP_PREFIX = "#"
+BATCH_MAX = 1024  # 写线程每批最多条数
+BATCH_WAIT = 0.05  # 攒批等待时间（秒）
+MAX_OPEN_SEGMENTS = 256  # 写线程保持打开的分段文件数上限
+
+
+def decode_records(data):
+    """解析分段数据，返回 ([(时间戳, 负载)], 完整记录的字节数)"""
+    view = memoryview(data)
+    records = []
+    pos = 0
+    while len(view) - pos >= RECORD.size:
+        timestamp, length = RECORD.unpack_from(view, pos)
+        start = pos + RECORD.size
+        if len(view) - start < length:
+            break  # 异常退出时留下的半条记录
+        records.append((timestamp, view[start:start + length]))
+        pos = start + length
+    return records, pos
+
+
+def conversation_dir(a, b=None):
+    """私聊为两个用户名转义后用 + 连接（转义后的名字里不会出现 +），群聊为 #群名"""
+    if b is None:
+        return quote(GROUP_PREFIX + a, safe="")
+    return "+".join(quote(name, safe="") for name in sorted((a, b)))
+
+
+class Conversation:
+    """单个会话的分段存档（所有方法需持有 self.lock）"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.segments = []  # [{"seq", "bytes", "count", "first", "last"}]，最后一个为当前写入的分段
+        self.file = None  # 当前分段的追加句柄，只由写线程打开
+        self.file_seq = None
+        os.makedirs(path, exist_ok=True)
+        self.load()
+
+    def segment_path(self, seq):
+        return os.path.join(self.path, f"{seq:08d}{SEGMENT_SUFFIX}")
+
+    @property
+    def count(self):
+        return sum(segment["count"] for segment in self.segments)
+
+    @property
+    def last(self):
+        return self.segments[-1]["last"] if self.segments else 0
+
+    def load(self):
+        """读取索引中的封存分段，并扫描未封存的分段（截掉末尾不完整的记录）"""
+        on_disk = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.path)
+                         if name.endswith(SEGMENT_SUFFIX))
+        indexed = {}
+        try:
+            with open(os.path.join(self.path, INDEX_FILE), "r", encoding="utf-8") as f:
+                indexed = {segment["seq"]: segment for segment in json.load(f)}
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        self.segments = []
+        for i, seq in enumerate(on_disk):
+            segment = indexed.get(seq)
+            if segment is None or i == len(on_disk) - 1:
+                segment = self.scan(seq)
+            if segment["count"]:
+                self.segments.append(segment)
+
+    def scan(self, seq):
+        path = self.segment_path(seq)
+        with open(path, "rb") as f:
+            data = f.read()
+        records, valid = decode_records(data)
+        if valid < len(data):
+            with open(path, "r+b") as f:
+                f.truncate(valid)
+        return {"seq": seq, "bytes": valid, "count": len(records),
+                "first": records[0][0] if records else 0, "last": records[-1][0] if records else 0}
+
+    def save_index(self):
+        """封存的分段写入索引（先写临时文件再替换）"""
+        tmp_path = os.path.join(self.path, INDEX_FILE + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.segments[:-1], f)
+        os.replace(tmp_path, os.path.join(self.path, INDEX_FILE))
+
+    def append_many(self, records, fsync=False):
+        """写线程：追加一批 (时间戳, 负载)，每个分段一次 write；当前分段写满时先封存再新开分段"""
+        try:
+            current = self.segments[-1] if self.segments else None
+            parts = []
+            for timestamp, payload in records:
+                if current is None or current["bytes"] >= SEGMENT_SIZE:
+                    self.write_parts(current, parts, fsync)
+                    parts = []
+                    last = current["last"] if current else timestamp
+                    current = {"seq": current["seq"] + 1 if current else 1, "bytes": 0, "count": 0,
+                               "first": max(timestamp, last), "last": max(timestamp, last)}
+                    self.segments.append(current)
+                    if len(self.segments) > 1:
+                        self.save_index()
+                timestamp = max(timestamp, current["last"])  # 系统时间回拨时保持递增，按时间二分才成立
+                parts.append(RECORD.pack(timestamp, len(payload)) + payload)
+                current["bytes"] += RECORD.size + len(payload)
+                current["count"] += 1
+                current["last"] = timestamp
+            self.write_parts(current, parts, fsync)
+        except OSError:
+            self.close_file()
+            self.load()  # 摘要已先行更新：按磁盘上实际写入的内容重新扫描
+            raise
+
+    def write_parts(self, segment, parts, fsync):
+        if not parts:
+            return
+        if self.file_seq != segment["seq"]:
+            self.close_file()
+            self.file = open(self.segment_path(segment["seq"]), "ab")
+            self.file_seq = segment["seq"]
+        self.file.write(b"".join(parts))
+        self.file.flush()
+        if fsync:
+            os.fsync(self.file.fileno())
+
+    def close_file(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.file_seq = None
+
+    def read(self, cursor, since, until, max_bytes=PAGE_BYTES):
+        """从游标（为空时按 since 定位）顺序读一页，返回 ([(时间戳, 负载)], 下一页游标或 None)"""
+        if cursor:
+            seq, offset = cursor
+            i = bisect_left([segment["seq"] for segment in self.segments], seq)
+            if i < len(self.segments) and self.segments[i]["seq"] != seq:
+                offset = 0
+        else:
+            i = bisect_left([segment["last"] for segment in self.segments], since)
+            offset = 0
+        records = []
+        used = 0
+        while i < len(self.segments) and used < max_bytes:
+            segment = self.segments[i]
+            if offset >= segment["bytes"]:
+                i, offset = i + 1, 0
+                continue
+            with open(self.segment_path(segment["seq"]), "rb") as f:
+                f.seek(offset)
+                chunk, valid = decode_records(f.read(min(max_bytes - used, segment["bytes"] - offset)))
+                if not chunk:  # 单条记录比剩余的页空间还大：整条读出
+                    f.seek(offset)
+                    length = RECORD.unpack(f.read(RECORD.size))[1]
+                    if offset + RECORD.size + length <= segment["bytes"]:
+                        f.seek(offset)
+                        chunk, valid = decode_records(f.read(RECORD.size + length))
+            if not valid:  # 游标偏移不在记录边界上，读出的长度是乱的：拒绝而不是原地打转
+                raise ValueError(f"游标无效：{segment['seq']}:{offset}")
+            offset += valid
+            for timestamp, payload in chunk:
+                if timestamp >= until:
+                    return records, None
+                if timestamp >= since:  # 定位到的分段开头早于 since 的部分只读不计入页大小
+                    records.append((timestamp, payload))
+                    used += RECORD.size + len(payload)
+        if i >= len(self.segments):
+            return records, None
+        return records, (self.segments[i]["seq"], offset)
+
+
+class Archive:
+    """全部会话的存档"""
+
+    def __init__(self, root=ARCHIVE_DIR, fsync=False):
+        self.root = root
+        self.fsync = fsync
+        self.conversations = {}  # {目录名: Conversation}，首次用到时加载
+        self.peers = {}  # {用户名: set(私聊对象)}，首次用到时加载
+        self.lock = threading.Lock()  # 只保护以上两个字典的查找与增删，持有期间不做磁盘读写
+        self.load_lock = threading.Lock()  # 加载会话和会话列表时持有，同一会话不会被扫描两次
+        self.recorded = 0
+        self.queue = queue.Queue()
+        self.open_convs = OrderedDict()  # {目录名: Conversation}，分段文件打开着的会话，只在写线程中使用
+        os.makedirs(os.path.join(root, USERS_DIR), exist_ok=True)
+        self.writer = threading.Thread(target=self._writer_loop, daemon=True)
+        self.writer.start()
+
+    def conversation(self, name):
+        with self.lock:
+            conv = self.conversations.get(name)
+        if conv is not None:
+            return conv
+        with self.load_lock:
+            with self.lock:
+                conv = self.conversations.get(name)
+            if conv is None:
+                conv = Conversation(os.path.join(self.root, name))
+                with self.lock:
+                    self.conversations[name] = conv
+        return conv
+
+    def peers_of(self, username):
+        """用户参与过的私聊对象（返回的集合只由写线程修改，读取时需持有 self.lock）"""
+        with self.lock:
+            peers = self.peers.get(username)
+        if peers is not None:
+            return peers
+        with self.load_lock:
+            with self.lock:
+                peers = self.peers.get(username)
+            if peers is None:
+                peers = set()
+                try:
+                    with open(self.users_path(username), "r", encoding="utf-8") as f:
+                        peers.update(line.rstrip("\n") for line in f if line.strip())
+                except OSError:
+                    pass
+                with self.lock:
+                    self.peers[username] = peers
+        return peers
+
+    def users_path(self, username):
+        return os.path.join(self.root, USERS_DIR, quote(username, safe="") + ".txt")
+
+    def add_peer(self, username, peer):
+        """写线程：第一次与 peer 私聊时追加到用户的会话列表"""
+        peers = self.peers_of(username)
+        if peer in peers:
+            return
+        with open(self.users_path(username), "a", encoding="utf-8") as f:
+            f.write(peer + "\n")
+        with self.lock:
+            peers.add(peer)
+
+    # ---------------------- 写入 ----------------------
+    def record(self, sender, target, content, group=False):
+        """存档一条已转发的消息（group 为 True 时 target 是群名）；只放入队列，由写线程落盘"""
+        self.queue.put((time.time(), sender, target, content, group))
+
+    def flush(self):
+        """等待已提交的消息全部落盘"""
+        self.queue.join()
+
+    def close(self):
+        """写完剩余消息后停止写线程"""
+        self.queue.put(None)
+        self.writer.join()
+
+    def _writer_loop(self):
+        """写线程：取到一条后继续等待 BATCH_WAIT 秒攒批，然后一次提交"""
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + BATCH_WAIT
+            while batch[-1] is not None and len(batch) < BATCH_MAX:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._commit([item for item in batch if item is not None])
+            for _ in batch:
+                self.queue.task_done()
+            if batch[-1] is None:
+                for conv in self.open_convs.values():
+                    with conv.lock:
+                        conv.close_file()
+                self.open_convs.clear()
+                return
+
+    def _commit(self, batch):
+        """按会话分组，每个会话一次 write，再登记新出现的私聊对象"""
+        records = {}
+        pairs = set()
+        for timestamp, sender, target, content, group in batch:
+            name = conversation_dir(target) if group else conversation_dir(sender, target)
+            records.setdefault(name, []).append((timestamp, pack_fields(sender, content)))
+            if not group:
+                pairs.add((sender, target))
+        for name, conv_records in records.items():
+            try:
+                conv = self.conversation(name)
+                with conv.lock:
+                    conv.append_many(conv_records, self.fsync)
+            except OSError as e:
+                print(f"⚠️ 消息存档写入失败：{str(e)}")
+                continue
+            self.recorded += len(conv_records)
+            self.open_convs[name] = conv
+            self.open_convs.move_to_end(name)
+            if len(self.open_convs) > MAX_OPEN_SEGMENTS:
+                _, oldest = self.open_convs.popitem(last=False)
+                with oldest.lock:
+                    oldest.close_file()
+        for sender, target in pairs:
+            try:
+                self.add_peer(sender, target)
+                self.add_peer(target, sender)
+            except OSError as e:
+                print(f"⚠️ 消息存档写入失败：{str(e)}")
+
+    # ---------------------- 查询 ----------------------
+    def overview(self, username, group_names, since):
+        """用户的全部会话 {会话对象: [条数, 最后时间]}，只列出 since 之后有消息的"""
+        peers = self.peers_of(username)
+        with self.lock:
+            peers = list(peers)
+        result = {}
+        for peer, name in [(peer, conversation_dir(username, peer)) for peer in peers] + \
+                          [(GROUP_PREFIX + group, conversation_dir(group)) for group in group_names]:
+            if not os.path.isdir(os.path.join(self.root, name)):
+                continue
+            conv = self.conversation(name)
+            with conv.lock:
+                if conv.last > since:
+                    result[peer] = [conv.count, conv.last]
+        return result
+
+    def fetch(self, username, peer, since, until, cursor):
+        """读一页会话记录，返回 ([(时间, 发送者, 内容)], 下一页游标字符串)"""
+        if peer.startswith(GROUP_PREFIX):
+            name = conversation_dir(peer[len(GROUP_PREFIX):])
+        else:
+            name = conversation_dir(username, peer)
+        if not os.path.isdir(os.path.join(self.root, name)):
+            return [], ""
+        conv = self.conversation(name)
+        with conv.lock:
+            records, next_cursor = conv.read(cursor, since, until)
+        page = []
+        for timestamp, payload in records:
+            sender, content = bytes(payload).decode("utf-8", "replace").split("|", 1)
+            page.append((timestamp, sender, content))
+        return page, f"{next_cursor[0]}:{next_cursor[1]}" if next_cursor else ""
+
+    def request(self, username, groups, fields, send_many):
+        """处理客户端的 HISTORY 请求（fields 为拆好的 5 个字段），回复交给 send_many"""
+        action, first, second, third, cursor = fields
+        try:
+            if action == "list":
+                conversations = self.overview(username, groups.groups_of(username), float(first or 0))
+                send_many([(HISTORY, pack_fields("list", json.dumps(conversations, ensure_ascii=False)), 0)])
+                return
+            if action != "fetch":
+                raise ValueError(f"未知的存档操作：{action}")
+            peer, since, until = first, float(second or 0), float(third or "inf")
+            if peer.startswith(GROUP_PREFIX) and not groups.is_member(peer[len(GROUP_PREFIX):], username):
+                raise ValueError(f"不在群组 {peer[len(GROUP_PREFIX):]} 中，无法读取群聊记录")
+            seq, _, offset = cursor.partition(":")
+            position = (int(seq), int(offset)) if cursor else None
+            if position is not None and min(position) < 0:
+                raise ValueError(f"游标无效：{cursor}")
+            page, next_cursor = self.fetch(username, peer, since, until, position)
+        except (ValueError, OSError, struct.error) as e:
+            send_many([(NOTICE, f"读取聊天记录失败：{str(e)}", 0)])
+            return
+        send_many([(HISTORY, pack_fields("page", peer, next_cursor, json.dumps(page, ensure_ascii=False)), 0)])
+
+    def stats(self):
+        with self.lock:
+            return {"recorded": self.recorded, "queued": self.queue.qsize(),
+                    "loaded_conversations": len(self.conversations)}
@@ -0,0 +1,282 @@
+import asyncio
+import signal
+import socket
+import time
+
+import metrics
+import protocol
+import relay
+
+MAX_CONNECTIONS_HINT = 10000
+RECV_SIZE = 65536
+SHUTDOWN_WAIT = 1.0  # 退出时等待各连接发完关闭提示的秒数
+client_tasks = set()  # 各连接的处理协程，退出时等它们走完下线流程
+congested = set()  # block 策略下本轮被塞满的接收方，由发送方协程在处理完一批消息后等待
+
+
+def raise_fd_limit():
+    """尽量调高文件描述符上限（万级连接需要）"""
+    try:
+        import resource
+    except ImportError:  # Windows 无 resource 模块
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    target = hard if hard != resource.RLIM_INFINITY else max(soft, MAX_CONNECTIONS_HINT * 2)
+    if soft < target:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+        except (ValueError, OSError):
+            pass
+
+
+class AsyncConnection(relay.Connection):
+    """协程模式的连接：专属写协程负责发送"""
+
+    def __init__(self, writer, addr, codec):
+        super().__init__(addr, codec)
+        self.writer = writer
+        self.has_data = asyncio.Event()
+        self.room = asyncio.Event()  # 队列腾出空间
+        self.writer_task = asyncio.create_task(self.writer_loop())
+
+    def write_many(self, chunks):
+        if self.closed:
+            return
+        size = sum(len(chunk) for chunk in chunks)
+        if self.over_limit(size):
+            if relay.backpressure == "drop_oldest":
+                self.drop_oldest(size)
+            elif relay.backpressure == "block":
+                congested.add(self)  # 不能阻塞事件循环：先放入，由发送方协程随后等待
+            else:
+                self.slow_consumer("发送队列已满")
+                return
+        self.outbox.append((chunks, size))
+        self.outbox_bytes += size
+        self.has_data.set()
+
+    async def writer_loop(self):
+        """写协程：把积攒的多组数据合并成一次写入传输层并等待排空，关闭后发完剩余数据再断开
+
+        asyncio 的 TCP 传输默认已开启 TCP_NODELAY（--no-coalesce 时在连接建立后关闭，与线程模式一致）。
+        """
+        try:
+            while True:
+                await self.has_data.wait()
+                self.has_data.clear()
+                while self.outbox:
+                    batch, batch_size, groups = [], 0, 0
+                    limit = relay.COALESCE_BYTES if relay.coalesce else 1  # 不合并时每次只取一组
+                    while self.outbox and batch_size < limit:
+                        chunks, size = self.outbox.popleft()
+                        batch.extend(chunks)
+                        batch_size += size
+                        groups += 1
+                    if relay.coalesce:
+                        self.write_batch(batch)
+                    else:
+                        for data in batch:
+                            self.writer.write(data)
+                        metrics.inc("write.calls", len(batch))
+                    metrics.inc("write.groups", groups)
+                    await self.writer.drain()  # 传输层缓冲低于水位线时立即返回
+                    self.outbox_bytes -= batch_size
+                    self.room.set()
+                if self.closed and not self.outbox:
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.closed = True
+            self.outbox.clear()
+            self.outbox_bytes = 0
+            self.room.set()
+            self.writer.close()
+
+    def write_batch(self, batch):
+        """小数据块合并成一次写入，大块（图片数据）单独写入，避免拼接拷贝"""
+        small = []
+        for data in batch:
+            if len(data) < protocol.ZERO_COPY_THRESHOLD:
+                small.append(data)
+                continue
+            if small:
+                self.writer.writelines(small)
+                small = []
+                metrics.inc("write.calls")
+            self.writer.write(data)
+            metrics.inc("write.calls")
+        if small:
+            self.writer.writelines(small)
+            metrics.inc("write.calls")
+
+    def close(self):
+        self.closed = True
+        self.has_data.set()
+
+    def abort(self):
+        self.closed = True
+        self.outbox.clear()
+        self.outbox_bytes = 0
+        self.room.set()
+        self.has_data.set()
+        self.writer.transport.abort()
+
+    async def wait_room(self):
+        while not self.closed and self.over_limit(0):
+            self.room.clear()
+            await self.room.wait()
+
+
+async def wait_congested():
+    """block 策略：发送方处理完一批消息后，等被它塞满的接收方腾出空间再继续读，等太久则断开对方"""
+    targets = list(congested)
+    congested.clear()
+    for conn in targets:
+        if conn.closed or not conn.over_limit(0):
+            continue
+        metrics.inc("backpressure.blocked")
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(conn.wait_room(), relay.BLOCK_TIMEOUT)
+        except asyncio.TimeoutError:
+            conn.slow_consumer(f"等待超过 {relay.BLOCK_TIMEOUT} 秒")
+        metrics.observe("backpressure.block_wait", time.perf_counter() - start)
+
+
+def read_size(conn):
+    """正在接收大帧时一次读够该帧剩余部分（最多 1 块），减少读调用次数"""
+    pending = conn.parser.pending_view() if conn.codec is protocol.FramedCodec else None
+    if pending is None:
+        return RECV_SIZE
+    return max(RECV_SIZE, min(len(pending), protocol.BULK_CHUNK_SIZE))
+
+
+async def detect_protocol(reader):
+    """根据首批数据识别协议，返回 (编解码器, 去掉前缀后的数据)"""
+    data = await reader.read(65536)
+    codec, data = protocol.detect_codec(data)
+    while codec is None:
+        more = await reader.read(65536)
+        if not more:
+            raise Exception("未接收到用户名")
+        codec, data = protocol.detect_codec(data + more)
+    return codec, data
+
+
+async def handle_client(reader, writer):
+    """处理客户端连接（协程版，每个连接只占用一个协程）"""
+    client_addr = writer.get_extra_info("peername")
+    sock = writer.get_extra_info("socket")
+    if not relay.coalesce and sock is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 0)
+    conn = None
+    task = asyncio.current_task()
+    client_tasks.add(task)
+    try:
+        codec, data = await asyncio.wait_for(detect_protocol(reader), 5.0)
+        conn = AsyncConnection(writer, client_addr, codec)
+        frames = conn.parser.feed(data)
+        while not frames:
+            data = await asyncio.wait_for(reader.read(65536), 5.0)
+            if not data:
+                raise Exception("未接收到用户名")
+            frames = conn.parser.feed(data)
+        if not relay.handle_hello(conn, frames[0]):
+            return
+
+        frames = frames[1:]
+        while True:
+            for frame in frames:
+                delay = relay.admit(conn, frame)
+                if delay is None:
+                    continue
+                if delay:
+                    await asyncio.sleep(delay)
+                if not relay.handle_frame(conn, frame):
+                    return
+            if congested:
+                await wait_congested()
+            data = await reader.read(read_size(conn))
+            if not data:
+                break
+            conn.last_seen = time.monotonic()
+            metrics.inc("bytes.in", len(data))
+            frames = conn.parser.feed(data)
+
+    except asyncio.TimeoutError:
+        print(f"⏱️ {client_addr} 用户名接收超时")
+    except asyncio.CancelledError:
+        # 服务端退出时仍未结束的连接：直接断开，照常走下面的下线流程后正常返回（被取消的连接协程会打印异常栈）
+        if conn is not None:
+            conn.abort()
+    except ConnectionResetError:
+        print(f"🔌 {conn.username if conn else client_addr} 连接被客户端重置")
+    except Exception as e:
+        print(f"⚠️ {conn.username if conn else client_addr} 消息处理异常：{str(e)}")
+    finally:
+        if conn is not None:
+            relay.logout(conn)
+            conn.close()
+            try:
+                await conn.writer_task
+            except asyncio.CancelledError:
+                conn.abort()
+        else:
+            print(f"🔌 {client_addr} 下线")
+            writer.close()
+        client_tasks.discard(task)
+
+
+async def heartbeat_loop():
+    """心跳协程：每个时间轮刻度检查一次到期的连接"""
+    while True:
+        await asyncio.sleep(relay.heartbeats.tick)
+        relay.check_heartbeats()
+
+
+async def serve(host, port, worker=None):
+    """启动协程服务端；worker 为 cluster.WorkerLink 时作为多进程模式的工作进程（与其他进程共用端口）"""
+    raise_fd_limit()
+    if worker is not None:
+        await worker.connect()
+    server = await asyncio.start_server(handle_client, host, port, reuse_address=True,
+                                        reuse_port=worker is not None, backlog=1024)
+    if worker is not None:
+        print(f"🚀 工作进程 {worker.worker_id} 启动成功 | 监听：{host}:{port}")
+    else:
+        print(f"🚀 服务端启动成功（协程模式）| 监听：{host}:{port}")
+    print("💡 按 Ctrl+C 优雅退出")
+    print("=" * 50)
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):  # Windows 不支持，退回 KeyboardInterrupt
+            pass
+
+    heartbeat_task = asyncio.create_task(heartbeat_loop())
+    async with server:
+        try:
+            await stop_event.wait()
+        finally:
+            print("\n📤 服务端正在退出...")
+            heartbeat_task.cancel()
+            server.close()
+            relay.broadcast_shutdown()
+            if client_tasks:  # 已通知关闭的连接发完提示后自行结束，剩下的取消
+                _, pending = await asyncio.wait(set(client_tasks), timeout=SHUTDOWN_WAIT)
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+    print("✅ 服务端已安全退出")
+
+
+def run(host, port, worker=None):
+    """协程模式入口"""
+    try:
+        asyncio.run(serve(host, port, worker))
+    except KeyboardInterrupt:
+        print("✅ 服务端已安全退出")
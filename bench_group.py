@@ -0,0 +1,198 @@
+"""
+群消息扇出测试：一个发言者向 N 人的群组连续发消息，统计每条送达延迟和整条消息送达全部成员的时间
+
+用法：python bench_group.py [--members 500] [--posts 200] [--rate 20] [--mode thread|async] [--compare]
+--compare 同时测“逐个单发”（发言者对每个成员各发一条 TEXT，相当于没有群组时的做法）作为对照。
+默认在本机临时端口启动一个服务端子进程（不保存群组、离线消息和存档，不限速），测完自动关闭。
+"""
+import argparse
+import asyncio
+import os
+import time
+
+from async_server import raise_fd_limit
+from bench_image import free_port, start_server
+from bench_server import RECV_SIZE, percentile, process_rss
+from protocol import (
+    GROUP, GROUP_MSG, HELLO, MAGIC, PING, PONG, STATS, TEXT, FrameParser, encode_frame, pack_fields,
+    unpack_fields,
+)
+
+
+class Delivery:
+    """所有成员收到的消息：每条的送达延迟、每个编号收到的人数和最后送达时刻"""
+
+    def __init__(self, members):
+        self.members = members
+        self.latency = []  # 毫秒
+        self.received = {}  # {消息编号: 人数}
+        self.completed = {}  # {消息编号: 全部送达用时（毫秒）}
+        self.done = None
+
+    def record(self, content):
+        post_id, sent_ns, _ = content.split("|", 2)
+        elapsed = (time.perf_counter_ns() - int(sent_ns)) / 1e6
+        self.latency.append(elapsed)
+        count = self.received[post_id] = self.received.get(post_id, 0) + 1
+        if count == self.members:
+            self.completed[post_id] = elapsed
+            if self.done is not None and len(self.completed) >= self.done[0] and not self.done[1].done():
+                self.done[1].set_result(True)
+
+
+class Member:
+    """一个连接：读协程解析下发的帧"""
+
+    def __init__(self, name, delivery):
+        self.name = name
+        self.delivery = delivery
+        self.parser = FrameParser()
+        self.reader = None
+        self.writer = None
+        self.joined = None
+        self.server_stats = None
+
+    async def connect(self, addr, group, action):
+        self.reader, self.writer = await asyncio.open_connection(*addr)
+        self.joined = asyncio.get_running_loop().create_future()
+        self.writer.write(MAGIC + encode_frame(HELLO, self.name) + encode_frame(GROUP, pack_fields(action, group)))
+
+    async def read_loop(self):
+        try:
+            while True:
+                data = await self.reader.read(RECV_SIZE)
+                if not data:
+                    break
+                for frame in self.parser.feed(data):
+                    self.handle_frame(frame)
+        except (ConnectionError, OSError):
+            pass
+        if not self.joined.done():
+            self.joined.set_result(False)
+
+    def handle_frame(self, frame):
+        mtype = frame.type
+        if mtype == GROUP and not self.joined.done():
+            self.joined.set_result(True)  # 创建/加入后服务端回复所在群组
+        elif mtype == GROUP_MSG:
+            self.delivery.record(unpack_fields(frame.payload, 3)[2])
+        elif mtype == TEXT:
+            self.delivery.record(unpack_fields(frame.payload, 2)[1])
+        elif mtype == STATS and self.server_stats is not None:
+            self.server_stats.set_result(bytes(frame.payload).decode("utf-8", "replace"))
+        elif mtype == PING:
+            self.writer.write(encode_frame(PONG))
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
+
+async def run_round(args, addr, style, tag):
+    """一轮测试：style 为 group（群发）或 unicast（逐个单发）"""
+    delivery = Delivery(args.members)
+    group = f"b{tag}{style[0]}"
+    poster = Member(f"bench_{tag}_{style}_poster", delivery)
+    await poster.connect(addr, group, "create")
+    tasks = [asyncio.create_task(poster.read_loop())]
+    if not await poster.joined:
+        raise RuntimeError("创建群组失败")
+    members = [Member(f"bench_{tag}_{style}_{i}", delivery) for i in range(args.members)]
+    for start in range(0, len(members), 100):  # 分批连接，避免 SYN 队列溢出
+        await asyncio.gather(*(member.connect(addr, group, "join") for member in members[start:start + 100]))
+    tasks += [asyncio.create_task(member.read_loop()) for member in members]
+    results = await asyncio.gather(*(member.joined for member in members))
+    if not all(results):
+        print(f"⚠️ {results.count(False)} 个成员加入失败")
+
+    padding = "x" * max(0, args.text_bytes - 30)
+    delivery.done = (args.posts, asyncio.get_running_loop().create_future())
+    start = time.perf_counter()
+    for post_id in range(args.posts):
+        content = f"{post_id}|{time.perf_counter_ns()}|{padding}"
+        if style == "group":
+            poster.writer.write(encode_frame(GROUP_MSG, pack_fields(group, content)))
+        else:
+            poster.writer.write(b"".join(encode_frame(TEXT, pack_fields(member.name, content)) for member in members))
+        await poster.writer.drain()
+        await asyncio.sleep(max(0.0, start + (post_id + 1) / args.rate - time.perf_counter()))
+    try:
+        await asyncio.wait_for(delivery.done[1], args.drain)
+    except asyncio.TimeoutError:
+        print(f"⚠️ {args.posts - len(delivery.completed)} 条消息在结束时仍未送达全部成员")
+    elapsed = time.perf_counter() - start
+
+    server_stats = None
+    if args.server_stats:
+        poster.server_stats = asyncio.get_running_loop().create_future()
+        poster.writer.write(encode_frame(STATS))
+        try:
+            server_stats = await asyncio.wait_for(poster.server_stats, 5.0)
+        except asyncio.TimeoutError:
+            server_stats = "（服务端未回应 STATS）"
+    poster.writer.write(encode_frame(GROUP, pack_fields("leave", group)))
+    for member in members:
+        member.writer.write(encode_frame(GROUP, pack_fields("leave", group)))
+    await asyncio.sleep(0.2)
+    for member in [poster] + members:
+        member.close()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return delivery, elapsed, server_stats
+
+
+def report(style, delivery, elapsed):
+    latency = sorted(delivery.latency)
+    completed = sorted(delivery.completed.values())
+    print(f"{style:<10}{len(latency):>10}{len(latency) / elapsed:>12.0f}"
+          f"{percentile(latency, 50):>10.2f}{percentile(latency, 99):>10.2f}"
+          f"{percentile(completed, 50):>12.2f}{percentile(completed, 99):>12.2f}")
+
+
+async def run_bench(args, addr, server_pid):
+    tag = f"{os.getpid() % 100000}"
+    styles = ["group", "unicast"] if args.compare else ["group"]
+    results = []
+    rss_before = process_rss(server_pid) if server_pid else None
+    for style in styles:
+        results.append((style,) + await run_round(args, addr, style, tag))
+    print(f"\n{args.members} 名成员，{args.posts} 条消息，每秒 {args.rate} 条，每条 {args.text_bytes} 字节")
+    print(f"{'方式':<10}{'送达数':>10}{'送达/秒':>12}{'p50(ms)':>10}{'p99(ms)':>10}"
+          f"{'全员p50(ms)':>12}{'全员p99(ms)':>12}")
+    for style, delivery, elapsed, _ in results:
+        report(style, delivery, elapsed)
+    if rss_before:
+        print(f"服务端内存：{rss_before / 1024 / 1024:.1f} MB → {(process_rss(server_pid) or 0) / 1024 / 1024:.1f} MB")
+    for style, _, _, server_stats in results:
+        if server_stats:
+            print(f"\n服务端指标（{style} 之后）：\n{server_stats}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="群消息扇出测试")
+    parser.add_argument("--members", type=int, default=500, help="群成员数（不含发言者）")
+    parser.add_argument("--posts", type=int, default=200, help="发送的消息条数")
+    parser.add_argument("--rate", type=float, default=20, help="每秒发送条数")
+    parser.add_argument("--text-bytes", type=int, default=64, help="消息大小")
+    parser.add_argument("--drain", type=float, default=30, help="发送结束后等待送达的最长时间（秒）")
+    parser.add_argument("--compare", action="store_true", help="同时测逐个单发作为对照")
+    parser.add_argument("--server-stats", action="store_true", help="每轮结束时打印服务端 STATS 指标")
+    parser.add_argument("--mode", choices=["thread", "async"], default="thread")
+    parser.add_argument("--port", type=int, default=0, help="默认随机端口")
+    parser.add_argument("--no-spawn", action="store_true", help="不启动服务端，连接已运行的服务端")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    port = args.port or (8888 if args.no_spawn else free_port())
+    proc = None if args.no_spawn else start_server(args.mode, port, ["--no-rate-limit"])
+    try:
+        asyncio.run(run_bench(args, ("127.0.0.1", port), proc.pid if proc else None))
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+"""
+图片转发吞吐测试：对比旧版 1024 字节收发路径、大块图片帧（sendfile + recv_into）路径，
+以及客户端现在实际使用的分块文件传输（file_transfer.py：块头 + sendfile，按窗口确认，收齐后校验）
+
+用法：python bench_image.py [--size-mb 20] [--rounds 3] [--mode thread|async]
+默认在本机临时端口启动一个服务端子进程（不保存群组、离线消息和存档），测完自动关闭；也可用 --no-spawn 连接已启动的服务端。
+"""
+import argparse
+import os
+import select
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from blob_store import BlobStore
+from file_transfer import TransferManager
+from protocol import (
+    BULK_CHUNK_SIZE, FILE_ACK, FILE_CANCEL, FILE_CHUNK, FILE_OFFER, FLAG_LAST, HELLO, IMAGE, IMAGE_DATA, MAGIC,
+    FrameParser, encode_frame, encode_header, pack_fields,
+)
+
+LEGACY_CHUNK = 1024
+# 压测用的服务端不保存群组、离线消息和存档：不在工作目录留下数据，也不受上一次运行留下的状态影响
+BENCH_SERVER_ARGS = ("--groups-file", "", "--no-offline", "--no-archive")
+
+
+def start_server(mode, port, extra_args=()):
+    """启动服务端子进程（不保存任何数据）并等待端口可连接"""
+    proc = subprocess.Popen([sys.executable, "server.py", "--mode", mode, "--host", "127.0.0.1",
+                             "--port", str(port), *BENCH_SERVER_ARGS, *extra_args],
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("服务端启动失败")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def legacy_login(addr, name):
+    sock = socket.create_connection(addr)
+    sock.send(name.encode("utf-8"))
+    return sock
+
+
+def framed_login(addr, name):
+    sock = socket.create_connection(addr)
+    sock.sendall(MAGIC + encode_frame(HELLO, name))
+    return sock
+
+
+def legacy_send(sock, target, path, size):
+    """旧版：每次读 1024 字节再 send"""
+    sock.send(f"image|{target}|bench.bin".encode("utf-8"))
+    time.sleep(0.05)  # 旧协议没有边界，需错开图片头和大小
+    sock.send(struct.pack("!I", size))
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(LEGACY_CHUNK)
+            if not data:
+                break
+            sock.send(data)
+
+
+def legacy_recv(sock, size, sender):
+    """旧版：每次 recv 1024 字节，直到收齐"""
+    expect = len(f"image|{sender}|bench.bin".encode("utf-8")) + 4 + size
+    got = 0
+    while got < expect:
+        data = sock.recv(LEGACY_CHUNK)
+        if not data:
+            break
+        got += len(data)
+
+
+def bulk_send(sock, target, path, size):
+    """新版：每块一个帧头 + sendfile"""
+    sock.sendall(encode_frame(IMAGE, pack_fields(target, "bench.bin", size)))
+    with open(path, "rb") as f:
+        sent = 0
+        while sent < size:
+            count = min(BULK_CHUNK_SIZE, size - sent)
+            sock.sendall(encode_header(IMAGE_DATA, count, FLAG_LAST if sent + count >= size else 0))
+            sock.sendfile(f, sent, count)
+            sent += count
+
+
+def bulk_recv(sock, size, sender):
+    """新版：复用缓冲 recv_into，大帧直接收进帧缓冲"""
+    parser = FrameParser(reuse_buffer=True)
+    buf = bytearray(256 * 1024)
+    got = 0
+    while True:
+        pending = parser.pending_view()
+        if pending is not None and len(pending) > len(buf):
+            frames = parser.commit(sock.recv_into(pending))
+        else:
+            nbytes = sock.recv_into(buf)
+            if not nbytes:
+                return
+            frames = parser.feed(memoryview(buf)[:nbytes])
+        for frame in frames:
+            if frame.type == IMAGE_DATA:
+                got += len(frame.payload)
+                if frame.flags & FLAG_LAST:
+                    return
+
+
+def transfer_manager(sock, recv_dir, done):
+    """与客户端相同的 TransferManager，完成或失败时置位 done"""
+    lock = threading.Lock()
+
+    def send_frame(mtype, payload=b"", flags=0):
+        with lock:
+            sock.sendall(encode_frame(mtype, payload, flags))
+
+    def send_file_frame(mtype, head, f, offset, count):
+        with lock:
+            sock.sendall(encode_header(mtype, len(head) + count) + head)
+            sock.sendfile(f, offset, count)
+
+    def on_error(text):
+        print(f"⚠️ {text}")
+        done.set()
+
+    return TransferManager(send_frame, send_file_frame, recv_dir, BlobStore(os.path.join(recv_dir, "images")),
+                           lambda direction, peer, path: done.set(), on_error, lambda text: None)
+
+
+def dispatch_file_frames(sock, manager, done):
+    """读出 FILE_* 帧交给 manager，直到 done 或连接关闭"""
+    parser = FrameParser()
+    handlers = {FILE_OFFER: manager.handle_offer, FILE_CHUNK: manager.handle_chunk,
+                FILE_ACK: manager.handle_ack, FILE_CANCEL: manager.handle_cancel}
+    while not done.is_set():
+        try:
+            if not select.select([sock], [], [], 0.05)[0]:
+                continue  # 收齐后的校验在另一个线程中完成，定期回来看 done
+            data = sock.recv(256 * 1024)
+        except OSError:
+            return
+        if not data:
+            return
+        for frame in parser.feed(data):
+            handler = handlers.get(frame.type)
+            if handler:
+                handler(frame.payload)
+
+
+def file_send(sock, target, path, size):
+    """分块文件传输：FILE_OFFER 后按确认发 FILE_CHUNK，等对方校验完确认收齐"""
+    done = threading.Event()
+    work_dir = tempfile.mkdtemp()
+    try:
+        manager = transfer_manager(sock, work_dir, done)
+        threading.Thread(target=dispatch_file_frames, args=(sock, manager, done), daemon=True).start()
+        manager.send_file(path, target)
+        done.wait()
+        manager.running = False
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def file_recv(sock, size, sender):
+    """分块文件传输的接收方：写入 .part，收齐后校验 CRC32/SHA-256 再保存"""
+    done = threading.Event()
+    work_dir = tempfile.mkdtemp()
+    try:
+        manager = transfer_manager(sock, work_dir, done)
+        dispatch_file_frames(sock, manager, done)
+        done.wait()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def run_round(addr, login, send, recv, path, size, tag):
+    sender = login(addr, f"s_{tag}")
+    receiver = login(addr, f"r_{tag}")
+    time.sleep(0.2)
+    t = threading.Thread(target=recv, args=(receiver, size, f"s_{tag}"))
+    t.start()
+    start = time.perf_counter()
+    send(sender, f"r_{tag}", path, size)
+    t.join()
+    elapsed = time.perf_counter() - start
+    sender.close()
+    receiver.close()
+    time.sleep(0.1)
+    return size / elapsed / 1024 / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description="图片转发吞吐测试")
+    parser.add_argument("--size-mb", type=float, default=20)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--mode", choices=["thread", "async"], default="thread")
+    parser.add_argument("--port", type=int, default=0, help="默认随机端口")
+    parser.add_argument("--no-spawn", action="store_true", help="不启动服务端，连接已运行的服务端")
+    args = parser.parse_args()
+
+    port = args.port or (8888 if args.no_spawn else free_port())
+    proc = None if args.no_spawn else start_server(args.mode, port)
+    addr = ("127.0.0.1", port)
+    size = int(args.size_mb * 1024 * 1024)
+    with tempfile.NamedTemporaryFile(delete=False) as f:
+        f.write(os.urandom(size))
+        path = f.name
+    try:
+        print(f"图片大小 {args.size_mb} MB，服务端模式 {args.mode}，每种方式 {args.rounds} 轮")
+        results = {}
+        for name, login, send, recv in (("旧版 1024B 收发", legacy_login, legacy_send, legacy_recv),
+                                        ("图片帧 sendfile+recv_into", framed_login, bulk_send, bulk_recv),
+                                        ("分块文件传输（客户端）", framed_login, file_send, file_recv)):
+            speeds = [run_round(addr, login, send, recv, path, size, f"{i}{len(results)}")
+                      for i in range(args.rounds)]
+            results[name] = max(speeds)
+            print(f"{name:<24} 最好 {max(speeds):8.1f} MB/s | 各轮 " + " ".join(f"{v:.1f}" for v in speeds))
+        old = results["旧版 1024B 收发"]
+        for name, speed in list(results.items())[1:]:
+            print(f"{name} 是旧版的 {speed / old:.1f} 倍")
+    finally:
+        os.remove(path)
+        if proc:
+            proc.terminate()
+            proc.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,331 @@
+"""
+服务端压力测试：模拟 N 个用户按比例混合发送文字、在线查询、好友申请和图片，统计吞吐、端到端延迟和每连接内存
+
+用法：python bench_server.py [--users 200] [--rate 5] [--duration 10] [--mix text=90,user_query=5,friend_req=4,image=1]
+默认在本机临时端口启动一个服务端子进程（不保存群组、离线消息和存档），测完自动关闭；也可用 --no-spawn 连接已启动的服务端。
+
+延迟口径：文字、图片为发送到对方收齐的时间；好友申请、在线查询为发送到收到服务端回应的时间。
+--flooders N 另开 N 个失控的用户不停地发送在线查询（或发给不存在用户的文字，--flood-kind text），
+不计入统计，用来观察服务端限速能否让其他用户的延迟保持稳定（加 --server-arg=--no-rate-limit 对照）。
+所有模拟用户跑在同一个事件循环里，用户数很大时压测端自身也会成为瓶颈，可观察“实际发送速率”一列。
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from collections import deque
+
+from async_server import raise_fd_limit
+from bench_image import free_port, start_server
+from protocol import (
+    BULK_CHUNK_SIZE, FLAG_LAST, FRIEND_REQ, HELLO, IMAGE, IMAGE_DATA, MAGIC, NOTICE, PING, PONG, STATS, TEXT,
+    USER_LIST, USER_QUERY, FrameParser, encode_frame, encode_header, pack_fields, unpack_fields,
+)
+
+KINDS = ("text", "user_query", "friend_req", "image")
+DEFAULT_MIX = "text=90,user_query=5,friend_req=4,image=1"
+RECV_SIZE = 65536
+FLOOD_BATCH = 100  # 失控用户每次写入的帧数
+
+
+def parse_mix(text):
+    """解析 text=90,image=1 形式的比例"""
+    mix = {}
+    for item in text.split(","):
+        if not item.strip():
+            continue
+        kind, _, weight = item.partition("=")
+        kind = kind.strip()
+        if kind not in KINDS:
+            raise ValueError(f"未知的消息类型：{kind}")
+        mix[kind] = float(weight or 1)
+    if not mix or sum(mix.values()) <= 0:
+        raise ValueError("消息比例不能为空")
+    return mix
+
+
+def percentile(sorted_values, p):
+    """已排序数据的百分位数"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))
+    return sorted_values[index]
+
+
+def process_rss(pid):
+    """进程常驻内存（字节），非 Linux 返回 None"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class Stats:
+    """各类消息的发送数、完成数和延迟（毫秒）"""
+
+    def __init__(self):
+        self.sent = dict.fromkeys(KINDS, 0)
+        self.latency = {kind: [] for kind in KINDS}
+        self.bytes_in = 0
+        self.record_from = None  # 预热结束时刻，此后发出的消息才计入统计
+
+    def start_recording(self):
+        self.record_from = time.perf_counter_ns()
+        self.bytes_in = 0
+
+    def count_sent(self, kind, start_ns):
+        if self.record_from is not None and start_ns >= self.record_from:
+            self.sent[kind] += 1
+
+    def record(self, kind, start_ns):
+        if self.record_from is not None and start_ns >= self.record_from:
+            self.latency[kind].append((time.perf_counter_ns() - start_ns) / 1e6)
+
+
+class SimUser:
+    """一个模拟用户：读协程解析下发的帧，写协程按速率发送"""
+
+    def __init__(self, name, stats):
+        self.name = name
+        self.stats = stats
+        self.parser = FrameParser()
+        self.reader = None
+        self.writer = None
+        self.acks = deque()  # 等待服务端回应的请求 (类型, 发送时间)，回应按发送顺序到达
+        self.logged_in = None
+        self.image = None  # 正在接收的图片发送时间
+        self.server_stats = None  # 等待服务端 STATS 回应
+
+    async def connect(self, addr):
+        self.reader, self.writer = await asyncio.open_connection(*addr)
+        self.logged_in = asyncio.get_running_loop().create_future()
+        self.writer.write(MAGIC + encode_frame(HELLO, self.name) + encode_frame(USER_QUERY))
+
+    async def read_loop(self):
+        try:
+            while True:
+                data = await self.reader.read(RECV_SIZE)
+                if not data:
+                    break
+                self.stats.bytes_in += len(data)
+                for frame in self.parser.feed(data):
+                    self.handle_frame(frame)
+        except (ConnectionError, OSError):
+            pass
+        if not self.logged_in.done():
+            self.logged_in.set_result(False)
+
+    def handle_frame(self, frame):
+        mtype = frame.type
+        if not self.logged_in.done():
+            # 登录后的第一条回应是在线列表；用户名被占用等情况会先收到提示
+            self.logged_in.set_result(mtype == USER_LIST)
+            return
+        if mtype == STATS and self.server_stats is not None:
+            self.server_stats.set_result(bytes(frame.payload).decode("utf-8", "replace"))
+        elif mtype == PING:
+            self.writer.write(encode_frame(PONG))
+        elif mtype == TEXT:
+            _, content = unpack_fields(frame.payload, 2)
+            self.stats.record("text", int(content.split("|", 1)[0]))
+        elif mtype == IMAGE:
+            _, filename, _ = unpack_fields(frame.payload, 3)
+            self.image = int(filename.split(".", 1)[0])
+        elif mtype == IMAGE_DATA:
+            if frame.flags & FLAG_LAST and self.image is not None:
+                self.stats.record("image", self.image)
+                self.image = None
+        elif mtype in (NOTICE, USER_LIST) and self.acks:
+            kind, start_ns = self.acks.popleft()
+            if kind in ("user_query", "friend_req"):
+                self.stats.record(kind, start_ns)
+
+    def send(self, kind, target, padding, image_data):
+        now = time.perf_counter_ns()
+        if kind == "text":
+            self.writer.write(encode_frame(TEXT, pack_fields(target, f"{now}|{padding}")))
+        elif kind == "user_query":
+            self.writer.write(encode_frame(USER_QUERY))
+        elif kind == "friend_req":
+            self.writer.write(encode_frame(FRIEND_REQ, pack_fields(target, "apply")))
+        else:
+            size = len(image_data)
+            self.writer.write(encode_frame(IMAGE, pack_fields(target, f"{now}.bin", size)))
+            for offset in range(0, size, BULK_CHUNK_SIZE):
+                chunk = image_data[offset:offset + BULK_CHUNK_SIZE]
+                flags = FLAG_LAST if offset + len(chunk) >= size else 0
+                self.writer.write(encode_header(IMAGE_DATA, len(chunk), flags))
+                self.writer.write(chunk)
+        self.acks.append((kind, now))
+        self.stats.count_sent(kind, now)
+
+    async def send_loop(self, users, mix, rate, until, padding, image_data):
+        kinds = list(mix)
+        weights = [mix[kind] for kind in kinds]
+        await asyncio.sleep(random.random() / rate)  # 错开各用户的发送时刻
+        next_at = time.monotonic()
+        while time.monotonic() < until:
+            kind = random.choices(kinds, weights)[0]
+            target = random.choice(users)
+            while target is self and len(users) > 1:
+                target = random.choice(users)
+            self.send(kind, target.name, padding, image_data)
+            await self.writer.drain()
+            next_at += random.expovariate(rate)  # 泊松到达
+            delay = next_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def flood_loop(self, kind, until):
+        """不看速率连续发送（模拟失控的客户端），返回发出的条数"""
+        if kind == "user_query":
+            frame = encode_frame(USER_QUERY)
+        else:
+            frame = encode_frame(TEXT, pack_fields(f"{self.name}_nobody", "0|flood"))
+        sent = 0
+        while time.monotonic() < until:
+            self.writer.write(frame * FLOOD_BATCH)
+            sent += FLOOD_BATCH
+            try:  # 服务端放慢读取后发送缓冲写满，在这里等待
+                await asyncio.wait_for(self.writer.drain(), max(0.0, until - time.monotonic()))
+            except asyncio.TimeoutError:
+                break
+            await asyncio.sleep(0)
+        return sent
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
+
+async def run_bench(args, addr, server_pid):
+    stats = Stats()
+    mix = parse_mix(args.mix)
+    image_data = os.urandom(int(args.image_kb * 1024))
+    padding = "x" * max(0, args.text_bytes - 20)
+    tag = f"{os.getpid()}_{int(time.time())}"
+    users = [SimUser(f"bench_{tag}_{i}", stats) for i in range(args.users)]
+    flooders = [SimUser(f"flood_{tag}_{i}", Stats()) for i in range(args.flooders)]  # 单独统计，不计入结果
+
+    rss_before = process_rss(server_pid) if server_pid else None
+    everyone = users + flooders
+    for start in range(0, len(everyone), 100):  # 分批连接，避免 SYN 队列溢出
+        await asyncio.gather(*(user.connect(addr) for user in everyone[start:start + 100]))
+    readers = [asyncio.create_task(user.read_loop()) for user in everyone]
+    results = await asyncio.gather(*(user.logged_in for user in everyone))
+    if not all(results):
+        print(f"⚠️ {results.count(False)} 个用户登录失败")
+    await asyncio.sleep(0.5)
+    rss_idle = process_rss(server_pid) if server_pid else None
+
+    print(f"{args.users} 个用户已上线，每人 {args.rate} 条/秒，持续 {args.duration} 秒，比例 {mix}")
+    start = time.monotonic()
+    until = start + args.warmup + args.duration
+    asyncio.get_running_loop().call_later(args.warmup, stats.start_recording)
+    rss_peak = rss_idle or 0
+    senders = [asyncio.create_task(user.send_loop(users, mix, args.rate, until, padding, image_data))
+               for user in users]
+    floods = [asyncio.create_task(user.flood_loop(args.flood_kind, until)) for user in flooders]
+    while time.monotonic() < until:
+        await asyncio.sleep(0.5)
+        if server_pid:
+            rss_peak = max(rss_peak, process_rss(server_pid) or 0)
+    await asyncio.gather(*senders)
+    elapsed = time.monotonic() - start - args.warmup
+    if floods:
+        flooded = sum(await asyncio.gather(*floods))
+        print(f"{len(flooders)} 个失控用户共写出 {flooded} 条 {args.flood_kind}（{flooded / (elapsed + args.warmup):.0f} 条/秒）")
+
+    drain_deadline = time.monotonic() + args.drain
+    while any(user.acks for user in users) and time.monotonic() < drain_deadline:
+        await asyncio.sleep(0.1)
+    server_stats = None
+    if args.server_stats:
+        users[0].server_stats = asyncio.get_running_loop().create_future()
+        users[0].writer.write(encode_frame(STATS))
+        try:
+            server_stats = await asyncio.wait_for(users[0].server_stats, 5.0)
+        except asyncio.TimeoutError:
+            server_stats = "（服务端未回应 STATS）"
+    for user in everyone:
+        user.close()
+    for task in readers:
+        task.cancel()
+    await asyncio.gather(*readers, return_exceptions=True)
+
+    report(args, stats, elapsed, users, rss_before, rss_idle, rss_peak)
+    if server_stats:
+        print(f"\n服务端指标：\n{server_stats}")
+    p99 = max((percentile(sorted(values), 99) for values in stats.latency.values() if values), default=0)
+    return args.max_p99 is None or p99 <= args.max_p99
+
+
+def report(args, stats, elapsed, users, rss_before, rss_idle, rss_peak):
+    print(f"\n{'类型':<12}{'发送':>9}{'完成':>9}{'吞吐/秒':>10}{'p50(ms)':>10}{'p99(ms)':>10}{'p999(ms)':>10}{'max(ms)':>10}")
+    total_done = 0
+    for kind in KINDS:
+        values = sorted(stats.latency[kind])
+        if not stats.sent[kind]:
+            continue
+        total_done += len(values)
+        print(f"{kind:<12}{stats.sent[kind]:>9}{len(values):>9}{len(values) / elapsed:>10.0f}"
+              f"{percentile(values, 50):>10.2f}{percentile(values, 99):>10.2f}"
+              f"{percentile(values, 99.9):>10.2f}{(values[-1] if values else 0):>10.2f}")
+    print(f"合计完成 {total_done / elapsed:.0f} 条/秒，实际发送速率 {sum(stats.sent.values()) / elapsed:.0f} 条/秒"
+          f"（目标 {args.users * args.rate:.0f}），下行 {stats.bytes_in / elapsed / 1024 / 1024:.1f} MB/s")
+    unanswered = sum(len(user.acks) for user in users)
+    if unanswered:
+        print(f"⚠️ {unanswered} 条请求在结束时仍未收到回应")
+    if rss_idle and rss_before:
+        print(f"服务端内存：空载 {rss_before / 1024 / 1024:.1f} MB，{args.users} 连接空闲 {rss_idle / 1024 / 1024:.1f} MB"
+              f"（每连接约 {(rss_idle - rss_before) / args.users / 1024:.1f} KB），压测峰值 {rss_peak / 1024 / 1024:.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="服务端压力测试")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=5, help="每个用户每秒发送条数")
+    parser.add_argument("--duration", type=float, default=10, help="统计时长（秒）")
+    parser.add_argument("--warmup", type=float, default=1, help="预热时长（秒），不计入统计")
+    parser.add_argument("--drain", type=float, default=5, help="发送结束后等待回应的最长时间（秒）")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="消息比例，如 text=90,user_query=5,friend_req=4,image=1")
+    parser.add_argument("--text-bytes", type=int, default=64, help="文字消息大小")
+    parser.add_argument("--image-kb", type=float, default=256, help="图片大小（KB）")
+    parser.add_argument("--max-p99", type=float, help="任一类型 p99 超过该值（毫秒）时返回非零退出码")
+    parser.add_argument("--flooders", type=int, default=0, help="另外不停发送消息的失控用户数（不计入统计）")
+    parser.add_argument("--flood-kind", choices=["user_query", "text"], default="user_query",
+                        help="失控用户发送的消息：user_query 在线查询（默认）；text 发给不存在用户的文字")
+    parser.add_argument("--server-stats", action="store_true", help="结束时打印服务端 STATS 指标")
+    parser.add_argument("--mode", choices=["thread", "async"], default="thread")
+    parser.add_argument("--port", type=int, default=0, help="默认随机端口")
+    parser.add_argument("--no-spawn", action="store_true", help="不启动服务端，连接已运行的服务端")
+    parser.add_argument("--server-arg", action="append", default=[],
+                        help="传给服务端子进程的参数（可重复），如 --server-arg=--no-coalesce")
+    args = parser.parse_args()
+    try:
+        parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+
+    raise_fd_limit()
+    port = args.port or (8888 if args.no_spawn else free_port())
+    proc = None if args.no_spawn else start_server(args.mode, port, args.server_arg)
+    try:
+        ok = asyncio.run(run_bench(args, ("127.0.0.1", port), proc.pid if proc else None))
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+    if not ok:
+        print(f"❌ p99 超过阈值 {args.max_p99} ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+客户端启动加载测试：对比连接时读取本地数据的三种方式
+
+用法：python bench_startup.py [--users 10] [--peers 200] [--messages 2000] [--rounds 3]
+在临时目录生成 --users 个用户的数据（每人 --peers 个会话、每个会话 --messages 条记录），然后分别测：
+  旧版 JSON   解析所有用户共用的 friends.json 和 chat_records.json（本地出现过的每个用户）
+  全部日志    逐个读取当前用户的全部会话日志
+  索引+尾部   只读当前用户的索引，再打开一个会话的最近一页（现在的做法）
+另测向上翻到顶时按需读取一个会话完整历史的用时。测完删除临时目录。
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from chat_store import ChatStore
+
+PAGE_SIZE = 50  # 与 client.PAGE_SIZE 一致（client.py 导入时会创建界面，这里不导入）
+
+
+def generate(root, args):
+    """生成测试数据：旧版两个共用 JSON 文件 + 每个用户的日志目录和索引"""
+    friends = {}
+    legacy_records = {}
+    for u in range(args.users):
+        user = f"user{u}"
+        peers = [f"peer{p}" for p in range(args.peers)]
+        records = {peer: [f"[{peer}] 第 {i} 条消息 {'x' * args.text_bytes}" for i in range(args.messages)]
+                   for peer in peers}
+        friends[user] = peers
+        legacy_records[user] = records
+        store = ChatStore(user, root=os.path.join(root, "chat_logs"), fsync=False)
+        store.import_records(records)
+        store.save_friends(peers)
+        store.close()
+    with open(os.path.join(root, "friends.json"), "w", encoding="utf-8") as f:
+        json.dump(friends, f)
+    with open(os.path.join(root, "chat_records.json"), "w", encoding="utf-8") as f:
+        json.dump(legacy_records, f, ensure_ascii=False)
+
+
+def load_legacy(root, user):
+    with open(os.path.join(root, "friends.json"), "r", encoding="utf-8") as f:
+        friends = json.load(f).get(user, [])
+    with open(os.path.join(root, "chat_records.json"), "r", encoding="utf-8") as f:
+        records = json.load(f).get(user, {})
+    return len(friends), sum(len(r) for r in records.values())
+
+
+def load_logs(root, user):
+    store = ChatStore(user, root=os.path.join(root, "chat_logs"), fsync=False)
+    records = store.load_all()
+    store.close()
+    return len(store.friends), sum(len(r) for r in records.values())
+
+
+def load_index(root, user):
+    store = ChatStore(user, root=os.path.join(root, "chat_logs"), fsync=False)
+    records, _ = store.load_tail(store.friends[0], PAGE_SIZE)
+    store.close()
+    return len(store.friends), len(records)
+
+
+def load_history(root, user):
+    store = ChatStore(user, root=os.path.join(root, "chat_logs"), fsync=False)
+    records = store.load(store.friends[0])
+    store.close()
+    return len(store.friends), len(records)
+
+
+def tree_size(path):
+    return sum(os.path.getsize(os.path.join(d, name)) for d, _, names in os.walk(path) for name in names)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="客户端启动加载测试")
+    parser.add_argument("--users", type=int, default=10, help="本机出现过的用户数")
+    parser.add_argument("--peers", type=int, default=200, help="每个用户的会话数")
+    parser.add_argument("--messages", type=int, default=2000, help="每个会话的记录数")
+    parser.add_argument("--text-bytes", type=int, default=40, help="每条记录的附加字节数")
+    parser.add_argument("--rounds", type=int, default=3, help="每种方式重复次数（取最快一次）")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="lanchat-startup-")
+    try:
+        start = time.perf_counter()
+        generate(root, args)
+        print(f"生成 {args.users} 个用户 × {args.peers} 个会话 × {args.messages} 条记录，"
+              f"用时 {time.perf_counter() - start:.1f} 秒")
+        print(f"chat_records.json：{os.path.getsize(os.path.join(root, 'chat_records.json')) / 1024 / 1024:.1f} MB，"
+              f"每个用户的日志目录：{tree_size(os.path.join(root, 'chat_logs')) / args.users / 1024 / 1024:.1f} MB")
+        print(f"\n{'方式':<12}{'用时(ms)':>12}{'好友数':>10}{'读入记录数':>12}")
+        for name, load in (("旧版 JSON", load_legacy), ("全部日志", load_logs), ("索引+尾部", load_index),
+                           ("按需完整历史", load_history)):
+            best = None
+            for _ in range(args.rounds):
+                start = time.perf_counter()
+                friends, records = load(root, "user0")
+                elapsed = (time.perf_counter() - start) * 1000
+                best = elapsed if best is None else min(best, elapsed)
+            print(f"{name:<12}{best:>12.1f}{friends:>10}{records:>12}")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+按内容寻址的图片存储（客户端使用）
+
+图片以内容的 SHA-256 命名，存放在 <根目录>/<哈希前两位>/<哈希><扩展名>，同一张图片无论收到多少次、
+原文件名是什么都只保存一份，也不会因为重名互相覆盖。发送方在 FILE_OFFER 中带上哈希，
+接收方已有这张图片时直接确认收齐，数据不再经过网络。
+"""
+import hashlib
+import os
+import zlib
+
+HASH_BLOCK = 1024 * 1024
+
+
+def file_digests(path):
+    """一次读取同时计算 (CRC32, SHA-256 十六进制)"""
+    crc = 0
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(HASH_BLOCK)
+            if not block:
+                break
+            crc = zlib.crc32(block, crc)
+            sha.update(block)
+    return crc, sha.hexdigest()
+
+
+def is_digest(text):
+    return len(text) == 64 and all(c in "0123456789abcdef" for c in text)
+
+
+class BlobStore:
+    """内容寻址目录"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, digest, ext=""):
+        return os.path.join(self.root, digest[:2], digest + ext.lower())
+
+    def find(self, digest, size=None):
+        """已保存的同哈希文件路径（size 不符视为没有），没有返回 None"""
+        if not is_digest(digest):
+            return None
+        try:
+            names = os.listdir(os.path.join(self.root, digest[:2]))
+        except OSError:
+            return None
+        for name in names:
+            if name.startswith(digest):
+                path = os.path.join(self.root, digest[:2], name)
+                if size is None or os.path.getsize(path) == size:
+                    return path
+        return None
+
+    def put(self, src, digest=None, ext=""):
+        """把 src 移入存储（已有同内容文件时删除 src），返回保存路径"""
+        if digest is None:
+            digest = file_digests(src)[1]
+        existing = self.find(digest, os.path.getsize(src))
+        if existing is not None:
+            os.remove(src)
+            return existing
+        dest = self.path(digest, ext)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.replace(src, dest)
+        return dest
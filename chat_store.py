@@ -0,0 +1,251 @@
+"""
+聊天记录存储（客户端使用）
+
+每个用户一个目录，每个会话一个只追加的日志文件（每行一条 JSON 记录）。
+写入只是放进队列，由唯一的后台写线程攒批后一次写入并刷盘（group commit），
+单条消息的开销与历史记录长短无关，也不会出现多个线程同时改写同一文件。
+
+目录下另有一个小的索引文件 index.json（好友列表、各会话从服务端存档同步到的时间），连接时只读它，不再解析所有用户共用的
+friends.json 和全部聊天记录。打开会话时只从日志末尾倒着读最近一页，完整历史等向上翻页时再读。
+
+全文搜索用的倒排索引（search_index.py）也由写线程随每批写入增量更新。
+从服务端存档导入的记录（merge）按时间合并：都比日志里的新时照常追加，否则由写线程按时间重写该会话的日志，
+翻页读到的顺序始终与时间一致。
+"""
+import json
+import os
+import queue
+import threading
+import time
+from urllib.parse import quote, unquote
+
+from search_index import SearchIndex
+
+STORE_DIR = "chat_logs"
+LOG_SUFFIX = ".log"
+BATCH_MAX = 256  # 每批最多条数
+BATCH_WAIT = 0.05  # 攒批等待时间（秒）
+INDEX_FILE = "index.json"
+TAIL_BLOCK = 64 * 1024  # 倒着读日志时每次读的字节数
+MERGE = "merge"  # 队列中表示“按时间合并导入的记录”的标记
+
+
+class ChatStore:
+    """单个用户的聊天记录存储"""
+
+    def __init__(self, username, root=STORE_DIR, fsync=True):
+        self.dir = os.path.join(root, quote(username, safe=""))
+        os.makedirs(self.dir, exist_ok=True)
+        self.fsync = fsync
+        self.queue = queue.Queue()
+        self.files = {}  # {会话对象: 已打开的日志文件}，只在写线程中使用
+        self.index_path = os.path.join(self.dir, INDEX_FILE)
+        self.friends = None  # 好友列表（None 表示索引中还没有，需要从旧版 friends.json 迁移）
+        self.synced = {}  # {会话对象: 已从服务端存档同步到的时间（服务端时间）}
+        self._load_index()
+        self.search_index = SearchIndex(self.dir)  # 第一次搜索时才加载
+        self.writer = threading.Thread(target=self._writer_loop, daemon=True)
+        self.writer.start()
+
+    def path_for(self, peer):
+        """会话日志路径（用户名转义后作文件名）"""
+        return os.path.join(self.dir, quote(peer, safe="") + LOG_SUFFIX)
+
+    def peers(self):
+        """已有记录的会话对象"""
+        return [unquote(name[:-len(LOG_SUFFIX)]) for name in os.listdir(self.dir) if name.endswith(LOG_SUFFIX)]
+
+    def is_empty(self):
+        return not self.peers()
+
+    def append(self, peer, record, timestamp=None):
+        """追加一条记录（立即返回，由写线程落盘）"""
+        self.queue.put((peer, timestamp or time.time(), record))
+
+    def merge(self, peer, entries):
+        """把 [(时间, 记录)] 按时间合并进会话日志（立即返回，由写线程落盘）"""
+        self.queue.put((peer, MERGE, entries))
+
+    # ---------------------- 索引 ----------------------
+    def _load_index(self):
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+            self.friends = index.get("friends")
+            self.synced = index.get("synced", {})
+        except (OSError, ValueError, AttributeError):
+            pass  # 没有索引或已损坏：重新迁移好友列表，从头同步
+
+    def save_index(self):
+        """原子地保存索引（先写临时文件再替换，不需要先读出来校验）"""
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"friends": self.friends, "synced": self.synced}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.index_path)
+
+    def save_friends(self, friends):
+        self.friends = sorted(set(friends))
+        self.save_index()
+
+    def mark_synced(self, peer, timestamp):
+        self.synced[peer] = max(timestamp, self.synced.get(peer, 0))
+        self.save_index()
+
+    # ---------------------- 读取 ----------------------
+    def load_tail(self, peer, limit):
+        """从日志末尾倒着读最近 limit 条，返回 (记录, 是否还有更早的记录)"""
+        lines = []
+        try:
+            with open(self.path_for(peer), "rb") as f:
+                pos = f.seek(0, os.SEEK_END)
+                rest = b""
+                while pos > 0 and len(lines) <= limit:  # 末尾换行后的空串也算一项，多读一行正好够
+                    step = min(TAIL_BLOCK, pos)
+                    pos -= step
+                    f.seek(pos)
+                    lines[:0] = (f.read(step) + rest).split(b"\n")
+                    rest = lines.pop(0)  # 可能是不完整的一行，和前一块拼起来
+                if pos == 0:
+                    lines.insert(0, rest)
+        except FileNotFoundError:
+            return [], False
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line)["m"])
+            except (ValueError, KeyError):
+                continue  # 空行或异常退出时留下的半行
+        return records[-limit:], pos > 0 or len(records) > limit
+
+    def search(self, keyword="", sender="", peer="", since=None, until=None):
+        """在全部会话中搜索，返回 [(会话对象, 时间, 记录)]，最新的在前"""
+        return self.search_index.search({p: self.path_for(p) for p in self.peers()},
+                                        keyword, sender, peer, since, until)
+
+    def load(self, peer, since=0):
+        """读取一个会话的全部记录（或时间不早于 since 的记录）"""
+        records = []
+        try:
+            with open(self.path_for(peer), "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        if entry["t"] >= since:
+                            records.append(entry["m"])
+                    except (ValueError, KeyError):
+                        continue  # 异常退出时可能留下半行，跳过
+        except FileNotFoundError:
+            pass
+        return records
+
+    def load_all(self):
+        """读取全部会话 {会话对象: [记录]}"""
+        return {peer: self.load(peer) for peer in self.peers()}
+
+    def import_records(self, chat_records):
+        """导入旧版 chat_records.json 中的记录（同步写入）"""
+        now = time.time()
+        for peer, records in chat_records.items():
+            with open(self.path_for(peer), "a", encoding="utf-8") as f:
+                for record in records:
+                    f.write(json.dumps({"t": now, "m": record}, ensure_ascii=False) + "\n")
+
+    def flush(self):
+        """等待已提交的记录全部落盘"""
+        self.queue.join()
+
+    def close(self):
+        """写完剩余记录后停止写线程，保存搜索索引"""
+        self.queue.put(None)
+        self.writer.join()
+        try:
+            self.search_index.save()
+        except OSError as e:
+            print(f"⚠️ 搜索索引保存失败：{str(e)}")
+
+    def _writer_loop(self):
+        """写线程：取到一条后继续等待 BATCH_WAIT 秒攒批，然后一次提交"""
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + BATCH_WAIT
+            while batch[-1] is not None and len(batch) < BATCH_MAX:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self._commit([item for item in batch if item is not None])
+            except OSError as e:
+                print(f"⚠️ 聊天记录写入失败：{str(e)}")
+            for _ in batch:
+                self.queue.task_done()
+            if batch[-1] is None:
+                for f in self.files.values():
+                    f.close()
+                self.files.clear()
+                return
+
+    def _commit(self, batch):
+        """依次提交：合并操作之前的追加先写完，再做合并"""
+        appends = []
+        for peer, timestamp, record in batch:
+            if timestamp is MERGE:
+                self._append(appends)
+                appends = []
+                self._merge(peer, record)
+            else:
+                appends.append((peer, timestamp, record))
+        self._append(appends)
+
+    def _merge(self, peer, entries):
+        """导入的记录都不早于日志中最新的一条时直接追加，否则读出日志按时间稳定排序后整个重写"""
+        if not entries:
+            return
+        path = self.path_for(peer)
+        keyed = []
+        try:
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        keyed.append((float(json.loads(line)["t"]), line.rstrip(b"\n") + b"\n"))
+                    except (ValueError, KeyError, TypeError):
+                        continue  # 异常退出时留下的半行
+        except FileNotFoundError:
+            pass
+        if not keyed or min(t for t, _ in entries) >= max(t for t, _ in keyed):
+            self._append([(peer, timestamp, record) for timestamp, record in entries])
+            return
+        keyed += [(timestamp, (json.dumps({"t": timestamp, "m": record}, ensure_ascii=False) + "\n").encode("utf-8"))
+                  for timestamp, record in entries]
+        keyed.sort(key=lambda item: item[0])  # 稳定排序：同一时间的本地记录在前
+        f = self.files.pop(peer, None)
+        if f is not None:
+            f.close()
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(b"".join(line for _, line in keyed))
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self.search_index.reindex(peer, path)
+
+    def _append(self, batch):
+        """按会话分组写入，每个文件一次 write + 一次刷盘，再把新记录加进搜索索引"""
+        lines = {}
+        for peer, timestamp, record in batch:
+            line = json.dumps({"t": timestamp, "m": record}, ensure_ascii=False) + "\n"
+            lines.setdefault(peer, []).append(line.encode("utf-8"))
+        for peer, peer_lines in lines.items():
+            f = self.files.get(peer)
+            if f is None:
+                f = self.files[peer] = open(self.path_for(peer), "ab")
+            start = f.tell()
+            f.write(b"".join(peer_lines))
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+            self.search_index.add_lines(peer, self.path_for(peer), start, peer_lines)
@@ -1,33 +1,101 @@
+import itertools
+import queue
+from collections import Counter
 import socket
 import threading
 import tkinter as tk
-from tkinter import messagebox, filedialog
-from PIL import Image, ImageTk
+from tkinter import messagebox, filedialog, simpledialog
 import json
 import os
 import sys
-import struct
 import time  # 新增：解决文件备份重名
 
+from blob_store import BlobStore
+from chat_store import ChatStore
+from file_transfer import IMAGE_EXTS, TransferManager
+from thumb_cache import ThumbnailCache
+from search_index import SEARCH_LIMIT
+from protocol import (
+    ACK, FILE_ACK, FILE_CANCEL, FILE_CHUNK, FILE_OFFER, FLAG_LAST, FRIEND_REPLY, FRIEND_REQ, GROUP, GROUP_MSG,
+    HEARTBEAT_IDLE, HEARTBEAT_TIMEOUT, HELLO, HISTORY, IMAGE, IMAGE_DATA, MAGIC, NOTICE, OFFLINE, PING, PONG, PRESENCE,
+    SESSION, TEXT, USER_LIST, FrameParser, encode_frame, encode_header, pack_fields, unpack_fields,
+)
+
 # 基础配置
 SERVER_PORT = 8888
 client_socket = None
+frame_parser = None  # 当前连接的帧解析器
+send_lock = threading.Lock()  # 保证一帧完整写入
+RECV_BUFFER_SIZE = 256 * 1024
+recv_buffer = bytearray(RECV_BUFFER_SIZE)  # 复用的接收缓冲（recv_into）
 current_username = ""
+server_address = None  # 当前连接的服务端 (IP, 端口)，断线重连时使用
 is_running = True
 exit_flag = False  # 新增：退出标记，避免多线程冲突
 
 # 数据存储
-chat_records = {}  # {好友/临时用户: [消息列表]}
+chat_records = {}  # {好友/临时用户: [消息列表]}，打开会话时才加载
+partial_history = set()  # 只加载了最近一页记录的会话，向上翻到顶时再读完整历史
+chat_store = None  # 当前用户的聊天记录存储（追加写日志）
 current_chat_target = ""
+PAGE_SIZE = 50  # 切换会话时只渲染最近的消息条数，向上滚动时每次再加载这么多
+rendered_start = 0  # 当前会话中已渲染的最早一条记录的下标
+loading_older = False
+image_tag_seq = itertools.count()  # 图片点击标签编号
 friends_list = []  # 正式好友
 temp_users = []  # 临时会话用户
-FRIENDS_FILE = "friends.json"
-CHAT_RECORDS_FILE = "chat_records.json"
-image_cache = {}  # 缓存图片对象（防止垃圾回收）
+group_list = []  # 所在的群组（服务端下发），在通讯录和聊天对象中显示为“#群名”
+GROUP_PREFIX = "#"
+
+# 在线状态：订阅好友和临时会话用户，服务端先发快照再推送上线/下线增量（按版本号合并，见 presence.py）
+online_peers = frozenset()  # 主线程使用的在线名单
+subscribed_peers = None  # 已订阅的名单
+presence_online = set()  # 以下由接收线程维护
+presence_pending = []  # 正在接收的快照
+presence_snapshot_version = 0
+presence_versions = {}  # {用户名: (版本号, 是否在线)}，快照之后的增量
+ONLINE_MARK = " ●"
+USER_PAGE_SIZE = 200  # “查在线”每次显示的人数
+FRIENDS_FILE = "friends.json"  # 旧版好友列表（所有用户共用），仅用于首次迁移
+CHAT_RECORDS_FILE = "chat_records.json"  # 旧版聊天记录，仅用于首次迁移
+thumbnails = ThumbnailCache()  # 缩略图缓存（内存 LRU + 磁盘），解码在后台线程池完成
+view_images = []  # 当前聊天框中显示的图片（防止被垃圾回收）
+placeholder_image = None  # 缩略图生成前的占位图
+BACKGROUND_POLL_MS = 30
+
+# 界面事件：接收线程只把事件放入队列，由主线程定时批量处理
+ui_events = queue.Queue()
+UI_BATCH_LIMIT = 2000  # 每次最多处理的事件数
+dialog_queue = []  # 待弹出的对话框（逐个弹出，避免嵌套）
+dialog_showing = False
+
+# 会话恢复：服务端下发的每帧（SESSION 除外）隐式编号，断线后带令牌和已处理帧数重连，只补发缺失部分
+session_token = ""
+handled_frames = 0  # 本会话已处理的帧数
+acked_frames = 0  # 已向服务端确认的帧数
+last_ack_time = 0.0
+ack_lock = threading.Lock()  # 接收线程和 Tk 主线程都会确认：确认数的读取、发送和更新须一起完成，不重复也不倒退
+ACK_EVERY = 64  # 每处理这么多帧确认一次
+ACK_INTERVAL = 2.0  # 有未确认的帧时最长多久确认一次（秒）
+RESUME_WINDOW = 120  # 断线后尝试恢复会话的时间（与服务端一致）
+
+# 从服务端存档同步聊天记录（见 archive.py）：逐个会话分页拉取，和本地已有的记录去重后追加
+history_sync = None  # 正在进行的同步：{"queue": [待同步的会话], "peer", "since", "local": Counter, "entries", "last", "imported"}
+SYNC_SKEW = 300  # 本地记录用本机时间，服务端用服务端时间：去重时往前多比较这么长一段（秒）
+
+# 心跳：接收线程一直阻塞在 recv 上，由主线程每秒检查一次最近收到数据的时刻
+last_recv = 0.0  # 最近一次收到服务端数据的时刻
+last_ping = 0.0
+last_heartbeat_check = 0.0
 
 # 图片弹窗窗口
 image_popup = None
 image_label = None
+search_window = None  # 搜索窗口：{"window", "entries", "status", "results", "peers"}
+incoming_image = None  # 旧版协议正在接收的图片：{"sender", "path", "file", "size", "recv_size"}
+file_transfers = None  # 文件/图片的分块传输（TransferManager），连接时创建
+RECV_FILES_DIR = "recv_files"
+image_store = BlobStore("recv_images")  # 收到的图片按内容哈希保存，同一张图只存一份
 
 
 def get_local_ip():
@@ -42,280 +110,552 @@ def get_local_ip():
         return "127.0.0.1"
 
 
-def init_file(file_path, default_content):
-    """初始化文件（修复备份重名）"""
-    if not os.path.exists(file_path):
-        with open(file_path, "w", encoding="utf-8") as f:
-            json.dump(default_content, f)
-    try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            json.load(f)
-    except:
-        # 给备份文件加时间戳，避免重名
-        timestamp = int(time.time())
-        backup_path = f"{file_path}.bak.{timestamp}"
-        if os.path.exists(file_path):
-            os.rename(file_path, backup_path)
-        with open(file_path, "w", encoding="utf-8") as f:
-            json.dump(default_content, f)
+def send_frame(mtype, payload=b"", flags=0):
+    """向服务端发送一帧"""
+    data = encode_frame(mtype, payload, flags)
+    with send_lock:
+        client_socket.sendall(data)
+
+
+def send_file_frame(mtype, head, f, offset, count):
+    """向服务端发送负载为 head + 文件中 [offset, offset + count) 的一帧：只发帧头和 head，数据由内核直接从文件发出"""
+    with send_lock:
+        client_socket.sendall(encode_header(mtype, len(head) + count) + head)
+        if client_socket.sendfile(f, offset, count) != count:
+            client_socket.shutdown(socket.SHUT_RDWR)  # 文件在发送中被截短，帧已不完整：断开重连
+            raise OSError("文件在发送过程中被修改")
 
 
 # ---------------------- 好友/临时用户管理 ----------------------
 def save_friends():
-    """保存正式好友列表"""
-    if exit_flag:  # 退出时跳过（避免文件操作冲突）
+    """保存正式好友列表（写入当前用户的索引文件）"""
+    if not chat_store:
         return
-    init_file(FRIENDS_FILE, {})
-    with open(FRIENDS_FILE, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    data[current_username] = list(set(friends_list))
-    with open(FRIENDS_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f)
+    try:
+        chat_store.save_friends(friends_list)
+    except OSError as e:
+        print(f"⚠️ 好友列表保存失败：{str(e)}")
 
 
 def load_friends():
-    """加载正式好友列表"""
+    """加载正式好友列表（只读当前用户的索引，首次使用时从旧版 friends.json 迁移）"""
     global friends_list
-    friends_list = []
-    init_file(FRIENDS_FILE, {})
-    try:
-        with open(FRIENDS_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        friends_list = list(set(data.get(current_username, [])))
-        load_chat_records()
-        for user in friends_list + temp_users:
-            if user not in chat_records:
-                chat_records[user] = []
-        update_friend_list()
-    except:
-        friends_list = []
+    load_chat_records()
+    if chat_store.friends is not None:
+        friends_list = list(chat_store.friends)
+    else:
+        try:
+            with open(FRIENDS_FILE, "r", encoding="utf-8") as f:
+                friends_list = list(set(json.load(f).get(current_username, [])))
+        except:
+            friends_list = []
+        save_friends()
+    update_friend_list()
 
 
 def update_friend_list():
     """更新通讯录UI"""
     friend_listbox.delete(0, tk.END)
     for friend in sorted(friends_list):
-        friend_listbox.insert(tk.END, friend)
+        friend_listbox.insert(tk.END, friend + (ONLINE_MARK if friend in online_peers else ""))
     for temp_user in sorted(temp_users):
         if temp_user not in friends_list:
-            friend_listbox.insert(tk.END, f"{temp_user} (临时)")
+            friend_listbox.insert(tk.END, f"{temp_user}{ONLINE_MARK if temp_user in online_peers else ''} (临时)")
+    for group in sorted(group_list):
+        friend_listbox.insert(tk.END, GROUP_PREFIX + group)
+    subscribe_presence()
 
 
-# ---------------------- 聊天记录管理 ----------------------
-def save_chat_records():
-    """保存聊天记录"""
-    if exit_flag:  # 退出时跳过
+def subscribe_presence(force=False):
+    """订阅好友和临时会话用户的在线状态（名单变化或重新连接后重新订阅）"""
+    global subscribed_peers
+    peers = tuple(sorted(set(friends_list + temp_users)))
+    if not client_socket or (peers == subscribed_peers and not force):
         return
-    init_file(CHAT_RECORDS_FILE, {})
-    with open(CHAT_RECORDS_FILE, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    data[current_username] = chat_records
-    with open(CHAT_RECORDS_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f)
+    subscribed_peers = peers
+    try:
+        send_frame(PRESENCE, pack_fields("subscribe", "users", ",".join(peers)))
+    except OSError:
+        pass  # 断线中，重连后会重新订阅
 
 
-def load_chat_records():
-    """加载聊天记录"""
-    global chat_records
-    chat_records = {}
-    init_file(CHAT_RECORDS_FILE, {})
-    try:
-        with open(CHAT_RECORDS_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        chat_records = data.get(current_username, {})
-    except:
-        chat_records = {}
+# ---------------------- 聊天记录管理 ----------------------
+def records_for(peer):
+    """会话已加载的记录（第一次用到时只从日志末尾读最近 PAGE_SIZE 条）"""
+    records = chat_records.get(peer)
+    if records is None:
+        records, more = chat_store.load_tail(peer, PAGE_SIZE) if chat_store else ([], False)
+        chat_records[peer] = records
+        if more:
+            partial_history.add(peer)
+    return records
 
 
-# ---------------------- 图片处理 ----------------------
-def resize_image(image_path, max_width=150, max_height=150):
-    """调整图片大小+缓存"""
-    if image_path in image_cache:
-        return image_cache[image_path]["img"], image_cache[image_path]["tk_img"]
+def store_chat_record(peer, record, timestamp=None):
+    """保存一条聊天记录（内存 + 追加写日志，不重写整个文件）"""
+    records_for(peer).append(record)
+    if chat_store:
+        chat_store.append(peer, record, timestamp)
 
-    img = Image.open(image_path)
-    width, height = img.size
-    scale = min(max_width / width, max_height / height, 1)
-    new_size = (int(width * scale), int(height * scale))
-    resized_img = img.resize(new_size, Image.Resampling.LANCZOS)
-    tk_img = ImageTk.PhotoImage(resized_img)
-    image_cache[image_path] = {"img": resized_img, "tk_img": tk_img}
-    return resized_img, tk_img
+
+def load_chat_records():
+    """打开当前用户的聊天记录（首次使用时从旧版 chat_records.json 迁移），各会话的记录用到时再读"""
+    global chat_store
+    if chat_store:
+        chat_store.close()
+    chat_store = ChatStore(current_username)
+    if chat_store.is_empty() and os.path.exists(CHAT_RECORDS_FILE):
+        try:
+            with open(CHAT_RECORDS_FILE, "r", encoding="utf-8") as f:
+                legacy_records = json.load(f).get(current_username, {})
+            chat_store.import_records(legacy_records)
+        except:
+            pass
+    chat_records.clear()
+    partial_history.clear()
 
 
+# ---------------------- 图片处理 ----------------------
 def show_image_popup(image_path):
-    """弹窗显示完整图片"""
+    """弹窗显示完整图片（先显示“加载中”，后台解码完成后再填入图片）"""
     global image_popup, image_label
     if image_popup:
         image_popup.destroy()
+    if not os.path.exists(image_path):
+        messagebox.showerror("错误", "图片文件不存在")
+        return
 
     image_popup = tk.Toplevel(root)
     image_popup.title("查看图片")
     image_popup.geometry("800x600")
     image_popup.protocol("WM_DELETE_WINDOW", lambda: image_popup.destroy())  # 修复弹窗关闭
 
-    try:
-        img = Image.open(image_path)
-        max_width = 750
-        max_height = 550
-        width, height = img.size
-        scale = min(max_width / width, max_height / height, 1)
-        new_size = (int(width * scale), int(height * scale))
-        resized_img = img.resize(new_size, Image.Resampling.LANCZOS)
-        img_tk = ImageTk.PhotoImage(resized_img)
-
-        image_label = tk.Label(image_popup, image=img_tk)
-        image_label.image = img_tk
-        image_label.pack(padx=10, pady=10)
-
-        tk.Button(image_popup, text="关闭", command=image_popup.destroy).pack(pady=5)
-    except Exception as e:
-        messagebox.showerror("错误", f"图片加载失败：{str(e)}")
-        image_popup.destroy()
+    image_label = tk.Label(image_popup, text="图片加载中…")
+    image_label.pack(padx=10, pady=10)
+    tk.Button(image_popup, text="关闭", command=image_popup.destroy).pack(pady=5)
+
+    def on_loaded(img, img_tk, popup=image_popup, label=image_label):
+        if popup.winfo_exists():
+            label.config(image=img_tk, text="")
+            label.image = img_tk
+
+    cached = thumbnails.peek(image_path, 750, 550)
+    if cached:
+        on_loaded(*cached)
+    else:
+        thumbnails.request(image_path, 750, 550, on_loaded)
 
 
 def send_image():
     """发送图片"""
+    send_file("选择图片", [("Image Files", "*.jpg *.jpeg *.png *.gif *.bmp")])
+
+
+def send_any_file():
+    """发送任意文件"""
+    send_file("选择文件", [("All Files", "*.*")])
+
+
+def send_file(title, filetypes):
+    """选择文件后交给后台分块发送（断线重连后从断点继续）"""
     target = target_entry.get().strip()
     if not target:
         messagebox.showwarning("提示", "请选择目标用户")
         return
 
-    file_path = filedialog.askopenfilename(
-        title="选择图片",
-        filetypes=[("Image Files", "*.jpg *.jpeg *.png *.gif *.bmp")]
-    )
+    file_path = filedialog.askopenfilename(title=title, filetypes=filetypes)
     if not file_path:
         return
+    file_transfers.send_file(file_path, target)
+    append_lines_to_view([f"正在向 {target} 发送 {os.path.basename(file_path)} ..."])
 
-    try:
-        img_filename = os.path.basename(file_path)
-        msg_header = f"image|{target}|{img_filename}"
-        client_socket.send(msg_header.encode("utf-8"))
-
-        img_size = os.path.getsize(file_path)
-        client_socket.send(struct.pack("!I", img_size))
-
-        client_socket.settimeout(30.0)
-        with open(file_path, "rb") as f:
-            sent_size = 0
-            while sent_size < img_size and not exit_flag:
-                send_data = f.read(1024)
-                if not send_data:
-                    break
-                client_socket.send(send_data)
-                sent_size += len(send_data)
-
-        resized_img, img_tk = resize_image(file_path)
-        chat_text.config(state=tk.NORMAL)
-        chat_text.insert(tk.END, "[我] 发送图片：\n")
-        img_index = chat_text.image_create(tk.END, image=img_tk)
-        chat_text.insert(tk.END, "\n")
-        chat_text.config(state=tk.DISABLED)
-
-        chat_records[target].append(f"[图片]我:{file_path}")
-        threading.Thread(target=save_chat_records, daemon=True).start()
-        messagebox.showinfo("成功", "图片发送完成")
 
-    except socket.timeout:
-        messagebox.showerror("发送失败", "图片传输超时")
-    except Exception as e:
-        messagebox.showerror("发送失败", f"图片发送失败：{str(e)}")
-    finally:
-        if not exit_flag:
-            client_socket.settimeout(3.0)
+def on_transfer_done(direction, peer, path):
+    """传输线程：文件收发完成，记录交给主线程"""
+    tag = "[图片]" if path.lower().endswith(IMAGE_EXTS) else "[文件]"
+    who = "我" if direction == "out" else peer
+    post_ui("record", peer, f"{tag}{who}:{path}")
+    if direction == "out":
+        post_ui("notice", f"{os.path.basename(path)} 已发送给 {peer}")
+
+
+def start_recv_image(sender, img_filename, img_size):
+    """收到图片头：先写入临时文件，收齐后按内容哈希存入图片目录"""
+    global incoming_image
+    os.makedirs(image_store.root, exist_ok=True)
+    save_path = os.path.join(image_store.root, f".incoming{os.path.splitext(img_filename)[1].lower()}")
+    incoming_image = {"sender": sender, "path": save_path, "file": open(save_path, "wb"),
+                      "size": img_size, "recv_size": 0}
+    if not img_size:
+        finish_recv_image()
 
 
-def recv_image(img_filename, img_size, sender):
-    """接收图片"""
+def recv_image_data(frame):
+    """收到图片数据块：写入文件，收齐后显示"""
+    if incoming_image is None:
+        return
+    incoming_image["file"].write(frame.payload)
+    incoming_image["recv_size"] += len(frame.payload)
+    if frame.flags & FLAG_LAST or incoming_image["recv_size"] >= incoming_image["size"]:
+        finish_recv_image()
+
+
+def finish_recv_image():
+    """图片接收完成"""
+    global incoming_image
+    image = incoming_image
+    incoming_image = None
+    image["file"].close()
+    sender = image["sender"]
+    save_path = image["path"]
     try:
-        if not os.path.exists("recv_images"):
-            os.makedirs("recv_images")
-        save_path = os.path.join("recv_images", img_filename)
-
-        client_socket.settimeout(30.0)
-        with open(save_path, "wb") as f:
-            recv_size = 0
-            while recv_size < img_size and not exit_flag:
-                recv_data = client_socket.recv(1024)
-                if not recv_data:
-                    break
-                f.write(recv_data)
-                recv_size += len(recv_data)
-
-        if recv_size != img_size:
+        if image["recv_size"] != image["size"]:
             os.remove(save_path)
-            messagebox.showerror("接收失败", "图片接收不完整")
+            post_ui("error", "接收失败", "图片接收不完整")
             return
+        save_path = image_store.put(save_path, ext=os.path.splitext(save_path)[1])
+        # 接收线程不碰 Tk：记录和显示交给主线程，缩略图由后台线程池生成
+        post_ui("record", sender, f"[图片]{sender}:{save_path}")
+    except Exception as e:
+        post_ui("error", "接收失败", f"图片接收失败：{str(e)}")
 
-        resized_img, img_tk = resize_image(save_path)
-        chat_text.config(state=tk.NORMAL)
-        chat_text.insert(tk.END, f"[{sender}] 发送图片：\n")
-        img_index = chat_text.image_create(tk.END, image=img_tk)
-        chat_text.insert(tk.END, "\n")
-        chat_text.config(state=tk.DISABLED)
-
-        chat_records[sender].append(f"[图片]{sender}:{save_path}")
-        threading.Thread(target=save_chat_records, daemon=True).start()
-
-        # 修复图片点击绑定
-        tag_name = f"img_{sender}_{len(chat_records[sender]) - 1}"
-        img_line_start = chat_text.index(f"end-2l linestart")
-        img_line_end = chat_text.index(f"end-1l lineend")
-        chat_text.tag_add(tag_name, img_line_start, img_line_end)
-        chat_text.tag_bind(tag_name, "<Button-1>", lambda e, p=save_path: show_image_popup(p))
-
-        if sender not in friends_list and sender not in temp_users:
-            temp_users.append(sender)
-            update_friend_list()
 
-    except socket.timeout:
-        messagebox.showerror("接收失败", "图片接收超时")
-    except Exception as e:
-        messagebox.showerror("接收失败", f"图片接收失败：{str(e)}")
-    finally:
+# ---------------------- 聊天记录渲染 ----------------------
+def render_record(record, index=tk.END):
+    """把一条记录插入聊天框 index 处（调用方负责切换 state）"""
+    chat_text.mark_set("render_at", index)
+    chat_text.mark_gravity("render_at", tk.RIGHT)  # 插入后标记后移，多次插入保持顺序
+    if not record.startswith("[图片]"):
+        chat_text.insert("render_at", f"{record}\n")
+        return
+
+    parts = record.split(":", 1)
+    sender = parts[0][4:]
+    img_path = parts[1]
+    if not os.path.exists(img_path):
+        return
+    chat_text.insert("render_at", f"[{sender}] 发送图片：\n")
+    cached = thumbnails.peek(img_path)
+    img_tk = cached[1] if cached else placeholder_image
+    view_images.append(img_tk)
+    chat_text.image_create("render_at", image=img_tk)
+    img_pos = chat_text.index("render_at -1c")
+    chat_text.insert("render_at", "\n")
+
+    tag_name = f"img_{next(image_tag_seq)}"
+    chat_text.tag_add(tag_name, img_pos)
+    chat_text.tag_bind(tag_name, "<Button-1>", lambda e, p=img_path: show_image_popup(p))
+    if not cached:
+        thumbnails.request(img_path, 150, 150, lambda img, img_tk, t=tag_name: fill_image(t, img_tk))
+
+
+def fill_image(tag_name, img_tk):
+    """后台缩略图完成后替换占位图（该图片已不在聊天框中时忽略）"""
+    ranges = chat_text.tag_ranges(tag_name)
+    if not ranges:
+        return
+    view_images.append(img_tk)
+    chat_text.config(state=tk.NORMAL)
+    chat_text.image_configure(ranges[0], image=img_tk)
+    chat_text.config(state=tk.DISABLED)
+
+
+def poll_background():
+    """定时在主线程处理界面事件和后台任务的结果"""
+    if exit_flag:
+        return
+    try:
+        process_ui_events()
+        thumbnails.drain()
+        check_heartbeat()
+    finally:  # 出错也要重新定时，否则消息显示、缩略图和心跳全部停止
         if not exit_flag:
-            client_socket.settimeout(3.0)
+            root.after(BACKGROUND_POLL_MS, poll_background)
+
+
+def check_heartbeat():
+    """每秒一次：确认已处理的帧；太久没收到服务端数据时发 PING，仍没有数据则断开（接收线程随即重连）"""
+    global last_ping, last_heartbeat_check
+    now = time.monotonic()
+    if not client_socket or now - last_heartbeat_check < 1.0:
+        return
+    last_heartbeat_check = now
+    idle = now - last_recv
+    try:
+        maybe_ack()
+        if idle >= HEARTBEAT_IDLE + HEARTBEAT_TIMEOUT:
+            client_socket.shutdown(socket.SHUT_RDWR)
+        elif idle >= HEARTBEAT_IDLE and last_ping < last_recv:
+            send_frame(PING)
+            last_ping = now
+    except OSError:
+        pass
+
+
+def append_to_view(peer, record):
+    """新消息只追加到聊天框末尾，不重绘整个会话"""
+    if peer == current_chat_target:
+        append_lines_to_view([record])
+
+
+def append_lines_to_view(lines):
+    """把多行一次性追加到聊天框末尾（连续的文字合并成一次插入）"""
+    if not lines or exit_flag:
+        return
+    chat_text.config(state=tk.NORMAL)
+    text_run = []
+    for line in lines:
+        if line.startswith("[图片]"):
+            if text_run:
+                chat_text.insert(tk.END, "".join(text_run))
+                text_run = []
+            render_record(line)
+        else:
+            text_run.append(f"{line}\n")
+    if text_run:
+        chat_text.insert(tk.END, "".join(text_run))
+    chat_text.config(state=tk.DISABLED)
+    chat_text.see(tk.END)
+
+
+def load_older_page():
+    """向上滚动到顶时，在聊天框顶部补上更早的一页记录"""
+    global rendered_start, loading_older
+    loading_older = False
+    if exit_flag:
+        return
+    records = records_for(current_chat_target)
+    if rendered_start <= 0 and current_chat_target in partial_history:
+        chat_store.flush()  # 已提交的记录全部落盘后再读完整历史
+        full = chat_records[current_chat_target] = chat_store.load(current_chat_target)
+        partial_history.discard(current_chat_target)
+        rendered_start += len(full) - len(records)
+        records = full
+    if rendered_start <= 0:
+        return
+    start = max(0, rendered_start - PAGE_SIZE)
+
+    chat_text.config(state=tk.NORMAL)
+    chat_text.mark_set("view_top", "@0,0")  # 记住当前可见的第一行，插入后滚回这里
+    chat_text.mark_set("page_top", "1.0")
+    chat_text.mark_gravity("page_top", tk.RIGHT)
+    for record in records[start:rendered_start]:
+        render_record(record, "page_top")
+    chat_text.config(state=tk.DISABLED)
+    chat_text.yview("view_top")
+    rendered_start = start
+
+
+def on_chat_scroll(first, last):
+    """聊天框滚动回调：滚到顶部且还有未渲染的历史时加载上一页"""
+    global loading_older
+    has_older = rendered_start > 0 or current_chat_target in partial_history
+    if float(first) <= 0.0 and has_older and not loading_older:
+        loading_older = True
+        root.after_idle(load_older_page)
+
+
+# ---------------------- 聊天记录搜索 ----------------------
+def open_search_window():
+    """搜索窗口：关键词（空格分隔，须全部包含）、发送者、会话、日期范围，双击结果切换到该会话"""
+    global search_window
+    if search_window and search_window["window"].winfo_exists():
+        search_window["window"].lift()
+        return
+    window = tk.Toplevel(root)
+    window.title("搜索聊天记录")
+    window.geometry("600x420")
+    entries = {}
+    for row, (key, label) in enumerate([("keyword", "关键词："), ("sender", "发送者："), ("peer", "会话："),
+                                        ("since", "起始日期："), ("until", "结束日期：")]):
+        tk.Label(window, text=label).grid(row=row, column=0, sticky="e", padx=5)
+        entries[key] = tk.Entry(window, width=30)
+        entries[key].grid(row=row, column=1, sticky="w")
+    tk.Label(window, text="日期如 2024-01-31；发送者填“我”查自己发的；群组会话填 #群名").grid(row=5, column=1, sticky="w")
+    tk.Button(window, text="搜索", command=start_search).grid(row=0, column=2, padx=5)
+    status = tk.Label(window, text="")
+    status.grid(row=6, column=0, columnspan=3, sticky="w", padx=5)
+    results = tk.Listbox(window, width=80, height=14)
+    results.grid(row=7, column=0, columnspan=3, padx=5, pady=5)
+    results.bind("<Double-Button-1>", lambda e: open_search_result())
+    entries["keyword"].bind("<Return>", lambda e: start_search())
+    entries["keyword"].focus_set()
+    search_window = {"window": window, "entries": entries, "status": status, "results": results, "peers": []}
+
+
+def parse_date(text, end_of_day=False):
+    """YYYY-MM-DD → 当天 0 点（或次日 0 点）的时间戳，空白返回 None"""
+    if not text:
+        return None
+    start = time.mktime(time.strptime(text, "%Y-%m-%d"))
+    return start + 86400 if end_of_day else start
+
+
+def start_search():
+    """读取搜索条件，在后台线程中查询（第一次搜索要加载或建立索引）"""
+    fields = {key: entry.get().strip() for key, entry in search_window["entries"].items()}
+    try:
+        since = parse_date(fields["since"])
+        until = parse_date(fields["until"], end_of_day=True)
+    except ValueError:
+        messagebox.showerror("日期格式错误", "请按 2024-01-31 的格式填写日期", parent=search_window["window"])
+        return
+    sender = "我" if fields["sender"] == current_username else fields["sender"]
+    search_window["status"].config(text="搜索中…")
+    threading.Thread(target=run_search, daemon=True,
+                     args=(chat_store, fields["keyword"], sender, fields["peer"], since, until)).start()
+
+
+def run_search(store, keyword, sender, peer, since, until):
+    """后台线程：查询索引，结果交给主线程显示"""
+    start = time.perf_counter()
+    try:
+        results = store.search(keyword, sender, peer, since, until)
+    except Exception as e:
+        post_ui("error", "搜索失败", str(e))
+        return
+    post_ui("search_results", tuple(results), time.perf_counter() - start)
+
+
+def show_search_results(results, elapsed):
+    if not search_window or not search_window["window"].winfo_exists():
+        return
+    listbox = search_window["results"]
+    listbox.delete(0, tk.END)
+    search_window["peers"] = [peer for peer, _, _ in results]
+    for peer, timestamp, record in results:
+        listbox.insert(tk.END, f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(timestamp))}  {peer}  {record}")
+    search_window["status"].config(text=f"找到 {len(results)} 条（最多显示最近 {SEARCH_LIMIT} 条），"
+                                        f"用时 {elapsed * 1000:.0f} 毫秒")
+
+
+def open_search_result():
+    """双击搜索结果：切换到该会话"""
+    selection = search_window["results"].curselection()
+    if not selection:
+        return
+    peer = search_window["peers"][selection[0]]
+    if not peer.startswith(GROUP_PREFIX) and peer not in friends_list and peer not in temp_users:
+        temp_users.append(peer)
+        update_friend_list()
+    switch_chat_target(peer)
+
+
+# ---------------------- 同步服务端存档 ----------------------
+def start_history_sync():
+    """请求服务端存档中自己的会话列表，之后逐个会话分页拉取上次同步之后的记录"""
+    global history_sync
+    history_sync = {"queue": [], "peer": None, "imported": 0}  # 再次点击时重新开始
+    try:
+        send_frame(HISTORY, pack_fields("list", 0))
+    except OSError as e:
+        history_sync = None
+        messagebox.showerror("同步失败", f"请求发送失败：{str(e)}")
+        return
+    append_lines_to_view(["正在从服务端同步聊天记录..."])
+
+
+def handle_history(kind, first, second="", third=""):
+    """主线程：处理服务端回复的会话列表（list）和记录页（page）"""
+    if history_sync is None:
+        return
+    if kind == "list":
+        conversations = json.loads(first)
+        history_sync["queue"] = sorted(peer for peer, (_, last) in conversations.items()
+                                       if last > chat_store.synced.get(peer, 0))
+        fetch_next_conversation()
+    elif kind == "page" and first == history_sync["peer"]:
+        import_history(first, json.loads(third))
+        if second:
+            send_frame(HISTORY, pack_fields("fetch", first, history_sync["since"], "", second))
+        else:
+            finish_conversation(first)
+            fetch_next_conversation()
+
+
+def fetch_next_conversation():
+    """开始同步下一个会话；本地在同步点之前不久的记录先读出来用于去重"""
+    global history_sync
+    if not history_sync["queue"]:
+        append_lines_to_view([f"同步完成，共导入 {history_sync['imported']} 条聊天记录"])
+        history_sync = None
+        update_friend_list()
+        return
+    peer = history_sync["queue"].pop(0)
+    since = chat_store.synced.get(peer, 0)
+    chat_store.flush()
+    history_sync.update(peer=peer, since=since, local=Counter(chat_store.load(peer, since - SYNC_SKEW)),
+                        entries=[], last=0)
+    send_frame(HISTORY, pack_fields("fetch", peer, since, "", ""))
+
+
+def import_history(peer, records):
+    """把一页存档记录转成本地格式暂存，本地已有的（在线时收到或上次同步过的）跳过"""
+    local = history_sync["local"]
+    entries = history_sync["entries"]
+    imported = len(entries)
+    for timestamp, sender, content in records:
+        record = f"[我] {content}" if sender == current_username else f"[{sender}] {content}"
+        if local[record] > 0:
+            local[record] -= 1
+            continue
+        entries.append((timestamp, record))
+    if records:
+        history_sync["last"] = records[-1][0]
+    history_sync["imported"] += len(entries) - imported
+    if entries and not peer.startswith(GROUP_PREFIX) and peer not in friends_list and peer not in temp_users:
+        temp_users.append(peer)
+
+
+def finish_conversation(peer):
+    """一个会话拉取完：导入的记录按时间合并进本地日志（存档里的旧消息不会排到本地新消息后面），
+    再记下同步点，内存中的记录作废后从日志重新读
+    """
+    if history_sync["entries"]:
+        chat_store.merge(peer, history_sync["entries"])
+        chat_store.flush()
+        chat_records.pop(peer, None)
+        partial_history.discard(peer)
+        if peer == current_chat_target:
+            render_current_chat()
+    if history_sync["last"]:
+        chat_store.mark_synced(peer, history_sync["last"])
 
 
 # ---------------------- 聊天核心功能 ----------------------
 def switch_chat_target(target):
-    """切换聊天对象"""
+    """切换聊天对象（只渲染最近 PAGE_SIZE 条，更早的滚动时再加载）"""
     global current_chat_target
     if not target or exit_flag:
         return
 
+    target = target.replace(ONLINE_MARK, "")
     if " (临时)" in target:
         target = target.replace(" (临时)", "")
         if target not in temp_users and target not in friends_list:
             temp_users.append(target)
 
+    if target == current_chat_target:
+        return
     current_chat_target = target
     chat_title.config(text=f"当前聊天：{target}")
     target_entry.delete(0, tk.END)
     target_entry.insert(0, target)
+    render_current_chat()
+
 
+def render_current_chat():
+    """重新渲染当前会话最近的 PAGE_SIZE 条"""
+    global rendered_start
+    records = records_for(current_chat_target)
+    rendered_start = max(0, len(records) - PAGE_SIZE)
     chat_text.config(state=tk.NORMAL)
     chat_text.delete(1.0, tk.END)
-    for record in chat_records.get(target, []):
-        if record.startswith("[图片]"):
-            parts = record.split(":", 1)
-            sender = parts[0][4:]
-            img_path = parts[1]
-            if os.path.exists(img_path):
-                chat_text.insert(tk.END, f"[{sender}] 发送图片：\n")
-                resized_img, img_tk = resize_image(img_path)
-                img_index = chat_text.image_create(tk.END, image=img_tk)
-                chat_text.insert(tk.END, "\n")
-
-                tag_name = f"img_load_{len(chat_text.tag_names())}"
-                img_line_start = chat_text.index(f"end-2l linestart")
-                img_line_end = chat_text.index(f"end-1l lineend")
-                chat_text.tag_add(tag_name, img_line_start, img_line_end)
-                chat_text.tag_bind(tag_name, "<Button-1>", lambda e, p=img_path: show_image_popup(p))
-        else:
-            chat_text.insert(tk.END, f"{record}\n")
+    view_images.clear()
+    for record in records[rendered_start:]:
+        render_record(record)
     chat_text.config(state=tk.DISABLED)
+    chat_text.see(tk.END)
 
 
 def add_chat_record(sender, content, is_self=False):
@@ -323,109 +663,366 @@ def add_chat_record(sender, content, is_self=False):
     if exit_flag:
         return
     msg = f"[我] {content}" if is_self else f"[{sender}] {content}"
-    if sender not in chat_records:
-        chat_records[sender] = []
-    chat_records[sender].append(msg)
+    store_chat_record(sender, msg)
+    append_to_view(sender, msg)
+
+
+# ---------------------- 界面事件分发 ----------------------
+def post_ui(kind, *args):
+    """从任意线程投递界面事件（参数需为不可变数据，不能引用接收缓冲）"""
+    ui_events.put((kind, args))
 
-    if current_chat_target == sender:
-        chat_text.config(state=tk.NORMAL)
-        chat_text.insert(tk.END, f"{msg}\n")
-        chat_text.config(state=tk.DISABLED)
 
-    threading.Thread(target=save_chat_records, daemon=True).start()
+def process_ui_events():
+    """主线程：一次取出一批事件合并处理
+
+    一批消息只改一次通讯录、只切换一次会话，当前会话的新消息合并成一次插入，
+    突发的大量消息只会触发少数几次界面更新。对话框排队逐个弹出。
+    """
+    global online_peers, history_sync
+    events = []
+    while len(events) < UI_BATCH_LIMIT:
+        try:
+            events.append(ui_events.get_nowait())
+        except queue.Empty:
+            break
+    if not events:
+        return
+
+    new_lines = []  # [(会话对象或 None, 行)]，None 表示提示文字
+    friends_dirty = False
+    switch_to = None
+    for kind, args in events:
+        try:
+            if kind in ("text", "record"):
+                sender, content = args
+                record = f"[{sender}] {content}" if kind == "text" else content
+                if sender not in friends_list and sender not in temp_users:
+                    temp_users.append(sender)
+                    friends_dirty = True
+                store_chat_record(sender, record)
+                new_lines.append((sender, record))
+                if kind == "text":
+                    switch_to = sender
+            elif kind == "group_msg":
+                group, sender, content = args
+                peer = GROUP_PREFIX + group
+                store_chat_record(peer, f"[{sender}] {content}")
+                new_lines.append((peer, f"[{sender}] {content}"))  # 群消息不自动切换会话
+            elif kind == "groups":
+                group_list[:] = args[0]
+                friends_dirty = True
+            elif kind == "presence":
+                online_peers = args[0]
+                friends_dirty = True
+            elif kind == "subscribe":
+                subscribe_presence(force=True)
+            elif kind == "history":
+                handle_history(*args)
+            elif kind == "notice":
+                new_lines.append((None, args[0]))
+            elif kind == "disconnected":
+                set_chat_buttons(tk.DISABLED)
+                history_sync = None
+                if args[0]:
+                    dialog_queue.append((messagebox.showerror, ("连接错误", args[0])))
+            elif kind == "error":
+                dialog_queue.append((messagebox.showerror, args))
+            else:
+                dialog_queue.append((DIALOG_HANDLERS[kind], args))
+        except Exception as e:  # 单个事件出错（如连接已断时回复失败）不影响其余事件和界面定时器
+            print(f"⚠️ 界面事件 {kind} 处理失败：{str(e)}")
+
+    if friends_dirty:
+        update_friend_list()
+    if switch_to and switch_to != current_chat_target:
+        switch_chat_target(switch_to)  # 切换时已渲染该会话的最新记录，只需补上提示文字
+        append_lines_to_view([line for peer, line in new_lines if peer is None])
+    else:
+        append_lines_to_view([line for peer, line in new_lines if peer is None or peer == current_chat_target])
+    run_dialogs()
+
+
+def run_dialogs():
+    """逐个弹出排队的对话框（对话框期间的嵌套调用直接返回，由外层继续弹出）"""
+    global dialog_showing
+    if dialog_showing:
+        return
+    dialog_showing = True
+    try:
+        while dialog_queue and not exit_flag:
+            handler, args = dialog_queue.pop(0)
+            try:
+                handler(*args)
+            except Exception as e:
+                print(f"⚠️ 对话框处理失败：{str(e)}")
+    finally:
+        dialog_showing = False
+
+
+def set_chat_buttons(state):
+    """启用/禁用需要连接的按钮"""
+    send_btn.config(state=state)
+    add_friend_btn.config(state=state)
+    query_btn.config(state=state)
+    send_img_btn.config(state=state)
+    send_file_btn.config(state=state)
+    sync_btn.config(state=state)
+    for btn in group_btns:
+        btn.config(state=state)
+
+
+def show_friend_request(req_user):
+    """好友申请对话框"""
+    if messagebox.askyesno("好友申请", f"{req_user} 请求添加你为好友？"):
+            send_frame(FRIEND_REPLY, pack_fields(req_user, "同意"))
+            if req_user not in friends_list:
+                friends_list.append(req_user)
+                save_friends()
+                update_friend_list()
+                messagebox.showinfo("成功", f"已添加{req_user}为好友")
+    else:
+        send_frame(FRIEND_REPLY, pack_fields(req_user, "拒绝"))
+
+
+def show_friend_reply(sender, res):
+    """好友申请结果"""
+    if res == "同意":
+        if sender not in friends_list:
+            friends_list.append(sender)
+            if sender in temp_users:
+                temp_users.remove(sender)
+            save_friends()
+            update_friend_list()
+            messagebox.showinfo("成功", f"{sender} 同意添加你为好友")
+    else:
+        messagebox.showinfo("提示", f"{sender} 拒绝添加你为好友")
+
+
+def show_user_list(users, total=None):
+    """在线用户对话框（total 为分页查询时的在线总数）"""
+    online_list = [x.strip() for x in users.split(",") if x.strip() and x != current_username]
+    msg_text = "当前在线用户：\n" if total is None else f"当前在线 {total} 人（显示前 {USER_PAGE_SIZE} 个）：\n"
+    for user in sorted(online_list):
+        if user in friends_list:
+            msg_text += f"• {user}（好友）\n"
+        else:
+            msg_text += f"• {user}（可发起临时会话）\n"
+    messagebox.showinfo("在线用户", msg_text if online_list else "暂无在线用户")
+
+
+def show_group_members(group, members):
+    """群成员对话框"""
+    names = [x for x in members.split(",") if x]
+    messagebox.showinfo("群成员", f"{GROUP_PREFIX}{group}（{len(names)} 人）：\n" + "\n".join(f"• {x}" for x in names))
+
+
+def group_action(action, title):
+    """建群/入群/退群/查群成员：当前聊天对象是群组时直接使用，否则询问群名"""
+    target = target_entry.get().strip()
+    if target.startswith(GROUP_PREFIX) and action != "create":
+        name = target[len(GROUP_PREFIX):]
+    else:
+        name = simpledialog.askstring(title, "群名：", parent=root)
+    if name and name.strip():
+        send_frame(GROUP, pack_fields(action, name.strip()))
+
+
+DIALOG_HANDLERS = {
+    "friend_req": show_friend_request,
+    "friend_reply": show_friend_reply,
+    "user_list": show_user_list,
+    "group_members": show_group_members,
+    "search_results": show_search_results,
+}
+
+
+def handle_frame(frame):
+    """接收线程：处理服务端下发的一帧（图片数据直接写文件，其余转成界面事件）"""
+    global handled_frames
+    mtype = frame.type
+    if mtype == SESSION:
+        handle_session(frame)
+        return
+    if mtype in (PING, PONG):  # 心跳不参与会话编号
+        if mtype == PING:
+            send_frame(PONG)
+        return
+    handled_frames += 1
+    if mtype == IMAGE:
+        sender, img_filename, img_size = unpack_fields(frame.payload, 3)
+        start_recv_image(sender, img_filename, int(img_size or 0))
+    elif mtype == IMAGE_DATA:
+        recv_image_data(frame)
+    elif mtype == FILE_CHUNK:
+        file_transfers.handle_chunk(frame.payload)
+    elif mtype == FILE_ACK:
+        file_transfers.handle_ack(frame.payload)
+    elif mtype == FILE_OFFER:
+        file_transfers.handle_offer(frame.payload)
+    elif mtype == FILE_CANCEL:
+        file_transfers.handle_cancel(frame.payload)
+    elif mtype == TEXT:
+        post_ui("text", *unpack_fields(frame.payload, 2))
+    elif mtype == PRESENCE:
+        handle_presence(frame)
+    elif mtype == HISTORY:
+        post_ui("history", *unpack_fields(frame.payload, 4 if frame.payload[:5] == b"page|" else 2))
+    elif mtype == GROUP_MSG:
+        post_ui("group_msg", *unpack_fields(frame.payload, 3))
+    elif mtype == GROUP:
+        action, name, members = unpack_fields(frame.payload, 3)
+        if action == "mine":
+            post_ui("groups", tuple(x for x in name.split(",") if x))
+        elif action == "members":
+            post_ui("group_members", name, members)
+    elif mtype == NOTICE:
+        post_ui("notice", bytes(frame.payload).decode("utf-8", "replace"))
+    elif mtype == FRIEND_REQ:
+        post_ui("friend_req", unpack_fields(frame.payload, 1)[0])
+    elif mtype == FRIEND_REPLY:
+        post_ui("friend_reply", *unpack_fields(frame.payload, 2))
+    elif mtype == USER_LIST:
+        post_ui("user_list", unpack_fields(frame.payload, 1)[0])
+
+
+def handle_presence(frame):
+    """接收线程：按版本号合并在线状态快照和增量，变化后交给主线程刷新通讯录"""
+    global presence_snapshot_version
+    kind, first, second, third = unpack_fields(frame.payload, 4)
+    if kind == "page":
+        post_ui("user_list", third, int(first or 0))
+        return
+    if not first.isdigit():
+        return
+    version = int(first)
+    if kind == "snapshot":
+        presence_pending.extend(x for x in second.split(",") if x)
+        if not frame.flags & FLAG_LAST:
+            return
+        if version < presence_snapshot_version:
+            presence_versions.clear()  # 服务端重启过，版本号重新计数
+        presence_online.clear()
+        presence_online.update(presence_pending)
+        presence_pending.clear()
+        presence_snapshot_version = version
+        for name, (seen, online) in list(presence_versions.items()):
+            if seen <= version:
+                del presence_versions[name]  # 已包含在快照中
+            elif online:
+                presence_online.add(name)
+            else:
+                presence_online.discard(name)
+    elif kind in ("online", "offline"):
+        if version <= presence_snapshot_version or version <= presence_versions.get(second, (0, False))[0]:
+            return  # 过时的增量
+        presence_versions[second] = (version, kind == "online")
+        if kind == "online":
+            presence_online.add(second)
+        else:
+            presence_online.discard(second)
+    else:
+        return
+    post_ui("presence", frozenset(presence_online))
+
+
+def handle_session(frame):
+    """服务端确认会话：恢复成功时从断点继续，否则从头计数"""
+    global session_token, handled_frames, acked_frames
+    token, resumed, handled = unpack_fields(frame.payload, 3)
+    session_token = token
+    post_ui("subscribe")  # 订阅随连接失效，每次连上都重新订阅
+    if resumed == "1":
+        post_ui("notice", "已重新连接，正在补发断线期间的消息")
+        return
+    with ack_lock:
+        handled_frames = acked_frames = 0
+    if incoming_image is not None:
+        finish_recv_image()  # 旧会话中没收完的图片不会再补发
+    file_transfers.resume_all()  # 旧会话中在途的数据块已丢失，重新发起后从接收方的断点继续
+
+
+def maybe_ack(force=False):
+    """累计处理一定帧数或隔一段时间后向服务端确认，服务端据此释放回放缓冲"""
+    global acked_frames, last_ack_time
+    with ack_lock:
+        handled = handled_frames
+        if handled <= acked_frames:
+            return
+        now = time.monotonic()
+        if force or handled - acked_frames >= ACK_EVERY or now - last_ack_time >= ACK_INTERVAL:
+            send_frame(ACK, str(handled))
+            acked_frames = handled
+            last_ack_time = now
+
+
+def open_connection():
+    """建立连接并发送握手（有会话令牌时请求恢复会话）"""
+    global client_socket, frame_parser, last_recv
+    sock = socket.create_connection(server_address, timeout=10.0)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # 每条消息一次 sendall，不必等 Nagle 合并
+    hello = pack_fields(current_username, session_token, handled_frames if session_token else 0)
+    with send_lock:
+        sock.sendall(MAGIC + encode_frame(HELLO, hello))
+        sock.settimeout(None)  # 连上后不再用 socket 超时，断线由心跳发现
+        client_socket = sock
+        frame_parser = FrameParser(reuse_buffer=True)  # 负载在处理完后即丢弃，可复用缓冲
+        last_recv = time.monotonic()
+
+
+def reconnect():
+    """断线后在 RESUME_WINDOW 内反复尝试恢复会话，成功返回 True"""
+    post_ui("notice", "与服务端的连接中断，正在重连...")
+    deadline = time.monotonic() + RESUME_WINDOW
+    delay = 0.5
+    while is_running and not exit_flag and time.monotonic() < deadline:
+        try:
+            client_socket.close()
+        except OSError:
+            pass
+        try:
+            open_connection()
+            return True
+        except OSError:
+            time.sleep(delay)
+            delay = min(delay * 2, 5.0)
+    return False
 
 
 def recv_msg():
-    """接收消息线程"""
-    global friends_list, temp_users
+    """接收消息线程（连接中断时自动重连并恢复会话）"""
+    global last_recv
     while is_running and not exit_flag:
         try:
             if not client_socket or exit_flag:
                 break
-            client_socket.settimeout(3.0)
-            msg = client_socket.recv(1024).decode("utf-8").strip()
-            if not msg:
-                continue
-
-            if msg.startswith("image|"):
-                parts = msg.split("|", 2)
-                if len(parts) >= 3:
-                    sender = parts[1]
-                    img_filename = parts[2]
-                    img_size_data = client_socket.recv(4)
-                    if len(img_size_data) != 4:
-                        continue
-                    img_size = struct.unpack("!I", img_size_data)[0]
-                    recv_image(img_filename, img_size, sender)
-                continue
-
-            if msg.startswith("friend_req|"):
-                req_user = msg.split("|")[1]
-                if messagebox.askyesno("好友申请", f"{req_user} 请求添加你为好友？"):
-                    client_socket.send(f"friend_reply|{req_user}|同意".encode("utf-8"))
-                    if req_user not in friends_list:
-                        friends_list.append(req_user)
-                        save_friends()
-                        update_friend_list()
-                        messagebox.showinfo("成功", f"已添加{req_user}为好友")
-                else:
-                    client_socket.send(f"friend_reply|{req_user}|拒绝".encode("utf-8"))
-            elif msg.startswith("friend_reply|"):
-                parts = msg.split("|")
-                if len(parts) >= 3:
-                    sender = parts[1]
-                    res = parts[2]
-                    if res == "同意":
-                        if sender not in friends_list:
-                            friends_list.append(sender)
-                            if sender in temp_users:
-                                temp_users.remove(sender)
-                            save_friends()
-                            update_friend_list()
-                            messagebox.showinfo("成功", f"{sender} 同意添加你为好友")
-                    else:
-                        messagebox.showinfo("提示", f"{sender} 拒绝添加你为好友")
-            elif msg.startswith("user_list|"):
-                online_list = msg.split("|")[1].split(",") if len(msg.split("|")) > 1 else []
-                online_list = [x.strip() for x in online_list if x.strip() and x != current_username]
-                msg_text = "当前在线用户：\n"
-                for user in sorted(online_list):
-                    if user in friends_list:
-                        msg_text += f"• {user}（好友）\n"
-                    else:
-                        msg_text += f"• {user}（可发起临时会话）\n"
-                messagebox.showinfo("在线用户", msg_text if online_list else "暂无在线用户")
+            pending = frame_parser.pending_view()
+            if pending is not None and len(pending) > RECV_BUFFER_SIZE:
+                # 大块图片数据直接收进帧缓冲
+                nbytes = client_socket.recv_into(pending)
+                frames = frame_parser.commit(nbytes) if nbytes else None
             else:
-                if "[" in msg and "]" in msg:
-                    sender = msg[1:msg.index("]")]
-                    content = msg[msg.index("]") + 2:]
-                    if sender not in friends_list and sender not in temp_users:
-                        temp_users.append(sender)
-                        update_friend_list()
-                    add_chat_record(sender, content)
-                    switch_chat_target(sender)
-                else:
-                    chat_text.config(state=tk.NORMAL)
-                    chat_text.insert(tk.END, f"{msg}\n")
-                    chat_text.config(state=tk.DISABLED)
-
-        except socket.timeout:
-            continue
-        except ConnectionResetError:
+                nbytes = client_socket.recv_into(recv_buffer)
+                frames = frame_parser.feed(memoryview(recv_buffer)[:nbytes]) if nbytes else None
+            if frames is None:
+                raise ConnectionResetError()
+            last_recv = time.monotonic()
+            for frame in frames:
+                handle_frame(frame)
+            maybe_ack()
+
+        except OSError:
+            if is_running and not exit_flag and session_token and reconnect():
+                continue
             if is_running and not exit_flag:
-                messagebox.showerror("连接错误", "与服务端的连接已断开")
+                post_ui("disconnected", "与服务端的连接已断开")
             break
         except Exception as e:
             if is_running and not exit_flag:
                 print(f"⚠️ 消息接收异常：{str(e)}")
+                post_ui("disconnected", "")
             break
 
-    if not exit_flag:
-        send_btn.config(state=tk.DISABLED)
-        add_friend_btn.config(state=tk.DISABLED)
-        query_btn.config(state=tk.DISABLED)
-        send_img_btn.config(state=tk.DISABLED)
-
 
 def send_msg():
     """发送文字消息"""
@@ -435,14 +1032,18 @@ def send_msg():
         messagebox.showwarning("提示", "目标用户和消息内容不能为空")
         return
 
-    if target not in friends_list and target not in temp_users:
+    is_group = target.startswith(GROUP_PREFIX)
+    if not is_group and target not in friends_list and target not in temp_users:
         temp_users.append(target)
         update_friend_list()
 
     switch_chat_target(target)
 
     try:
-        client_socket.send(f"text|{target}|{content}".encode("utf-8"))
+        if is_group:
+            send_frame(GROUP_MSG, pack_fields(target[len(GROUP_PREFIX):], content))
+        else:
+            send_frame(TEXT, pack_fields(target, content))
         input_entry.delete(0, tk.END)
         add_chat_record(target, content, is_self=True)
     except Exception as e:
@@ -450,8 +1051,8 @@ def send_msg():
 
 
 def connect_server():
-    """连接服务端"""
-    global current_username, client_socket
+    """连接服务端（手动连接总是开始新会话）"""
+    global current_username, server_address, session_token, handled_frames, acked_frames, file_transfers
     current_username = username_entry.get().strip()
     server_ip = server_ip_entry.get().strip()
 
@@ -466,20 +1067,24 @@ def connect_server():
         if client_socket:
             client_socket.close()
 
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client_socket.settimeout(10.0)
-        client_socket.connect((server_ip, SERVER_PORT))
-        client_socket.send(current_username.encode("utf-8"))
+        server_address = (server_ip, SERVER_PORT)
+        session_token = ""
+        if file_transfers is None:
+            file_transfers = TransferManager(send_frame, send_file_frame, RECV_FILES_DIR, image_store,
+                                             on_transfer_done,
+                                             lambda text: post_ui("error", "文件传输失败", text),
+                                             lambda text: post_ui("notice", text))
+        with ack_lock:
+            handled_frames = acked_frames = 0
+        open_connection()
 
         threading.Thread(target=recv_msg, daemon=True).start()
 
         connect_btn.config(state=tk.DISABLED)
-        send_btn.config(state=tk.NORMAL)
-        add_friend_btn.config(state=tk.NORMAL)
-        query_btn.config(state=tk.NORMAL)
-        send_img_btn.config(state=tk.NORMAL)
+        set_chat_buttons(tk.NORMAL)
 
         load_friends()
+        search_btn.config(state=tk.NORMAL)  # 搜索只用本地记录，断线后也可以用
         messagebox.showinfo("成功", "已连接到服务端")
     except socket.timeout:
         messagebox.showerror("连接失败", "连接超时，请检查服务端是否启动")
@@ -503,11 +1108,16 @@ def on_close():
         if image_popup:
             image_popup.destroy()
 
+        if file_transfers:
+            file_transfers.stop()
+
         # 关闭socket连接
         if client_socket:
             try:
-                client_socket.send(f"offline|{current_username}".encode("utf-8"))
+                maybe_ack(force=True)  # 主动下线前确认全部已处理的帧
+                send_frame(OFFLINE, current_username)
                 time.sleep(0.1)  # 确保消息发送完成
+                client_socket.shutdown(socket.SHUT_RDWR)  # 唤醒阻塞在 recv 上的接收线程
                 client_socket.close()
             except:
                 pass
@@ -515,7 +1125,9 @@ def on_close():
         # 保存数据（非阻塞）
         try:
             save_friends()
-            save_chat_records()
+            if chat_store:
+                chat_store.close()  # 写完队列中剩余的记录
+            print(f"🖼️ 缩略图缓存：{thumbnails.stats()}")
         except:
             pass
 
@@ -531,6 +1143,7 @@ if __name__ == "__main__":
     root.geometry("650x520")
     root.resizable(False, False)
     root.protocol("WM_DELETE_WINDOW", on_close)
+    placeholder_image = tk.PhotoImage(width=150, height=100)
 
     # 1. 顶部：IP+用户名
     tk.Label(root, text="服务端IP：").place(x=10, y=10)
@@ -545,29 +1158,41 @@ if __name__ == "__main__":
     connect_btn = tk.Button(root, text="连接", command=connect_server)
     connect_btn.place(x=380, y=8)
 
+    search_btn = tk.Button(root, text="搜索记录", state=tk.DISABLED, command=open_search_window)
+    search_btn.place(x=440, y=8)
+
     # 2. 中部：目标用户+功能按钮
     tk.Label(root, text="目标用户：").place(x=10, y=40)
     target_entry = tk.Entry(root, width=15)
     target_entry.place(x=70, y=40)
 
     query_btn = tk.Button(root, text="查在线", state=tk.DISABLED,
-                          command=lambda: client_socket.send("user_query|none|none".encode("utf-8")))
+                          command=lambda: send_frame(PRESENCE, pack_fields("query", "", 0, USER_PAGE_SIZE)))
     query_btn.place(x=200, y=38)
 
     add_friend_btn = tk.Button(root, text="加好友", state=tk.DISABLED,
-                               command=lambda: client_socket.send(
-                                   f"friend_req|{target_entry.get().strip()}|apply".encode("utf-8")))
+                               command=lambda: send_frame(FRIEND_REQ, pack_fields(target_entry.get().strip(), "apply")))
     add_friend_btn.place(x=270, y=38)
 
     send_img_btn = tk.Button(root, text="发图片", state=tk.DISABLED, command=send_image)
     send_img_btn.place(x=340, y=38)
 
+    send_file_btn = tk.Button(root, text="发文件", state=tk.DISABLED, command=send_any_file)
+    send_file_btn.place(x=410, y=38)
+
     # 3. 聊天标题
     chat_title = tk.Label(root, text="当前聊天：未选择好友")
     chat_title.place(x=10, y=70)
 
+    group_btns = []
+    for i, (action, text) in enumerate([("create", "建群"), ("join", "入群"), ("leave", "退群"), ("members", "群成员")]):
+        btn = tk.Button(root, text=text, state=tk.DISABLED,
+                        command=lambda action=action, text=text: group_action(action, text))
+        btn.place(x=300 + 50 * i, y=66)
+        group_btns.append(btn)
+
     # 4. 聊天框
-    chat_text = tk.Text(root, state=tk.DISABLED, width=73, height=18)
+    chat_text = tk.Text(root, state=tk.DISABLED, width=73, height=18, yscrollcommand=on_chat_scroll)
     chat_text.place(x=10, y=95)
 
     # 5. 底部：输入框+发送
@@ -577,6 +1202,9 @@ if __name__ == "__main__":
     send_btn = tk.Button(root, text="发送", state=tk.DISABLED, command=send_msg)
     send_btn.place(x=500, y=468)
 
+    sync_btn = tk.Button(root, text="同步记录", state=tk.DISABLED, command=start_history_sync)
+    sync_btn.place(x=560, y=468)
+
     # 6. 右侧：通讯录
     tk.Label(root, text="通讯录").place(x=560, y=10)
     friend_listbox = tk.Listbox(root, width=15, height=25)
@@ -584,4 +1212,5 @@ if __name__ == "__main__":
     friend_listbox.bind("<<ListboxSelect>>",
                         lambda e: switch_chat_target(friend_listbox.get(friend_listbox.curselection())))
 
+    root.after(BACKGROUND_POLL_MS, poll_background)
     root.mainloop()
\ No newline at end of file
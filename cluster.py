@@ -0,0 +1,455 @@
+"""
+多进程模式（服务端使用，--workers N）
+
+主进程作为代理进程，启动 N 个工作进程。工作进程各自运行协程服务端，用 SO_REUSEPORT 监听同一端口，
+由内核把新连接分给各进程，每个进程有自己的 GIL，转发能力随核数增加。
+
+代理进程通过 Unix 域套接字与各工作进程相连，是全局状态的唯一权威：
+  - 每个用户在哪个工作进程上线（CLAIM/RELEASE），用户名冲突由它裁决
+  - 群组名单（保存到文件）、离线消息队列和消息存档（只有它读写离线和存档目录）
+上线/下线和群组变更广播给所有工作进程，工作进程保留一份副本（在线名单、群组），
+查找、在线状态订阅、群消息成员名单都在本进程完成，不需要往返代理进程。
+
+发给其他工作进程上用户的消息经 ROUTE 交给代理进程，代理进程只解析目标名单，消息体原样转给
+目标所在的工作进程（同一工作进程的多个目标只转一份，由该进程按协议编码一次后扇出）。
+
+会话只在建立它的工作进程中有效：断线重连被分到其他工作进程时，代理进程核对原会话令牌后按新会话处理，
+旧进程收到上线广播后作废旧会话，未确认的消息转存离线后再转给新连接。
+"""
+import asyncio
+import contextlib
+import marshal
+import os
+import secrets
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+from urllib.parse import quote
+
+import async_server
+import metrics
+import relay
+from groups import GroupRegistry
+from protocol import FILE_ACK, FILE_CANCEL, FILE_OFFER, GROUP, NOTICE, pack_fields
+
+LINK_HEADER = struct.Struct("!BII")  # | 操作 1B | 元数据长度 4B | 消息体长度 4B |
+CONNECT_TIMEOUT = 10.0  # 工作进程等待代理进程就绪的时间（秒）
+
+# 工作进程 → 代理进程
+HELLO = 1  # (工作进程编号,)
+CLAIM = 2  # (用户名, 客户端出示的会话令牌, 新会话令牌, 是否新版协议)
+RELEASE = 3  # (用户名,)
+ROUTE = 4  # (目标列表, 不在线时是否离线保存) + 消息体
+DRAIN = 5  # (用户名,)，投递该用户的离线消息
+GROUP_OP = 6  # (用户名, 操作, 群名)
+ARCHIVE = 7  # (发送者, 目标, 内容, 是否群消息)，存档一条已转发的消息
+HISTORY_REQ = 8  # (用户名, 请求字段)，读取存档，回复经 DELIVER 发给该用户
+# 代理进程 → 工作进程
+SYNC = 10  # ({用户名: (工作进程, 是否新版协议)}, 版本号, {群名: (群主, 成员列表)})
+ONLINE = 11  # (用户名, 工作进程, 版本号, 是否新版协议)
+OFFLINE = 12  # (用户名, 版本号)
+REJECT = 13  # (用户名,)，用户名已在其他工作进程上线
+DELIVER = 14  # (目标列表, 不在线时是否离线保存) + 消息体
+GROUP_SYNC = 15  # (群名, 群主, 成员列表)，群组解散时成员列表为 None
+
+
+def default_socket_path(port):
+    return os.path.join(tempfile.gettempdir(), f"lanchat-{port}.sock")
+
+
+def encode_op(op, meta=(), body=b""):
+    """编码成待写入的数据块列表"""
+    meta = marshal.dumps(meta)
+    return [LINK_HEADER.pack(op, len(meta), len(body)), meta, body]
+
+
+def encode_messages(messages):
+    """[(类型, 负载, 标志)] 编码成消息体（负载可以是 str、bytes 或 memoryview）"""
+    return marshal.dumps(list(messages))
+
+
+async def read_op(reader):
+    """读取一条操作，返回 (操作, 元数据, 消息体)"""
+    op, meta_len, body_len = LINK_HEADER.unpack(await reader.readexactly(LINK_HEADER.size))
+    data = await reader.readexactly(meta_len + body_len)
+    return op, marshal.loads(data[:meta_len]), data[meta_len:]
+
+
+# ---------------------- 代理进程 ----------------------
+class Broker:
+    """全局的用户位置、群组和离线消息"""
+
+    def __init__(self, groups_file=None, offline=None, archive=None):
+        self.links = {}  # {工作进程编号: StreamWriter}
+        self.owners = {}  # {用户名: (工作进程编号, 是否新版协议)}
+        self.tokens = {}  # {用户名: 会话令牌}，跨进程接管时核对
+        self.version = 0
+        self.groups = GroupRegistry(groups_file)
+        self.offline = offline
+        self.archive = archive
+        self.routed = 0
+
+    def send(self, worker, op, meta=(), body=b""):
+        writer = self.links.get(worker)
+        if writer is not None:
+            writer.writelines(encode_op(op, meta, body))
+
+    def broadcast(self, op, meta=()):
+        chunks = encode_op(op, meta)
+        for writer in self.links.values():
+            writer.writelines(chunks)
+
+    def notify(self, worker, username, messages):
+        self.send(worker, DELIVER, ([username], False), encode_messages(messages))
+
+    async def handle_worker(self, reader, writer):
+        """一个工作进程的连接：依次处理它发来的操作，断开时它上面的用户全部下线"""
+        worker = None
+        try:
+            op, meta, _ = await read_op(reader)
+            if op != HELLO:
+                return
+            worker = meta[0]
+            self.links[worker] = writer
+            groups = {name: (group["owner"], sorted(group["members"])) for name, group in self.groups.groups.items()}
+            self.send(worker, SYNC, (self.owners, self.version, groups))
+            print(f"🧩 工作进程 {worker} 已连接 | 共 {len(self.links)} 个")
+            while True:
+                op, meta, body = await read_op(reader)
+                try:
+                    self.dispatch(worker, op, meta, body)
+                except Exception as e:  # 单个请求出错不能断开整个工作进程的连接（其上的用户会全部下线）
+                    print(f"⚠️ 处理工作进程 {worker} 的请求（操作 {op}）失败：{str(e)}")
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if worker is not None and self.links.get(worker) is writer:
+                del self.links[worker]
+                for username in [name for name, (owner, _) in self.owners.items() if owner == worker]:
+                    self.release(worker, username)
+                print(f"🧩 工作进程 {worker} 已断开 | 剩余 {len(self.links)} 个")
+            writer.close()
+
+    def dispatch(self, worker, op, meta, body):
+        if op == ROUTE:
+            self.route(meta[0], meta[1], body)
+        elif op == CLAIM:
+            self.claim(worker, *meta)
+        elif op == RELEASE:
+            self.release(worker, meta[0])
+        elif op == DRAIN:
+            self.drain(meta[0])
+        elif op == GROUP_OP:
+            self.group_op(worker, *meta)
+        elif op == ARCHIVE and self.archive is not None:
+            self.archive.record(*meta)
+        elif op == HISTORY_REQ and self.archive is not None:
+            username, fields = meta
+            self.archive.request(username, self.groups, fields,
+                                 lambda messages: self.notify(worker, username, messages))
+
+    def claim(self, worker, username, presented, token, framed):
+        """用户在 worker 上线：已在其他进程上线时，出示原会话令牌（断线重连）则转到新进程，否则拒绝"""
+        owner = self.owners.get(username)
+        if owner is not None and owner[0] != worker and not (
+                presented and secrets.compare_digest(presented, self.tokens.get(username, ""))):
+            self.send(worker, REJECT, (username,))
+            return
+        self.owners[username] = (worker, framed)
+        self.tokens[username] = token
+        self.version += 1
+        self.broadcast(ONLINE, (username, worker, self.version, framed))
+
+    def release(self, worker, username):
+        owner = self.owners.get(username)
+        if owner is None or owner[0] != worker:
+            return  # 已转到其他工作进程
+        del self.owners[username]
+        self.tokens.pop(username, None)
+        self.version += 1
+        self.broadcast(OFFLINE, (username, self.version))
+
+    def route(self, targets, store, body):
+        """按目标所在的工作进程分组转发消息体；不在线的按 store 存入离线队列或丢弃"""
+        by_worker = {}
+        offline_targets = []
+        for target in targets:
+            owner = self.owners.get(target)
+            if owner is not None:
+                by_worker.setdefault(owner[0], []).append(target)
+            elif store:
+                offline_targets.append(target)
+        for worker, names in by_worker.items():
+            self.send(worker, DELIVER, (names, store), body)
+        self.routed += len(targets)
+        if not offline_targets or self.offline is None:
+            return
+        messages = marshal.loads(body)
+        for target in offline_targets:
+            if not self.offline.known(target):
+                continue
+            box = self.offline.mailbox(target)
+            with box.lock:
+                if not self.offline.store(box, messages):
+                    print(f"⚠️ {target} 离线消息空间已满，丢弃 {len(messages)} 条消息")
+
+    def drain(self, username):
+        """用户上线后把离线消息转给其所在的工作进程，末尾附上条数提示"""
+        owner = self.owners.get(username)
+        if owner is None or self.offline is None:
+            return
+        collected = []
+        box = self.offline.mailbox(username)
+        with box.lock:
+            count = self.offline.deliver(box, collected.extend)
+        if not collected:
+            return
+        collected.append((NOTICE, f"以上为 {count} 条离线消息", 0))
+        self.send(owner[0], DELIVER, ([username], True), encode_messages(collected))
+        print(f"📬 {username} 收到 {count} 条离线消息")
+
+    def group_op(self, worker, username, action, name):
+        """群组修改：成功后把新名单广播给所有工作进程，并回复操作者所在的群组"""
+        if action == "create":
+            error = self.groups.create(name, username)
+        elif action == "join":
+            error = self.groups.join(name, username)
+        elif action == "leave":
+            error = self.groups.leave(name, username)
+        else:
+            error = f"未知的群组操作：{action}"
+        if error:
+            self.notify(worker, username, [(NOTICE, error, 0)])
+            return
+        group = self.groups.groups.get(name)
+        self.broadcast(GROUP_SYNC, (name, group["owner"], sorted(group["members"])) if group else (name, "", None))
+        print(f"👥 {username} {action} 群组 {name}")
+        self.notify(worker, username, [(GROUP, pack_fields("mine", ",".join(self.groups.groups_of(username))), 0)])
+
+
+async def run_broker(path, workers, worker_args, broker):
+    """代理进程：监听 Unix 域套接字，启动工作进程，收到退出信号时结束它们"""
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+    server = await asyncio.start_unix_server(broker.handle_worker, path)
+    os.chmod(path, 0o600)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+    procs = [subprocess.Popen([sys.executable, script, *worker_args, "--worker-id", str(i), "--broker-socket", path])
+             for i in range(1, workers + 1)]
+    print(f"🚀 代理进程启动成功 | {workers} 个工作进程 | 进程间通信：{path}")
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    async def watch(i, proc):
+        code = await loop.run_in_executor(None, proc.wait)
+        if not stop_event.is_set():
+            print(f"⚠️ 工作进程 {i} 意外退出（返回码 {code}）")
+            if all(p.poll() is not None for p in procs):
+                stop_event.set()
+
+    watchers = [asyncio.create_task(watch(i, proc)) for i, proc in enumerate(procs, 1)]
+    async with server:
+        await stop_event.wait()
+        print("\n📤 正在结束工作进程...")
+        for proc in procs:
+            if proc.poll() is None:
+                proc.send_signal(signal.SIGTERM)
+        await asyncio.gather(*watchers)
+        server.close()
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+    print(f"✅ 代理进程已退出 | 共转发 {broker.routed} 人次")
+
+
+def run(path, workers, worker_args, groups_file=None, offline=None, archive=None):
+    """多进程模式入口（主进程）"""
+    if not hasattr(socket, "SO_REUSEPORT") or not hasattr(socket, "AF_UNIX"):
+        print("❌ 当前系统不支持 SO_REUSEPORT 或 Unix 域套接字，无法使用多进程模式")
+        sys.exit(1)
+    asyncio.run(run_broker(path, workers, worker_args, Broker(groups_file, offline, archive)))
+
+
+# ---------------------- 工作进程 ----------------------
+class RemoteMailbox:
+    """代理进程中某个收件人信箱的代称（工作进程是单线程事件循环，不需要真正的锁）"""
+
+    lock = contextlib.nullcontext()
+
+    def __init__(self, username):
+        self.username = username
+
+
+class OfflineProxy:
+    """工作进程的离线队列：只检查目录判断是否登录过，保存和投递交给代理进程"""
+
+    def __init__(self, link, root):
+        self.link = link
+        self.root = root
+
+    def known(self, username):
+        return os.path.isdir(os.path.join(self.root, quote(username, safe="")))
+
+    def register(self, username):
+        os.makedirs(os.path.join(self.root, quote(username, safe="")), exist_ok=True)
+
+    def mailbox(self, username):
+        return RemoteMailbox(username)
+
+    def store(self, box, messages):
+        """交给代理进程保存（空间已满时由代理进程丢弃并记录），总是返回 True"""
+        self.link.route([box.username], messages, store=True)
+        return True
+
+    def deliver(self, box, send_many):
+        """请代理进程把离线消息转过来（随后异步到达，条数提示附在末尾），这里返回 0"""
+        self.link.send(DRAIN, (box.username,))
+        return 0
+
+    def stats(self):
+        return None
+
+
+class ArchiveProxy:
+    """工作进程的消息存档：写入和查询都交给代理进程"""
+
+    def __init__(self, link):
+        self.link = link
+
+    def record(self, sender, target, content, group=False):
+        self.link.send(ARCHIVE, (sender, target, content, group))
+
+    def request(self, username, groups, fields, send_many):
+        """群成员身份由代理进程核对，回复随后经 DELIVER 到达"""
+        self.link.send(HISTORY_REQ, (username, list(fields)))
+
+    def stats(self):
+        return None
+
+
+class WorkerLink:
+    """工作进程与代理进程的连接，以及全局在线名单的副本（都在事件循环线程中访问）"""
+
+    def __init__(self, worker_id, path):
+        self.worker_id = worker_id
+        self.path = path
+        self.owners = {}  # {用户名: (工作进程编号, 是否新版协议)}
+        self.writer = None
+        self.task = None
+
+    async def connect(self):
+        """连接代理进程并载入当前的在线名单和群组，之后开始接收广播"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + CONNECT_TIMEOUT
+        while True:
+            try:
+                reader, self.writer = await asyncio.open_unix_connection(self.path)
+                break
+            except OSError:
+                if loop.time() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+        self.send(HELLO, (self.worker_id,))
+        op, meta, _ = await read_op(reader)
+        if op != SYNC:
+            raise ConnectionError("代理进程握手失败")
+        owners, version, groups = meta
+        self.owners = owners
+        with relay.lock:
+            for username in owners:
+                relay.directory.add(username, version)
+        for name, (owner, members) in groups.items():
+            relay.groups.apply(name, owner, members)
+        self.task = asyncio.create_task(self.read_loop(reader))
+
+    def send(self, op, meta=(), body=b""):
+        self.writer.writelines(encode_op(op, meta, body))
+
+    def owner(self, username):
+        """用户所在的工作进程编号，不在线返回 None"""
+        owner = self.owners.get(username)
+        return owner[0] if owner is not None else None
+
+    def is_remote(self, username):
+        owner = self.owners.get(username)
+        return owner is not None and owner[0] != self.worker_id
+
+    def is_framed(self, username):
+        owner = self.owners.get(username)
+        return owner is None or owner[1]
+
+    def may_claim(self, username, takeover):
+        """本地初步检查：已在其他进程上线且没出示令牌时直接拒绝（令牌由代理进程核对）"""
+        return takeover or not self.is_remote(username)
+
+    def claim(self, username, presented, token, framed):
+        self.send(CLAIM, (username, presented, token, framed))
+
+    def release(self, username):
+        self.send(RELEASE, (username,))
+
+    def route(self, targets, messages, store=False):
+        """交给代理进程转发，消息只序列化一次"""
+        self.send(ROUTE, (targets, store), encode_messages(messages))
+        metrics.inc("cluster.routed", len(targets))
+
+    def group_op(self, username, action, name):
+        self.send(GROUP_OP, (username, action, name))
+
+    async def read_loop(self, reader):
+        try:
+            while True:
+                op, meta, body = await read_op(reader)
+                self.dispatch(op, meta, body)
+                if async_server.congested:
+                    await async_server.wait_congested()  # block 策略：本进程的接收方跟不上时暂停接收转发
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        print(f"❌ 工作进程 {self.worker_id} 与代理进程的连接已断开，退出")
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    def dispatch(self, op, meta, body):
+        if op == DELIVER:
+            self.deliver(meta[0], meta[1], marshal.loads(body))
+        elif op == ONLINE:
+            username, worker, version, framed = meta
+            self.owners[username] = (worker, framed)
+            with relay.lock:
+                relay.directory.add(username, version)
+            if worker != self.worker_id:
+                relay.evict(username)  # 在其他进程重新连接，本进程的旧连接和旧会话作废
+            relay.publish_presence("online", username, version)
+        elif op == OFFLINE:
+            username, version = meta
+            self.owners.pop(username, None)
+            with relay.lock:
+                relay.directory.remove(username, version)
+            relay.publish_presence("offline", username, version)
+        elif op == REJECT:
+            relay.reject(meta[0])
+        elif op == GROUP_SYNC:
+            relay.groups.apply(*meta)
+
+    def deliver(self, targets, store, messages):
+        """其他进程转来的消息：交给本进程的用户，已不在本进程时（刚下线/转走）按 store 存离线或丢弃"""
+        encoded = {}
+        for target in targets:
+            for mtype, payload, _ in messages:
+                if mtype in (FILE_OFFER, FILE_ACK, FILE_CANCEL):
+                    relay.track_transfer(target, mtype, payload)
+            if store:
+                relay.deliver(target, messages, encoded, remote=False)
+            else:
+                relay.send_online(target, messages, remote=False)
+        metrics.inc("cluster.delivered", len(targets))
+
+    def stats(self):
+        return {"worker": self.worker_id, "online_total": len(self.owners),
+                "remote": sum(1 for worker, _ in self.owners.values() if worker != self.worker_id)}
+
@@ -0,0 +1,398 @@
+"""
+可断点续传的分块文件传输（客户端使用，任意文件类型）
+
+流程：发送方发 FILE_OFFER（传输编号、文件名、大小、整文件 CRC32 和 SHA-256）→ 接收方已有同内容的
+图片时直接确认收齐（blob_store.py），否则查找同编号的未完成文件，用 FILE_ACK 回报已收到的字节数
+→ 发送方从该偏移开始发 FILE_CHUNK（每块带偏移和 CRC32），在途数据不超过 WINDOW → 接收方校验后
+顺序写入 .part 文件并定期确认；块校验失败或偏移不连续时回复“请从某偏移重发”→ 全部收齐后在校验线程中
+校验整文件 CRC32 和 SHA-256（大文件要读很久，不能占用接收线程），图片按内容哈希存入图片目录，其他文件改名保存。
+
+未完成的文件连同说明（.json）保存在接收目录的 .partial 子目录中，断线重连、甚至重启客户端后，
+发送方重新发 FILE_OFFER 即可从断点继续。对方不在线时发送方暂停，每隔 RETRY_INTERVAL 秒重试。
+"""
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+import uuid
+import zlib
+from array import array
+
+from blob_store import file_digests, is_digest
+from protocol import FILE_ACK, FILE_CANCEL, FILE_CHUNK, FILE_OFFER, pack_fields, unpack_fields
+
+CHUNK_SIZE = 256 * 1024
+WINDOW = 4 * 1024 * 1024  # 未确认的在途数据上限
+ACK_EVERY = 1024 * 1024  # 接收方每收到这么多字节确认一次
+RETRY_INTERVAL = 10.0  # 对方不在线或未回应时重新发起的间隔（秒）
+STALL_TIMEOUT = 30.0  # 发送中超过这么久没有收到确认时重新发起，由接收方报告断点（秒）
+CHUNK_HEADER = struct.Struct("!16sQI")  # 传输编号、偏移、CRC32
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".gif", ".bmp")
+CANCEL_OFFLINE = "offline"  # 服务端通知对方不在线（暂停，稍后重试）
+
+
+def scan_file(path):
+    """一次读取计算 (整文件 CRC32, SHA-256 十六进制, 每个 CHUNK_SIZE 块的 CRC32)
+
+    发送时块头用这里算好的 CRC，数据由内核直接从文件发出（sendfile），不再读进 Python 拼成负载。
+    """
+    crc = 0
+    sha = hashlib.sha256()
+    chunk_crcs = array("I")
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(CHUNK_SIZE)
+            if not block:
+                break
+            chunk_crcs.append(zlib.crc32(block))
+            crc = zlib.crc32(block, crc)
+            sha.update(block)
+    return crc, sha.hexdigest(), chunk_crcs
+
+
+def decode_chunk(payload):
+    """解析 FILE_CHUNK 负载，返回 (传输编号, 偏移, CRC32, 数据)"""
+    raw_id, offset, crc = CHUNK_HEADER.unpack_from(payload)
+    return raw_id.hex(), offset, crc, memoryview(payload)[CHUNK_HEADER.size:]
+
+
+def unique_path(directory, filename):
+    """目录中不重名的保存路径（重名时加序号，不覆盖已有文件）"""
+    name, ext = os.path.splitext(os.path.basename(filename) or "file")
+    path = os.path.join(directory, name + ext)
+    n = 1
+    while os.path.exists(path):
+        path = os.path.join(directory, f"{name}({n}){ext}")
+        n += 1
+    return path
+
+
+class OutgoingTransfer:
+    """一个正在发送的文件，由专属线程按窗口发送"""
+
+    def __init__(self, path, target):
+        self.id = uuid.uuid4().hex
+        self.path = path
+        self.target = target
+        self.filename = os.path.basename(path)
+        self.size = os.path.getsize(path)
+        self.crc, self.digest, self.chunk_crcs = scan_file(path)
+        self.cond = threading.Condition()
+        self.state = "offering"  # offering / sending / paused / done / failed
+        self.acked = 0  # 对方已确认的字节数
+        self.next = 0  # 下一块的偏移
+        self.offered_at = 0.0
+        self.progress_at = 0.0  # 最近一次收到确认的时间
+        self.waiting = False  # 已提示过对方不在线
+        self.error = ""
+
+    def offer_frame(self):
+        return FILE_OFFER, pack_fields(self.target, self.id, self.filename, self.size, self.crc, self.digest)
+
+
+class IncomingTransfer:
+    """一个正在接收的文件（数据顺序写入 .part 文件）"""
+
+    def __init__(self, partial_dir, transfer_id, sender, filename, size, crc, digest):
+        self.id = transfer_id
+        self.sender = sender
+        self.filename = filename
+        self.size = size
+        self.crc = crc
+        self.digest = digest
+        self.part_path = os.path.join(partial_dir, transfer_id + ".part")
+        self.meta_path = os.path.join(partial_dir, transfer_id + ".json")
+        self.file = None
+        self.offset = 0
+        self.acked = 0
+        self.nacked = None  # 已请求重发的偏移，收到该偏移前不重复请求
+
+    def open(self):
+        """打开（或续接）.part 文件，返回已有的字节数"""
+        meta = {"sender": self.sender, "filename": self.filename, "size": self.size, "crc": self.crc,
+                "digest": self.digest}
+        try:
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                resumable = json.load(f) == meta
+        except (OSError, ValueError):
+            resumable = False
+        if not resumable:
+            with open(self.meta_path, "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+        self.file = open(self.part_path, "r+b" if resumable and os.path.exists(self.part_path) else "wb")
+        self.offset = min(self.file.seek(0, os.SEEK_END), self.size)
+        self.file.truncate(self.offset)
+        self.acked = self.offset
+        self.nacked = None
+        return self.offset
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def discard(self):
+        self.close()
+        for path in (self.part_path, self.meta_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class TransferManager:
+    """收发双方的传输状态；send_frame(类型, 负载) 发往服务端，send_file_frame(类型, 头部, 文件, 偏移, 长度)
+    发一帧负载为头部加文件中该段数据的帧（数据用 sendfile 发出）；回调在接收线程或发送线程中调用
+
+    图片存入 blobs（BlobStore），其他文件保存到 recv_dir。on_done(方向 "in"/"out", 对方, 文件路径) 在传输完成时调用；on_error(文字) 在失败时调用；
+    on_notice(文字) 用于提示开始/续传等进度。
+    """
+
+    def __init__(self, send_frame, send_file_frame, recv_dir, blobs, on_done, on_error, on_notice):
+        self.send_frame = send_frame
+        self.send_file_frame = send_file_frame
+        self.recv_dir = recv_dir
+        self.blobs = blobs
+        self.partial_dir = os.path.join(recv_dir, ".partial")
+        os.makedirs(self.partial_dir, exist_ok=True)
+        self.on_done = on_done
+        self.on_error = on_error
+        self.on_notice = on_notice
+        self.lock = threading.Lock()
+        self.outgoing = {}  # {传输编号: OutgoingTransfer}
+        self.incoming = {}  # {传输编号: IncomingTransfer}
+        self.verifying = set()  # 已收齐、正在校验的传输编号
+        self.running = True
+
+    # ---------------------- 发送方 ----------------------
+    def send_file(self, path, target):
+        """发起发送（计算 CRC 较慢，放在发送线程中进行）"""
+        threading.Thread(target=self._send_loop, args=(path, target), daemon=True).start()
+
+    def _send_loop(self, path, target):
+        try:
+            transfer = OutgoingTransfer(path, target)
+        except OSError as e:
+            self.on_error(f"无法读取文件：{str(e)}")
+            return
+        with self.lock:
+            self.outgoing[transfer.id] = transfer
+        try:
+            with open(path, "rb") as f:
+                self._pump(transfer, f)
+        except OSError as e:
+            transfer.state = "failed"
+            transfer.error = str(e)
+        with self.lock:
+            self.outgoing.pop(transfer.id, None)
+        if transfer.state == "done":
+            self.on_done("out", target, path)
+        elif self.running:
+            self.on_error(f"{transfer.filename} 发送失败：{transfer.error or '已取消'}")
+
+    def _pump(self, transfer, f):
+        """按窗口发送数据块，等待确认；对方不在线或未回应时定期重新发起"""
+        while self.running:
+            with transfer.cond:
+                while True:
+                    if transfer.state in ("done", "failed"):
+                        return
+                    now = time.monotonic()
+                    if transfer.state in ("offering", "paused"):
+                        if now - transfer.offered_at >= RETRY_INTERVAL:
+                            transfer.offered_at = now
+                            transfer.state = "offering"
+                            break
+                    elif transfer.next < transfer.size and transfer.next - transfer.acked < WINDOW:
+                        break
+                    elif now - transfer.progress_at >= STALL_TIMEOUT:
+                        transfer.state = "offering"  # 数据块可能在断线时丢失，询问对方断点
+                        transfer.offered_at = 0.0
+                        continue
+                    transfer.cond.wait(1.0)
+                if transfer.state == "offering":
+                    frame = transfer.offer_frame()
+                    offset = None
+                else:
+                    offset = transfer.next
+                    # 对方的断点不在块边界上时（异常退出时 .part 只写了半块）先补齐到边界
+                    count = min(CHUNK_SIZE - offset % CHUNK_SIZE, transfer.size - offset)
+                    transfer.next += count
+            if offset is None:
+                self._send(transfer, self.send_frame, *frame)
+                continue
+            if offset % CHUNK_SIZE:
+                f.seek(offset)
+                crc = zlib.crc32(f.read(count))
+            else:
+                crc = transfer.chunk_crcs[offset // CHUNK_SIZE]
+            head = CHUNK_HEADER.pack(bytes.fromhex(transfer.id), offset, crc)
+            self._send(transfer, self.send_file_frame, FILE_CHUNK, head, f, offset, count)
+
+    def _send(self, transfer, send, *args):
+        """发送失败（断线重连中）时暂停，稍后重新发起，由接收方报告断点"""
+        try:
+            send(*args)
+        except OSError:
+            with transfer.cond:
+                if transfer.state not in ("done", "failed"):
+                    transfer.state = "paused"
+                    transfer.offered_at = time.monotonic()
+
+    def handle_ack(self, payload):
+        """FILE_ACK：对方已收到的字节数，或请求从某偏移重发"""
+        transfer_id, offset, resend = unpack_fields(payload, 3)
+        with self.lock:
+            transfer = self.outgoing.get(transfer_id)
+        if transfer is None or not offset.isdigit():
+            return
+        offset = int(offset)
+        with transfer.cond:
+            transfer.progress_at = time.monotonic()
+            transfer.waiting = False
+            if offset >= transfer.size:
+                transfer.state = "done"
+            elif transfer.state in ("offering", "paused") or resend == "1":
+                if transfer.state != "sending" and offset:
+                    self.on_notice(f"{transfer.filename} 从 {offset} 字节处继续发送")
+                transfer.state = "sending"
+                transfer.acked = transfer.next = offset  # 从对方缺的位置重发
+            else:
+                transfer.acked = max(transfer.acked, offset)
+            transfer.cond.notify_all()
+
+    def resume_all(self):
+        """重新连接（新会话）后，重新发起所有未完成的发送"""
+        with self.lock:
+            transfers = list(self.outgoing.values())
+        for transfer in transfers:
+            with transfer.cond:
+                if transfer.state not in ("done", "failed"):
+                    transfer.state = "offering"
+                    transfer.offered_at = 0.0
+                    transfer.cond.notify_all()
+
+    # ---------------------- 接收方 ----------------------
+    def handle_offer(self, payload):
+        """FILE_OFFER：准备接收（已有同内容的图片时跳过，同编号的未完成文件从断点继续）"""
+        sender, transfer_id, filename, size, crc, digest = unpack_fields(payload, 6)
+        if len(transfer_id) != 32 or not size.isdigit() or not crc.isdigit():
+            return
+        filename = os.path.basename(filename)
+        with self.lock:
+            if transfer_id in self.verifying:
+                return  # 发送方等确认超时重新发起：校验完成后会确认
+        if filename.lower().endswith(IMAGE_EXTS):
+            existing = self.blobs.find(digest, int(size))
+            if existing is not None:
+                self.send_frame(FILE_ACK, pack_fields(transfer_id, size, 0))
+                self.on_notice(f"已有 {sender} 发来的图片 {filename}，无需重新传输")
+                self.on_done("in", sender, existing)
+                return
+        with self.lock:
+            transfer = self.incoming.get(transfer_id)
+            if transfer is None:
+                transfer = IncomingTransfer(self.partial_dir, transfer_id, sender, filename, int(size), int(crc),
+                                            digest if is_digest(digest) else "")
+                self.incoming[transfer_id] = transfer
+        transfer.close()
+        offset = transfer.open()
+        if offset:
+            self.on_notice(f"继续接收 {sender} 的文件 {transfer.filename}（已收到 {offset}/{transfer.size} 字节）")
+        else:
+            self.on_notice(f"开始接收 {sender} 的文件 {transfer.filename}（{transfer.size} 字节）")
+        if offset >= transfer.size:
+            self._finish(transfer)
+        else:
+            self.send_frame(FILE_ACK, pack_fields(transfer_id, offset, 1))
+
+    def handle_chunk(self, payload):
+        """FILE_CHUNK：校验后顺序写入，不连续或校验失败时请求重发"""
+        transfer_id, offset, crc, data = decode_chunk(payload)
+        with self.lock:
+            transfer = self.incoming.get(transfer_id)
+        if transfer is None or transfer.file is None:
+            return
+        if offset != transfer.offset or zlib.crc32(data) != crc or offset + len(data) > transfer.size:
+            if transfer.nacked != transfer.offset:
+                transfer.nacked = transfer.offset
+                self.send_frame(FILE_ACK, pack_fields(transfer_id, transfer.offset, 1))
+            return
+        transfer.file.write(data)
+        transfer.offset += len(data)
+        transfer.nacked = None
+        if transfer.offset >= transfer.size:
+            self._finish(transfer)
+        elif transfer.offset - transfer.acked >= ACK_EVERY:
+            transfer.acked = transfer.offset
+            self.send_frame(FILE_ACK, pack_fields(transfer_id, transfer.offset, 0))
+
+    def _finish(self, transfer):
+        """收齐：交给校验线程（整文件哈希耗时与文件大小成正比，放在接收线程会耽误心跳等其他帧）"""
+        transfer.close()
+        with self.lock:
+            self.incoming.pop(transfer.id, None)
+            self.verifying.add(transfer.id)
+        threading.Thread(target=self._verify, args=(transfer,), daemon=True).start()
+
+    def _verify(self, transfer):
+        """校验线程：校验整文件后保存（图片按内容哈希存放），再向发送方确认"""
+        try:
+            crc, digest = file_digests(transfer.part_path)
+            if crc != transfer.crc or transfer.digest not in ("", digest):
+                transfer.discard()
+                self.send_frame(FILE_CANCEL, pack_fields(transfer.id, "文件校验失败"))
+                self.on_error(f"{transfer.filename} 校验失败，已丢弃")
+                return
+            ext = os.path.splitext(transfer.filename)[1]
+            with self.lock:  # 同时收齐的同名文件不会选到同一个保存路径
+                if ext.lower() in IMAGE_EXTS:
+                    save_path = self.blobs.put(transfer.part_path, digest, ext)
+                else:
+                    os.makedirs(self.recv_dir, exist_ok=True)
+                    save_path = unique_path(self.recv_dir, transfer.filename)
+                    os.replace(transfer.part_path, save_path)
+            transfer.discard()
+            self.send_frame(FILE_ACK, pack_fields(transfer.id, transfer.size, 0))
+            self.on_done("in", transfer.sender, save_path)
+        except OSError as e:
+            self.on_error(f"{transfer.filename} 接收失败：{str(e)}")
+        finally:
+            with self.lock:
+                self.verifying.discard(transfer.id)
+
+    # ---------------------- 取消 ----------------------
+    def handle_cancel(self, payload):
+        """FILE_CANCEL：对方或服务端取消；对方不在线时发送方暂停等待重试"""
+        transfer_id, reason = unpack_fields(payload, 2)
+        with self.lock:
+            outgoing = self.outgoing.get(transfer_id)
+            incoming = self.incoming.pop(transfer_id, None) if outgoing is None else None
+        if outgoing is not None:
+            with outgoing.cond:
+                if reason == CANCEL_OFFLINE:
+                    if not outgoing.waiting:
+                        outgoing.waiting = True
+                        self.on_notice(f"{outgoing.target} 不在线，{outgoing.filename} 将在对方上线后继续发送")
+                    outgoing.state = "paused"
+                else:
+                    outgoing.state = "failed"
+                    outgoing.error = reason
+                outgoing.cond.notify_all()
+        elif incoming is not None:
+            incoming.close()  # 保留 .part 文件，对方重新发起时续传
+            self.on_notice(f"{incoming.sender} 的文件 {incoming.filename} 传输中断：{reason}")
+
+    def stop(self):
+        """退出时停止所有发送线程（未完成的接收文件保留在 .partial 中）"""
+        self.running = False
+        with self.lock:
+            transfers = list(self.outgoing.values())
+            incoming = list(self.incoming.values())
+        for transfer in transfers:
+            with transfer.cond:
+                transfer.cond.notify_all()
+        for transfer in incoming:
+            transfer.close()
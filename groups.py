@@ -0,0 +1,129 @@
+"""
+群组（服务端使用）
+
+服务端只记录群名、群主和成员名单，保存在 JSON 文件中（变更后先写临时文件再替换），重启后仍在。
+成员名单另存一份只读元组供群消息扇出使用，发消息时不必复制名单；扇出本身在 relay.fan_out 中完成，
+一条群消息每种协议只编码一次，所有成员的发送队列共享同一份数据。
+"""
+import json
+import os
+import threading
+
+GROUPS_FILE = "groups.json"
+MAX_MEMBERS = 1000
+MAX_NAME_LENGTH = 32
+FORBIDDEN_CHARS = "|,"  # 分隔符不能出现在群名中
+
+
+class GroupRegistry:
+    """所有群组的成员名单；修改方法成功返回 None，失败返回提示文字"""
+
+    def __init__(self, path=None):
+        self.path = path  # None 表示不保存到文件
+        self.lock = threading.Lock()
+        self.groups = {}  # {群名: {"owner": 用户名, "members": set}}
+        self.snapshots = {}  # {群名: 成员元组}，名单变更时重建
+        self.user_groups = {}  # {用户名: set(群名)}
+        self.load()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"⚠️ 群组文件读取失败：{str(e)}")
+            return
+        for name, group in data.items():
+            self.groups[name] = {"owner": group.get("owner", ""), "members": set(group.get("members", []))}
+            self.refresh(name)
+
+    def save(self):
+        """写入文件（需持有 self.lock）"""
+        if not self.path:
+            return
+        data = {name: {"owner": group["owner"], "members": sorted(group["members"])}
+                for name, group in self.groups.items()}
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"⚠️ 群组文件保存失败：{str(e)}")
+
+    def refresh(self, name):
+        """重建成员元组和用户索引（需持有 self.lock）"""
+        group = self.groups.get(name)
+        for member in self.snapshots.get(name, ()):
+            self.user_groups[member].discard(name)
+        if group is None:
+            self.snapshots.pop(name, None)
+            return
+        self.snapshots[name] = tuple(sorted(group["members"]))
+        for member in group["members"]:
+            self.user_groups.setdefault(member, set()).add(name)
+
+    def create(self, name, owner):
+        if not name or len(name) > MAX_NAME_LENGTH or any(c in name for c in FORBIDDEN_CHARS):
+            return f"群名不能为空、不超过 {MAX_NAME_LENGTH} 个字符且不能包含 | 或 ,"
+        with self.lock:
+            if name in self.groups:
+                return f"群组 {name} 已存在"
+            self.groups[name] = {"owner": owner, "members": {owner}}
+            self.refresh(name)
+            self.save()
+        return None
+
+    def join(self, name, username):
+        with self.lock:
+            group = self.groups.get(name)
+            if group is None:
+                return f"群组 {name} 不存在"
+            if username in group["members"]:
+                return f"已在群组 {name} 中"
+            if len(group["members"]) >= MAX_MEMBERS:
+                return f"群组 {name} 已满（{MAX_MEMBERS} 人）"
+            group["members"].add(username)
+            self.refresh(name)
+            self.save()
+        return None
+
+    def leave(self, name, username):
+        """退出群组，最后一人退出时解散；群主退出时由剩下成员中名字最小的接任"""
+        with self.lock:
+            group = self.groups.get(name)
+            if group is None or username not in group["members"]:
+                return f"不在群组 {name} 中"
+            group["members"].discard(username)
+            if not group["members"]:
+                del self.groups[name]
+            elif group["owner"] == username:
+                group["owner"] = min(group["members"])
+            self.refresh(name)
+            self.save()
+        return None
+
+    def apply(self, name, owner, members):
+        """用代理进程广播的名单替换本地副本（多进程模式的工作进程使用），members 为 None 表示已解散"""
+        with self.lock:
+            if members is None:
+                self.groups.pop(name, None)
+            else:
+                self.groups[name] = {"owner": owner, "members": set(members)}
+            self.refresh(name)
+
+    def members(self, name):
+        """成员元组（只读，可在锁外遍历），群组不存在返回 None"""
+        return self.snapshots.get(name)
+
+    def is_member(self, name, username):
+        return name in self.user_groups.get(username, ())
+
+    def groups_of(self, username):
+        with self.lock:
+            return sorted(self.user_groups.get(username, ()))
+
+    def stats(self):
+        return {"groups": len(self.groups), "largest": max(map(len, self.snapshots.values()), default=0)}
@@ -0,0 +1,209 @@
+"""
+服务端运行指标：计数器、延迟直方图和锁等待/持有时间
+
+每个线程写自己的分片（不加锁，热路径只有字典加法），读取时再合并，线程模式下
+上千个连接线程同时计数也不会互相争用；协程模式只有一个分片。直方图按 2 的幂次
+（微秒）分桶，分位数取所在桶的上界。可通过 STATS 消息或本机 HTTP 端口查看。
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BUCKETS = 32  # 1us ~ 2^31us（约 36 分钟）
+TOP_BACKLOG = 5
+
+_local = threading.local()
+_shards = []  # [(线程, 分片)]
+_retired = {"counters": {}, "histograms": {}}  # 已退出线程的分片合并到这里
+_shards_lock = threading.Lock()  # 只在创建分片和读取指标时使用
+_gauges = {}  # {名称: 无参函数}，读取指标时才计算
+started = time.time()
+_last = {"time": started, "counters": {}}
+
+
+def _shard():
+    shard = getattr(_local, "shard", None)
+    if shard is None:
+        shard = _local.shard = {"counters": {}, "histograms": {}}
+        with _shards_lock:
+            _shards.append((threading.current_thread(), shard))
+    return shard
+
+
+def inc(name, n=1):
+    """计数器加 n"""
+    counters = _shard()["counters"]
+    counters[name] = counters.get(name, 0) + n
+
+
+def observe(name, seconds):
+    """记录一次耗时（秒）"""
+    histograms = _shard()["histograms"]
+    hist = histograms.get(name)
+    if hist is None:
+        hist = histograms[name] = [0] * BUCKETS + [0, 0.0, 0.0]  # 各桶计数 + 次数、总和、最大值
+    micros = int(seconds * 1000000)
+    hist[min(micros.bit_length(), BUCKETS - 1)] += 1
+    hist[BUCKETS] += 1
+    hist[BUCKETS + 1] += seconds
+    if seconds > hist[BUCKETS + 2]:
+        hist[BUCKETS + 2] = seconds
+
+
+def gauge(name, func):
+    """注册一个在读取指标时计算的值"""
+    _gauges[name] = func
+
+
+class TimedLock:
+    """记录等待时间和持有时间的锁，用法与 threading.Lock 相同"""
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._wait_name = f"lock.wait.{name}"
+        self._hold_name = f"lock.hold.{name}"
+        self._acquired_at = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = time.perf_counter()
+        ok = self._lock.acquire(blocking, timeout)
+        if ok:
+            self._acquired_at = now = time.perf_counter()
+            observe(self._wait_name, now - start)
+        return ok
+
+    def release(self):
+        held = time.perf_counter() - self._acquired_at
+        self._lock.release()
+        observe(self._hold_name, held)
+
+    def locked(self):
+        return self._lock.locked()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def _merge(target, shard):
+    for name, value in list(shard["counters"].items()):
+        target["counters"][name] = target["counters"].get(name, 0) + value
+    for name, hist in list(shard["histograms"].items()):
+        merged = target["histograms"].get(name)
+        if merged is None:
+            target["histograms"][name] = list(hist)
+            continue
+        for i in range(BUCKETS + 2):
+            merged[i] += hist[i]
+        merged[BUCKETS + 2] = max(merged[BUCKETS + 2], hist[BUCKETS + 2])
+
+
+def percentile(hist, p):
+    """按分桶估算分位数（秒）"""
+    count = hist[BUCKETS]
+    if not count:
+        return 0.0
+    rank = count * p / 100
+    seen = 0
+    for i in range(BUCKETS):
+        seen += hist[i]
+        if seen >= rank:
+            return min((1 << i) / 1000000, hist[BUCKETS + 2])
+    return hist[BUCKETS + 2]
+
+
+def snapshot():
+    """合并各分片，返回 {"uptime", "counters", "rates", "histograms", "gauges"}"""
+    total = {"counters": {}, "histograms": {}}
+    with _shards_lock:
+        alive = []
+        for thread, shard in _shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                _merge(_retired, shard)
+        _shards[:] = alive
+        _merge(total, _retired)
+        for _, shard in alive:
+            _merge(total, shard)
+
+        now = time.time()
+        interval = max(now - _last["time"], 1e-6)
+        rates = {name: (value - _last["counters"].get(name, 0)) / interval
+                 for name, value in total["counters"].items()}
+        _last["time"] = now
+        _last["counters"] = dict(total["counters"])
+
+    histograms = {}
+    for name, hist in total["histograms"].items():
+        count = hist[BUCKETS]
+        histograms[name] = {
+            "count": count,
+            "avg_ms": hist[BUCKETS + 1] / count * 1000 if count else 0.0,
+            "p50_ms": percentile(hist, 50) * 1000,
+            "p99_ms": percentile(hist, 99) * 1000,
+            "p999_ms": percentile(hist, 99.9) * 1000,
+            "max_ms": hist[BUCKETS + 2] * 1000,
+        }
+    gauges = {}
+    for name, func in list(_gauges.items()):
+        try:
+            gauges[name] = func()
+        except Exception as e:
+            gauges[name] = f"error: {e}"
+    return {"uptime": now - started, "counters": dict(sorted(total["counters"].items())),
+            "rates": dict(sorted(rates.items())), "histograms": dict(sorted(histograms.items())),
+            "gauges": gauges}
+
+
+def render_text(snap=None):
+    """把指标格式化成便于阅读的文本"""
+    snap = snap or snapshot()
+    lines = [f"运行时间 {snap['uptime']:.0f}s"]
+    lines.append("[计数]  名称  总数  每秒（距上次查询）")
+    for name, value in snap["counters"].items():
+        lines.append(f"{name}  {value}  {snap['rates'].get(name, 0):.1f}/s")
+    lines.append("[耗时]  名称  次数  平均  p50  p99  p999  最大（毫秒）")
+    for name, h in snap["histograms"].items():
+        lines.append(f"{name}  {h['count']}  {h['avg_ms']:.3f}  {h['p50_ms']:.3f}  {h['p99_ms']:.3f}"
+                     f"  {h['p999_ms']:.3f}  {h['max_ms']:.3f}")
+    lines.append("[状态]")
+    for name, value in snap["gauges"].items():
+        lines.append(f"{name}  {value}")
+    return "\n".join(lines)
+
+
+# ---------------------- HTTP 端口 ----------------------
+class MetricsHandler(BaseHTTPRequestHandler):
+    """GET /metrics 返回文本，GET /metrics.json 返回 JSON"""
+
+    def do_GET(self):
+        if self.path == "/metrics.json":
+            body = json.dumps(snapshot(), ensure_ascii=False).encode("utf-8")
+            content_type = "application/json; charset=utf-8"
+        elif self.path in ("/", "/metrics"):
+            body = render_text().encode("utf-8")
+            content_type = "text/plain; charset=utf-8"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # 不打印访问日志
+
+
+def serve_http(port, host="127.0.0.1"):
+    """在后台线程启动指标 HTTP 端口（默认只监听本机）"""
+    httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    print(f"📊 指标端口：http://{host}:{port}/metrics")
+    return httpd
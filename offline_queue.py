@@ -0,0 +1,244 @@
+"""
+离线消息队列（服务端使用）
+
+每个收件人一个目录，消息按到达顺序追加写入分段日志（00000001.seg、00000002.seg ...），
+每条记录为 | 负载长度 4B | 类型 1B | 标志 1B | 时间戳 8B | 负载 |，一条消息连同图片数据一次写入。
+写满 SEGMENT_SIZE 的分段封存，摘要（大小、条数、首末时间）记在 index.json 中，启动时只需扫描
+最后一个分段。用户上线时按分段整块读出、批量放入发送队列，发完一个分段删除一个。
+
+保留策略以分段为单位：超过 max_age 的分段删除；单个收件人超过 max_user_bytes 时删除最旧的分段；
+全部离线消息超过 max_total_bytes 时拒收新消息。只为登录过的用户（已有目录）保存离线消息。
+"""
+import json
+import os
+import struct
+import threading
+import time
+from urllib.parse import quote
+
+from protocol import IMAGE_DATA
+
+OFFLINE_DIR = "offline_mail"
+SEGMENT_SIZE = 1024 * 1024  # 分段大小（超过后新开分段）
+MAX_AGE = 7 * 24 * 3600  # 离线消息保留时间（秒）
+MAX_USER_BYTES = 64 * 1024 * 1024  # 单个收件人上限
+MAX_TOTAL_BYTES = 1024 * 1024 * 1024  # 全部离线消息上限
+RECORD = struct.Struct("!IBBd")
+INDEX_FILE = "index.json"
+SEGMENT_SUFFIX = ".seg"
+
+
+def encode_records(messages, timestamp):
+    """把 [(类型, 负载, 标志)] 编码成待写入的数据块列表"""
+    chunks = []
+    for mtype, payload, flags in messages:
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        chunks.append(RECORD.pack(len(payload), mtype, flags, timestamp))
+        chunks.append(payload)
+    return chunks
+
+
+def decode_records(data):
+    """解析分段数据，返回 ([(类型, 负载, 标志, 时间戳)], 完整记录的字节数)；负载为 memoryview"""
+    view = memoryview(data)
+    records = []
+    pos = 0
+    while len(view) - pos >= RECORD.size:
+        length, mtype, flags, timestamp = RECORD.unpack_from(view, pos)
+        start = pos + RECORD.size
+        if len(view) - start < length:
+            break  # 异常退出时留下的半条记录
+        records.append((mtype, view[start:start + length], flags, timestamp))
+        pos = start + length
+    return records, pos
+
+
+class Mailbox:
+    """单个收件人的离线消息（所有方法需持有 self.lock）"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()  # 登录时持有本锁，期间作废旧会话会再次存入离线消息
+        self.segments = []  # [{"seq", "bytes", "count", "first", "last"}]，最后一个为当前写入的分段
+        self.discarded = 0  # 加载时截掉/删除的无效字节数
+        self.load()
+
+    def segment_path(self, seq):
+        return os.path.join(self.path, f"{seq:08d}{SEGMENT_SUFFIX}")
+
+    @property
+    def bytes(self):
+        return sum(segment["bytes"] for segment in self.segments)
+
+    @property
+    def count(self):
+        return sum(segment["count"] for segment in self.segments)
+
+    def load(self):
+        """读取索引中的封存分段，并扫描未封存的分段（截掉末尾不完整的记录）"""
+        on_disk = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.path)
+                         if name.endswith(SEGMENT_SUFFIX))
+        indexed = {}
+        try:
+            with open(os.path.join(self.path, INDEX_FILE), "r", encoding="utf-8") as f:
+                indexed = {segment["seq"]: segment for segment in json.load(f)}
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        self.segments = []
+        for i, seq in enumerate(on_disk):
+            segment = indexed.get(seq)
+            if segment is None or i == len(on_disk) - 1:
+                segment = self.scan(seq)
+            if segment["count"]:
+                self.segments.append(segment)
+            else:
+                self.discarded += os.path.getsize(self.segment_path(seq))
+                os.remove(self.segment_path(seq))
+
+    def scan(self, seq):
+        path = self.segment_path(seq)
+        with open(path, "rb") as f:
+            data = f.read()
+        records, valid = decode_records(data)
+        if valid < len(data):
+            self.discarded += len(data) - valid
+            with open(path, "r+b") as f:
+                f.truncate(valid)
+        return {"seq": seq, "bytes": valid, "count": len(records),
+                "first": records[0][3] if records else 0, "last": records[-1][3] if records else 0}
+
+    def save_index(self):
+        """封存的分段写入索引（先写临时文件再替换）"""
+        tmp_path = os.path.join(self.path, INDEX_FILE + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.segments[:-1], f)
+        os.replace(tmp_path, os.path.join(self.path, INDEX_FILE))
+
+    def append(self, chunks, size, timestamp, count, fsync=False):
+        """追加一组记录（一次写入），当前分段写满时先封存"""
+        current = self.segments[-1] if self.segments else None
+        if current is None or current["bytes"] >= SEGMENT_SIZE:
+            current = {"seq": current["seq"] + 1 if current else 1, "bytes": 0, "count": 0,
+                       "first": timestamp, "last": timestamp}
+            self.segments.append(current)
+            if len(self.segments) > 1:
+                self.save_index()
+        with open(self.segment_path(current["seq"]), "ab") as f:
+            f.write(b"".join(chunks))
+            f.flush()
+            if fsync:
+                os.fsync(f.fileno())
+        current["bytes"] += size
+        current["count"] += count
+        current["last"] = timestamp
+
+    def drop_oldest(self):
+        """删除最旧的分段，返回释放的字节数"""
+        segment = self.segments.pop(0)
+        try:
+            os.remove(self.segment_path(segment["seq"]))
+        except OSError:
+            pass
+        self.save_index()
+        return segment["bytes"]
+
+    def read_oldest(self):
+        """整块读出最旧的分段"""
+        with open(self.segment_path(self.segments[0]["seq"]), "rb") as f:
+            return decode_records(f.read())[0]
+
+
+class OfflineQueue:
+    """所有收件人的离线消息"""
+
+    def __init__(self, root=OFFLINE_DIR, max_age=MAX_AGE, max_user_bytes=MAX_USER_BYTES,
+                 max_total_bytes=MAX_TOTAL_BYTES, fsync=False):
+        self.root = root
+        self.max_age = max_age
+        self.max_user_bytes = max_user_bytes
+        self.max_total_bytes = max_total_bytes
+        self.fsync = fsync
+        self.boxes = {}  # {用户名: Mailbox}，首次用到时加载
+        self.lock = threading.Lock()  # 保护 boxes 和 total_bytes
+        os.makedirs(root, exist_ok=True)
+        self.total_bytes = 0
+        for entry in os.scandir(root):
+            if entry.is_dir():
+                self.total_bytes += sum(f.stat().st_size for f in os.scandir(entry.path)
+                                        if f.name.endswith(SEGMENT_SUFFIX))
+
+    def user_dir(self, username):
+        return os.path.join(self.root, quote(username, safe=""))
+
+    def known(self, username):
+        """是否登录过（只为登录过的用户保存离线消息）"""
+        return username in self.boxes or os.path.isdir(self.user_dir(username))
+
+    def register(self, username):
+        """用户登录时调用，此后可以接收离线消息"""
+        os.makedirs(self.user_dir(username), exist_ok=True)
+
+    def mailbox(self, username):
+        """取收件人的信箱（调用方需持有返回对象的 lock 再读写）"""
+        with self.lock:
+            box = self.boxes.get(username)
+            if box is None:
+                box = self.boxes[username] = Mailbox(self.user_dir(username))
+                self.total_bytes -= box.discarded
+            return box
+
+    def expire(self, box, now):
+        """删除超过保留时间的分段（需持有 box.lock）"""
+        freed = 0
+        while box.segments and box.segments[0]["last"] < now - self.max_age:
+            freed += box.drop_oldest()
+        if freed:
+            with self.lock:
+                self.total_bytes -= freed
+        return freed
+
+    def store(self, box, messages):
+        """保存一组消息（需持有 box.lock），成功返回 True，超出空间上限返回 False"""
+        now = time.time()
+        chunks = encode_records(messages, now)
+        size = sum(len(chunk) for chunk in chunks)
+        if size > self.max_user_bytes:
+            return False
+        self.expire(box, now)
+        freed = 0
+        while box.segments and box.bytes + size > self.max_user_bytes:
+            freed += box.drop_oldest()
+        if freed:
+            print(f"🗑️ {os.path.basename(box.path)} 离线消息超过上限，已删除最早的 {freed} 字节")
+        with self.lock:
+            self.total_bytes -= freed
+            if self.total_bytes + size > self.max_total_bytes:
+                return False
+            self.total_bytes += size
+        try:
+            box.append(chunks, size, now, len(messages), self.fsync)
+        except OSError as e:
+            with self.lock:
+                self.total_bytes -= size
+            print(f"⚠️ 离线消息写入失败：{str(e)}")
+            return False
+        return True
+
+    def deliver(self, box, send_many):
+        """把全部离线消息按分段批量交给 send_many（需持有 box.lock），返回投递的消息条数（不含图片数据块）"""
+        self.expire(box, time.time())
+        delivered = 0
+        while box.segments:
+            records = box.read_oldest()
+            if records:
+                send_many([(mtype, payload, flags) for mtype, payload, flags, _ in records])
+                delivered += sum(1 for record in records if record[0] != IMAGE_DATA)
+            freed = box.drop_oldest()
+            with self.lock:
+                self.total_bytes -= freed
+        return delivered
+
+    def stats(self):
+        with self.lock:
+            return {"total_bytes": self.total_bytes, "loaded_boxes": len(self.boxes)}
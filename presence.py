@@ -0,0 +1,84 @@
+"""
+在线状态订阅（服务端使用）
+
+订阅后先收到一份快照（按名字排序分页下发），之后只收到上线/下线的增量，不再反复拉取全部名单。
+可以只订阅指定用户（如好友），也可以订阅全部在线用户。全部名单另有分页和前缀查询。
+
+每次状态变化分配一个递增的版本号，快照和增量都带版本号。增量在锁外发送，不同线程的发送顺序可能与
+发生顺序不同：客户端对每个用户只接受比已知版本更新的状态，版本不超过快照的增量直接忽略。
+"""
+from bisect import bisect_left, insort
+
+SNAPSHOT_PAGE = 500  # 快照每帧的名字数
+QUERY_LIMIT = 200  # 分页查询每页最多的名字数
+MAX_WATCH = 2000  # 指定用户订阅的名单上限
+ALL = "all"  # 订阅全部在线用户
+
+
+class Directory:
+    """有序的在线名单和订阅关系（所有方法需持有 relay.lock）"""
+
+    def __init__(self):
+        self.names = []  # 按名字排序的在线用户
+        self.version = 0
+        self.all_subscribers = set()  # 订阅全部的连接
+        self.watchers = {}  # {用户名: set(订阅了该用户的连接)}
+
+    def contains(self, name):
+        i = bisect_left(self.names, name)
+        return i < len(self.names) and self.names[i] == name
+
+    def add(self, name, version=None):
+        """用户上线，返回版本号（多进程模式下使用代理进程分配的 version）"""
+        if not self.contains(name):
+            insort(self.names, name)
+        self.version = max(self.version, version) if version is not None else self.version + 1
+        return self.version
+
+    def remove(self, name, version=None):
+        """用户下线，返回版本号"""
+        i = bisect_left(self.names, name)
+        if i < len(self.names) and self.names[i] == name:
+            del self.names[i]
+        self.version = max(self.version, version) if version is not None else self.version + 1
+        return self.version
+
+    def subscribers(self, name):
+        """关心该用户状态的连接"""
+        return list(self.all_subscribers) + list(self.watchers.get(name, ()))
+
+    def subscribe(self, conn, watch=None):
+        """订阅（替换该连接原有的订阅），watch 为 None 表示全部；返回 (当前在线的名字, 版本号)"""
+        self.unsubscribe(conn)
+        if watch is None:
+            self.all_subscribers.add(conn)
+            conn.presence = ALL
+            return list(self.names), self.version
+        watch = set(watch[:MAX_WATCH])
+        for name in watch:
+            self.watchers.setdefault(name, set()).add(conn)
+        conn.presence = watch
+        return sorted(name for name in watch if self.contains(name)), self.version
+
+    def unsubscribe(self, conn):
+        if conn.presence == ALL:
+            self.all_subscribers.discard(conn)
+        elif conn.presence:
+            for name in conn.presence:
+                conns = self.watchers.get(name)
+                if conns is not None:
+                    conns.discard(conn)
+                    if not conns:
+                        del self.watchers[name]
+        conn.presence = None
+
+    def query(self, prefix, offset, limit):
+        """按前缀分页查询，返回 (匹配总数, 本页名字)"""
+        lo = bisect_left(self.names, prefix)
+        hi = bisect_left(self.names, prefix + "\U0010ffff") if prefix else len(self.names)
+        start = min(hi, lo + offset)
+        return hi - lo, self.names[start:min(hi, start + min(limit, QUERY_LIMIT))]
+
+    def stats(self):
+        return {"online": len(self.names), "version": self.version, "all_subscribers": len(self.all_subscribers),
+                "watched_users": len(self.watchers)}
@@ -0,0 +1,337 @@
+"""
+聊天协议编解码（服务端与客户端共用）
+
+帧格式：| 负载长度 4B | 消息类型 1B | 标志位 1B | 负载 |
+新客户端连接后先发送 MAGIC，再发送 HELLO 帧；未发送 MAGIC 的连接按旧版
+“类型|目标|内容”格式处理（兼容模式）。
+"""
+import struct
+from collections import namedtuple
+
+MAGIC = b"\x00LC2"  # 新协议握手前缀（旧客户端的用户名不会以 \x00 开头）
+HEADER = struct.Struct("!IBB")
+HEADER_SIZE = HEADER.size
+MAX_PAYLOAD = 16 * 1024 * 1024
+ZERO_COPY_THRESHOLD = 64 * 1024  # 超过此大小的负载不再拼接拷贝
+BULK_CHUNK_SIZE = 1024 * 1024  # 图片数据每帧大小
+# 心跳：超过 HEARTBEAT_IDLE 秒没收到对方任何数据时发 PING，之后再过 HEARTBEAT_TIMEOUT 秒仍没有数据视为断开
+HEARTBEAT_IDLE = 30
+HEARTBEAT_TIMEOUT = 15
+
+# 消息类型
+HELLO = 1
+TEXT = 2
+FRIEND_REQ = 3
+FRIEND_REPLY = 4
+USER_QUERY = 5
+USER_LIST = 6
+IMAGE = 7
+IMAGE_DATA = 8
+OFFLINE = 9
+NOTICE = 10
+STATS = 11  # 管理员查询服务端指标（请求负载为空，回应为文本）
+SESSION = 12  # 服务端→客户端：会话令牌|是否为恢复的会话(0/1)|客户端已处理的帧数
+ACK = 13  # 客户端→服务端：已处理的帧数（不含 SESSION）
+FILE_OFFER = 14  # 发起文件传输：目标(服务端转发时为发送方)|传输编号|文件名|大小|CRC32|SHA-256
+FILE_CHUNK = 15  # 文件数据块：传输编号 16B | 偏移 8B | CRC32 4B | 数据（见 file_transfer.py）
+FILE_ACK = 16  # 接收方→发送方：传输编号|已收到的字节数|是否请求从该偏移重发(0/1)
+FILE_CANCEL = 17  # 取消/暂停传输：传输编号|原因
+GROUP = 18  # 群组管理：客户端→服务端 create/join/leave/members|群名；服务端→客户端 mine|群1,群2 或 members|群名|成员1,成员2
+GROUP_MSG = 19  # 群消息：客户端→服务端 群名|内容；服务端→成员 群名|发送者|内容
+# 在线状态（见 presence.py）：客户端→服务端 subscribe|all、subscribe|users|用户1,用户2、unsubscribe、
+# query|前缀|偏移|条数；服务端→客户端 snapshot|版本|用户1,用户2（分页，最后一页带 FLAG_LAST）、
+# online|版本|用户、offline|版本|用户、page|匹配总数|偏移|用户1,用户2
+PRESENCE = 20
+PING = 21  # 心跳：任一方发出，对方回 PONG（不参与会话编号）
+PONG = 22
+HISTORY = 23  # 服务端存档的聊天记录（见 archive.py）：客户端→服务端 list|起始时间 或 fetch|会话对象|起始|结束|游标
+
+TYPE_NAMES = {
+    HELLO: "hello",
+    TEXT: "text",
+    FRIEND_REQ: "friend_req",
+    FRIEND_REPLY: "friend_reply",
+    USER_QUERY: "user_query",
+    USER_LIST: "user_list",
+    IMAGE: "image",
+    IMAGE_DATA: "image_data",
+    OFFLINE: "offline",
+    NOTICE: "notice",
+    STATS: "stats",
+    SESSION: "session",
+    ACK: "ack",
+    FILE_OFFER: "file_offer",
+    FILE_CHUNK: "file_chunk",
+    FILE_ACK: "file_ack",
+    FILE_CANCEL: "file_cancel",
+    GROUP: "group",
+    GROUP_MSG: "group_msg",
+    PRESENCE: "presence",
+    PING: "ping",
+    PONG: "pong",
+    HISTORY: "history",
+}
+TYPE_CODES = {name: code for code, name in TYPE_NAMES.items()}
+
+# 标志位
+FLAG_LAST = 0x01  # 图片数据的最后一块
+
+Frame = namedtuple("Frame", ["type", "flags", "payload"])  # payload 为 memoryview
+
+
+class ProtocolError(Exception):
+    """协议数据错误"""
+
+
+def encode_header(mtype, length, flags=0):
+    """只编码帧头（负载随后单独发送，如 sendfile）"""
+    if length > MAX_PAYLOAD:
+        raise ProtocolError(f"帧过大：{length}")
+    return HEADER.pack(length, mtype, flags)
+
+
+def encode_frame(mtype, payload=b"", flags=0):
+    """编码一帧"""
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8")
+    return encode_header(mtype, len(payload), flags) + payload
+
+
+def encode_frame_parts(mtype, payload=b"", flags=0):
+    """编码一帧，返回待发送的缓冲列表；大负载不与帧头拼接，避免拷贝"""
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8")
+    if len(payload) < ZERO_COPY_THRESHOLD:
+        return [encode_frame(mtype, payload, flags)]
+    return [encode_header(mtype, len(payload), flags), payload]
+
+
+def pack_fields(*fields):
+    """多个字段用 | 拼接成负载（最后一个字段可包含 |）"""
+    return "|".join(str(field) for field in fields).encode("utf-8")
+
+
+def unpack_fields(payload, count):
+    """把负载拆成 count 个字段，不足的补空字符串"""
+    parts = bytes(payload).decode("utf-8", "replace").split("|", count - 1)
+    return parts + [""] * (count - len(parts))
+
+
+class FrameParser:
+    """增量帧解析器：一次喂入任意长度数据，返回其中所有完整帧
+
+    完整落在本次数据内的帧直接切片引用（不拷贝），跨越多次数据的帧在读到头部后按负载长度
+    一次性分配缓冲，之后可以用 pending_view()/commit() 让 socket.recv_into 直接写进去。
+    调用方应喂入不可变的 bytes，这样返回的负载可以安全地长期持有；reuse_buffer=True 时
+    大帧缓冲会被复用，负载只在下一次 feed/commit 之前有效。
+    """
+
+    def __init__(self, max_payload=MAX_PAYLOAD, reuse_buffer=False):
+        self.max_payload = max_payload
+        self.reuse_buffer = reuse_buffer
+        self._head = bytearray()  # 不完整的帧头
+        self._body = None  # 当前帧的负载缓冲（memoryview）
+        self._filled = 0
+        self._mtype = 0
+        self._flags = 0
+        self._spare = bytearray()  # reuse_buffer 模式下复用的缓冲
+        self._lent = False  # 本次调用已有帧引用 _spare，不能再覆盖
+
+    def _check_header(self, data, offset=0):
+        length, mtype, flags = HEADER.unpack_from(data, offset)
+        if length > self.max_payload:
+            raise ProtocolError(f"帧过大：{length}")
+        return length, mtype, flags
+
+    def _start_body(self, length, mtype, flags):
+        if self.reuse_buffer:
+            if self._lent or len(self._spare) < length:
+                self._spare = bytearray(length)
+            self._body = memoryview(self._spare)[:length]
+        else:
+            self._body = memoryview(bytearray(length))
+        self._filled = 0
+        self._mtype = mtype
+        self._flags = flags
+
+    def _finish_body(self):
+        frame = Frame(self._mtype, self._flags, self._body)
+        self._body = None
+        self._lent = self.reuse_buffer
+        return frame
+
+    def pending_view(self):
+        """当前未收完的帧负载还缺的部分，可直接传给 recv_into；没有时返回 None"""
+        if self._body is None:
+            return None
+        return self._body[self._filled:]
+
+    def commit(self, nbytes):
+        """recv_into 向 pending_view() 写入 nbytes 后调用，返回完成的帧列表"""
+        self._lent = False
+        self._filled += nbytes
+        if self._filled < len(self._body):
+            return []
+        return [self._finish_body()]
+
+    def feed(self, data):
+        """喂入数据，返回解析出的帧列表"""
+        frames = []
+        self._lent = False
+        view = memoryview(data)
+        pos = 0
+        end = len(view)
+        if self._head:
+            take = min(HEADER_SIZE - len(self._head), end)
+            self._head += view[:take]
+            pos = take
+            if len(self._head) < HEADER_SIZE:
+                return frames
+            self._start_body(*self._check_header(self._head))
+            self._head = bytearray()
+        if self._body is not None:
+            take = min(len(self._body) - self._filled, end - pos)
+            self._body[self._filled:self._filled + take] = view[pos:pos + take]
+            self._filled += take
+            pos += take
+            if self._filled < len(self._body):
+                return frames
+            frames.append(self._finish_body())
+
+        while end - pos >= HEADER_SIZE:
+            length, mtype, flags = self._check_header(view, pos)
+            if end - pos - HEADER_SIZE < length:
+                break
+            start = pos + HEADER_SIZE
+            frames.append(Frame(mtype, flags, view[start:start + length]))
+            pos = start + length
+
+        if end - pos >= HEADER_SIZE:
+            self._start_body(*self._check_header(view, pos))
+            rest = view[pos + HEADER_SIZE:]
+            self._body[:len(rest)] = rest
+            self._filled = len(rest)
+        elif pos < end:
+            self._head = bytearray(view[pos:])
+        return frames
+
+
+class LegacyParser:
+    """旧版“类型|目标|内容”格式的兼容解析器（服务端使用）
+
+    旧协议没有边界，只能按“一次 recv 就是一条消息”处理；图片数据按声明的大小切分。
+    解析结果统一转换成 Frame，方便服务端用同一套逻辑处理。
+    """
+
+    def __init__(self):
+        self._hello_done = False
+        self._image = None  # 等待 4 字节大小的图片头 (目标, 文件名)
+        self._size_buf = b""
+        self._remaining = 0  # 剩余的图片数据字节数
+
+    def feed(self, data):
+        """喂入数据，返回解析出的帧列表"""
+        frames = []
+        view = memoryview(data)
+        pos = 0
+        while pos < len(view):
+            if not self._hello_done:
+                username = bytes(view[pos:]).decode("utf-8", "replace").strip()
+                frames.append(Frame(HELLO, 0, username.encode("utf-8")))
+                self._hello_done = True
+                break
+
+            if self._remaining:
+                take = min(self._remaining, len(view) - pos)
+                self._remaining -= take
+                flags = 0 if self._remaining else FLAG_LAST
+                frames.append(Frame(IMAGE_DATA, flags, view[pos:pos + take]))
+                pos += take
+                continue
+
+            if self._image is not None:
+                take = min(4 - len(self._size_buf), len(view) - pos)
+                self._size_buf += bytes(view[pos:pos + take])
+                pos += take
+                if len(self._size_buf) == 4:
+                    img_size = struct.unpack("!I", self._size_buf)[0]
+                    target, img_filename = self._image
+                    frames.append(Frame(IMAGE, 0, pack_fields(target, img_filename, img_size)))
+                    if not img_size:
+                        frames.append(Frame(IMAGE_DATA, FLAG_LAST, b""))
+                    self._remaining = img_size
+                    self._image = None
+                    self._size_buf = b""
+                continue
+
+            msg = bytes(view[pos:]).decode("utf-8", "replace").strip()
+            pos = len(view)
+            if not msg:
+                continue
+            if msg.startswith("offline"):
+                frames.append(Frame(OFFLINE, 0, b""))
+                continue
+            parts = msg.split("|", 2)
+            if len(parts) < 3:
+                frames.append(Frame(0, 0, msg.encode("utf-8")))  # 格式错误
+                continue
+            msg_type, target, content = parts
+            if msg_type == "image":
+                self._image = (target, content)
+            elif msg_type == "user_query":
+                frames.append(Frame(USER_QUERY, 0, b""))
+            elif msg_type in ("text", "friend_req", "friend_reply"):
+                frames.append(Frame(TYPE_CODES[msg_type], 0, pack_fields(target, content)))
+        return frames
+
+
+def encode_legacy(mtype, payload=b"", flags=0):
+    """把服务端下发的消息编码成旧客户端能识别的格式，不支持的类型返回 None"""
+    if mtype == IMAGE_DATA:
+        return payload
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8")
+    if mtype == TEXT:
+        sender, content = unpack_fields(payload, 2)
+        return f"[{sender}] {content}".encode("utf-8")
+    if mtype == FRIEND_REQ:
+        return b"friend_req|" + bytes(payload)
+    if mtype == FRIEND_REPLY:
+        return b"friend_reply|" + bytes(payload)
+    if mtype == USER_LIST:
+        return b"user_list|" + bytes(payload)
+    if mtype == IMAGE:
+        sender, img_filename, img_size = unpack_fields(payload, 3)
+        return f"image|{sender}|{img_filename}".encode("utf-8") + struct.pack("!I", int(img_size))
+    if mtype == NOTICE:
+        return bytes(payload)
+    return None
+
+
+class FramedCodec:
+    """新版分帧协议"""
+    name = "framed"
+    parser_class = FrameParser
+    encode = staticmethod(encode_frame)
+    encode_parts = staticmethod(encode_frame_parts)
+
+
+class LegacyCodec:
+    """旧版管道分隔协议（兼容模式）"""
+    name = "legacy"
+    parser_class = LegacyParser
+    encode = staticmethod(encode_legacy)
+
+    @staticmethod
+    def encode_parts(mtype, payload=b"", flags=0):
+        data = encode_legacy(mtype, payload, flags)
+        return [] if data is None else [data]
+
+
+def detect_codec(data):
+    """根据连接的首批数据判断协议，返回 (编解码器, 去掉前缀后的数据)；数据不足时返回 (None, data)"""
+    if data.startswith(MAGIC):
+        return FramedCodec, data[len(MAGIC):]
+    if len(data) < len(MAGIC) and MAGIC.startswith(data):
+        return None, data
+    return LegacyCodec, data
@@ -0,0 +1,130 @@
+"""
+按用户限速（服务端使用）
+
+每个用户每类消息一个令牌桶，另有一个所有受限消息共用的总桶：桶按速率补充令牌，最多攒到突发上限，
+每处理一帧取一个令牌。桶空时算出要等多久才有令牌：
+  throttle：等待时间不超过 MAX_DELAY 时预支令牌，由读线程/读协程等这么久再处理（只拖慢该用户自己，
+            对方 TCP 缓冲满后客户端自然放慢）；超过则丢弃
+  reject：直接丢弃
+丢弃时给发送方提示（每 NOTICE_INTERVAL 秒最多一次）。不占用全局锁，一个用户狂发在线查询、文字消息
+也只会在自己的连接上排队，不会挤占其他人的转发。
+数据块、确认和心跳帧（图片数据、文件块、ACK、PING/PONG 等）不限速，它们已有发送窗口和发送队列上限。
+"""
+import threading
+import time
+
+from protocol import (
+    FILE_OFFER, FRIEND_REPLY, FRIEND_REQ, GROUP, GROUP_MSG, HISTORY, IMAGE, PRESENCE, STATS, TEXT, USER_QUERY,
+)
+
+POLICIES = ("throttle", "reject")
+MAX_DELAY = 1.0  # throttle 策略下单帧最多等待的秒数
+NOTICE_INTERVAL = 5.0  # 同一用户两次限速提示的最短间隔（秒）
+SWEEP_INTERVAL = 60.0  # 清理长时间未使用的令牌桶的间隔（秒）
+TOTAL = "total"
+# 类别 → (消息类型, 每秒令牌数, 突发上限, 提示用的名称)；类型 0 为旧版客户端格式错误的消息
+CLASSES = {
+    "message": ((TEXT, GROUP_MSG, IMAGE, FILE_OFFER, 0), 20.0, 60, "消息"),
+    "social": ((FRIEND_REQ, FRIEND_REPLY, GROUP), 1.0, 10, "好友/群组操作"),
+    "query": ((USER_QUERY, PRESENCE, STATS), 2.0, 10, "在线查询"),
+    "history": ((HISTORY,), 20.0, 50, "聊天记录同步"),
+}
+TOTAL_LIMIT = (30.0, 100)  # 所有受限消息合计
+
+
+def parse_limit(text):
+    """解析 --rate-limit 的“类别=速率/突发”（突发省略时为速率的 2 倍），返回 (类别, 速率, 突发)"""
+    name, _, value = text.partition("=")
+    name = name.strip()
+    if name not in CLASSES and name != TOTAL:
+        raise ValueError(f"未知的限速类别：{name}（可选 {', '.join(list(CLASSES) + [TOTAL])}）")
+    rate, _, burst = value.partition("/")
+    rate = float(rate)
+    burst = float(burst) if burst else rate * 2
+    if rate <= 0 or burst < 1:
+        raise ValueError(f"限速参数无效：{text}（速率须大于 0，突发至少为 1）")
+    return name, rate, burst
+
+
+class TokenBucket:
+    """令牌桶（tokens 可以为负，表示已预支给正在等待的帧）"""
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def wait(self, now):
+        """补充令牌，返回还要等多久才有一个令牌（秒）"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class UserLimits:
+    """一个用户的各类令牌桶（只由该用户的读线程/读协程使用）"""
+
+    def __init__(self, limits, now):
+        self.buckets = {name: TokenBucket(rate, burst, now) for name, (rate, burst) in limits.items()}
+        self.total = self.buckets.pop(TOTAL)
+        self.notified = 0.0  # 上次提示的时刻
+        self.used = now
+
+
+class RateLimiter:
+    """全部用户的令牌桶"""
+
+    def __init__(self, limits=None, policy="throttle"):
+        self.limits = {name: (rate, burst) for name, (_, rate, burst, _) in CLASSES.items()}
+        self.limits[TOTAL] = TOTAL_LIMIT
+        self.limits.update(limits or {})
+        self.policy = policy
+        self.class_of = {mtype: name for name, (types, _, _, _) in CLASSES.items() for mtype in types}
+        # 闲置超过这么久的桶已经补满，清理后再用时新建的桶与原来无异
+        self.idle_ttl = max(burst / rate for rate, burst in self.limits.values())
+        self.users = {}  # {用户名: UserLimits}
+        self.lock = threading.Lock()  # 只保护 users 字典
+        self.swept = time.monotonic()
+
+    def user(self, username):
+        """用户的令牌桶（连接登录后第一次限速时取一次，之后缓存在连接上）"""
+        now = time.monotonic()
+        with self.lock:
+            if now - self.swept > SWEEP_INTERVAL:
+                self.swept = now
+                for name in [name for name, limits in self.users.items() if now - limits.used > self.idle_ttl]:
+                    del self.users[name]
+            limits = self.users.get(username)
+            if limits is None:
+                limits = self.users[username] = UserLimits(self.limits, now)
+            return limits
+
+    def check(self, limits, mtype):
+        """取一个令牌，返回 (类别, 需要等待的秒数)；不限速的类型类别为 None，要丢弃时等待时间为 None"""
+        name = self.class_of.get(mtype)
+        if name is None:
+            return None, 0.0
+        now = time.monotonic()
+        limits.used = now
+        bucket = limits.buckets[name]
+        delay = max(bucket.wait(now), limits.total.wait(now))
+        if delay and (self.policy == "reject" or delay > MAX_DELAY):
+            return name, None
+        bucket.tokens -= 1
+        limits.total.tokens -= 1
+        return name, delay
+
+    def should_notify(self, limits):
+        """距上次提示超过 NOTICE_INTERVAL 时返回 True"""
+        now = time.monotonic()
+        if now - limits.notified < NOTICE_INTERVAL:
+            return False
+        limits.notified = now
+        return True
+
+    def stats(self):
+        with self.lock:
+            users = len(self.users)
+        return {"policy": self.policy, "users": users,
+                "limits": {name: f"{rate:g}/{burst:g}" for name, (rate, burst) in self.limits.items()}}
@@ -0,0 +1,860 @@
+"""
+消息转发核心（线程模式与协程模式共用）
+
+各模式只负责收发字节，把解析出的帧交给 handle_frame；连接对象实现 write_many/close/abort。
+转发时只在查找目标连接时持有 lock，消息放入目标的发送队列后由其专属写线程/协程发出，
+慢速或正在接收大图片的用户不会拖住其他人。新版客户端的连接绑定一个会话（session.py），
+发给它的帧经会话编号后再放入发送队列，断线重连时可以只回放缺失的部分。
+文件传输（file_transfer.py）的数据块按传输编号直接转给对方，服务端不缓存文件内容。
+群消息（groups.py）经 fan_out 扇出：每种协议只编码一次，所有成员的发送队列共享同一份数据。
+在线状态（presence.py）按订阅推送快照和上线/下线增量，代替反复拉取全部在线名单。
+连接登记到心跳时间轮（timer_wheel.py）：新版客户端长时间没有数据时发 PING，仍无回应则断开；
+旧版客户端不认识 PING，超过 LEGACY_IDLE_TIMEOUT 没有数据直接断开。
+每帧处理前先经 admit 按用户限速（rate_limit.py），狂发消息的用户只会在自己的连接上排队或被丢弃。
+转发成功的文字消息和群消息写入存档（archive.py），客户端可用 HISTORY 分页取回，换设备也能同步聊天记录。
+多进程模式（cluster.py）下设置 cluster：其他工作进程上的用户经代理进程转发，在线名单和群组是代理进程的副本。
+"""
+import time
+from collections import deque
+
+import metrics
+from file_transfer import CANCEL_OFFLINE, CHUNK_HEADER
+from groups import GroupRegistry
+from presence import ALL, SNAPSHOT_PAGE, Directory
+from rate_limit import CLASSES
+from protocol import (
+    ACK, FILE_ACK, FILE_CANCEL, FILE_CHUNK, FILE_OFFER, FLAG_LAST, FRIEND_REPLY, FRIEND_REQ, GROUP, GROUP_MSG,
+    HEADER_SIZE, HEARTBEAT_IDLE, HEARTBEAT_TIMEOUT, HELLO, HISTORY, IMAGE, IMAGE_DATA, NOTICE, OFFLINE, PING, PONG,
+    PRESENCE, SESSION, STATS, TEXT, TYPE_NAMES, USER_LIST, USER_QUERY, pack_fields, unpack_fields,
+)
+from session import Session
+from timer_wheel import TimerWheel
+
+online_users = {}  # {用户名: Connection}
+sessions = {}  # {用户名: Session}，包括断线后等待恢复的会话
+detached_sessions = {}  # {用户名: Session}，断线后等待恢复的会话
+directory = Directory()  # 有序在线名单与在线状态订阅（受 lock 保护）
+lock = metrics.TimedLock("registry")  # 只保护 online_users、sessions、directory 的查找与增删
+STORABLE = (TEXT, FRIEND_REQ, FRIEND_REPLY, IMAGE, IMAGE_DATA, GROUP_MSG)  # 会话作废时转存离线消息的类型
+
+# 慢速接收方：发送队列超过 outbox_limit 字节时按 backpressure 策略处理
+#   block：发送方等待对方队列腾出空间，超过 BLOCK_TIMEOUT 秒仍未腾出则断开对方
+#   drop_oldest：丢弃对方队列中最早的消息
+#   disconnect：直接断开对方
+BACKPRESSURE_POLICIES = ("block", "drop_oldest", "disconnect")
+OUTBOX_LIMIT = 16 * 1024 * 1024
+BLOCK_TIMEOUT = 5.0
+backpressure = "block"
+outbox_limit = OUTBOX_LIMIT
+
+# 写合并：写线程/写协程每次把队列中积攒的多组数据合并成一次写（线程模式用 sendmsg 分散写），
+# 每次最多 COALESCE_BYTES；连接开启 TCP_NODELAY，小消息不必等 Nagle 算法。--no-coalesce 恢复逐块发送（对比测试用）
+COALESCE_BYTES = 256 * 1024
+coalesce = True
+offline = None  # 离线消息队列（OfflineQueue），由服务端启动时设置，None 表示不保存
+groups = GroupRegistry()  # 群组名单，服务端启动时替换为保存到文件的实例
+archive = None  # 消息存档（archive.Archive），由服务端启动时设置，None 表示不存档
+limiter = None  # 按用户限速（rate_limit.RateLimiter），由服务端启动时设置，None 表示不限速
+heartbeats = TimerWheel()  # 各连接的心跳期限
+LEGACY_IDLE_TIMEOUT = 300  # 旧版客户端不认识 PING：这么久没有收到任何数据就断开（即原来的 socket 超时）
+cluster = None  # 多进程模式下工作进程与代理进程的连接（cluster.WorkerLink），None 表示单进程
+admin_users = set()  # 可查看 STATS 的用户（本机连接总是允许）
+LOCAL_ADDRS = ("127.0.0.1", "::1", "localhost")
+transfers = {}  # {传输编号: {"sender", "target", "size", "touched"}}，文件传输的路由表（受 lock 保护）
+TRANSFER_TTL = 24 * 3600  # 超过这么久没有进展的传输从路由表中清除（秒）
+MAX_TRANSFERS_PER_USER = 32
+MAX_IMAGE_SIZE = 64 * 1024 * 1024  # 图片收齐后才转发，要整张缓存在服务端：声明的大小超过上限直接拒绝
+FRAME_COUNTERS = {code: f"frames.{name}" for code, name in TYPE_NAMES.items()}
+HANDLE_TIMERS = {code: f"handle.{name}" for code, name in TYPE_NAMES.items()}
+
+
+class Connection:
+    """客户端连接（与 I/O 模型无关的部分）"""
+
+    def __init__(self, addr, codec):
+        self.addr = addr
+        self.codec = codec
+        self.parser = codec.parser_class()
+        self.username = None
+        self.image = None  # 正在上传的图片：{"target", "filename", "size", "chunks", "recv_size"}
+        self.outbox = deque()  # 待发送的消息组 (数据块列表, 字节数)，一组内的数据不会被拆开丢弃
+        self.outbox_bytes = 0  # 尚未发出的字节数（含写线程已取走但未发完的部分）
+        self.closed = False
+        self.session = None  # 新版客户端的会话
+        self.clean_exit = False  # 客户端主动下线（不保留会话）
+        self.logged_out = False  # 已经注销过（服务端关闭时先行注销，读线程/读协程结束时不再重复）
+        self.presence = None  # 在线状态订阅：None、presence.ALL 或订阅的用户名集合
+        self.last_seen = time.monotonic()  # 最近一次收到数据的时刻，由读线程/读协程更新
+        self.limits = None  # 该用户的令牌桶（rate_limit.UserLimits），第一次限速时取
+
+    def send(self, mtype, payload=b"", flags=0):
+        """按该连接的协议编码，放入发送队列"""
+        self.send_many([(mtype, payload, flags)])
+
+    def send_many(self, messages, encoded=None):
+        """把多条消息一次性放入发送队列，中间不会插入其他消息（有会话时先经会话编号）"""
+        if self.session is not None:
+            self.session.push(messages, encoded)
+        else:
+            self.write_encoded(messages, encoded)
+
+    def write_encoded(self, messages, encoded=None):
+        """按该连接的协议编码后放入发送队列
+
+        群发时传入同一个 encoded 字典（{协议名: 数据块列表}），每种协议只编码一次，
+        各连接的发送队列引用同一份数据（数据块列表放入队列后不会再被修改）。
+        """
+        chunks = encoded.get(self.codec.name) if encoded is not None else None
+        if chunks is None:
+            chunks = []
+            for mtype, payload, flags in messages:
+                chunks.extend(self.codec.encode_parts(mtype, payload, flags))
+            if encoded is not None:
+                encoded[self.codec.name] = chunks
+        if chunks:
+            metrics.inc("bytes.out", sum(len(chunk) for chunk in chunks))
+            self.write_many(chunks)
+
+    def notice(self, text):
+        """发送提示文字"""
+        self.send(NOTICE, text)
+
+    def write_many(self, chunks):
+        """作为一组追加到发送队列并唤醒写线程/协程，队列满时按 backpressure 策略处理"""
+        raise NotImplementedError
+
+    def close(self):
+        """发完队列中剩余的数据后关闭连接"""
+        raise NotImplementedError
+
+    def abort(self):
+        """丢弃队列中的数据，立即断开（用于处理慢速接收方）"""
+        raise NotImplementedError
+
+    def over_limit(self, size):
+        """再放入 size 字节是否超出队列上限（队列为空时总能放下一组）"""
+        return self.outbox_bytes > 0 and self.outbox_bytes + size > outbox_limit
+
+    def drop_oldest(self, size):
+        """丢弃最早的消息组直到放得下（需持有队列锁）"""
+        while self.outbox and self.over_limit(size):
+            _, dropped = self.outbox.popleft()
+            self.outbox_bytes -= dropped
+            metrics.inc("backpressure.dropped")
+        if self.session is not None:
+            self.session.resumable = False  # 丢了帧，编号对不上，不能再恢复
+
+    def slow_consumer(self, reason):
+        """断开慢速接收方"""
+        metrics.inc("backpressure.disconnected")
+        print(f"🐢 {self.username or self.addr} 接收过慢（{reason}），断开连接 | 积压 {self.outbox_bytes} 字节")
+        self.abort()
+
+
+def find_user(username):
+    """查找在线用户的连接，不在线返回 None"""
+    with lock:
+        return online_users.get(username)
+
+
+def login(conn, username, token=None, handled=0):
+    """登记上线用户，用户名被占用时返回 False
+
+    token 不为 None 表示客户端支持会话恢复：建立新会话，或带着有效令牌重连时恢复原会话
+    （接管仍未断开的旧连接），只回放客户端没处理的帧。
+    """
+    sweep_sessions()
+    framed = token is not None
+    takeover = framed and bool(token)
+    replaced = None
+    with lock:
+        current = online_users.get(username)
+        session = sessions.get(username)
+        resume = takeover and session is not None and not session.expired() and session.can_resume(token, handled)
+        if (current is not None and not resume) or (cluster is not None and not cluster.may_claim(username, takeover)):
+            metrics.inc("connections.rejected")
+            return False
+        if framed and not resume:
+            replaced = session
+            session = sessions[username] = Session(username)
+        if framed:
+            detached_sessions.pop(username, None)
+            conn.session = session  # 先绑定会话，之后发给该连接的帧都会编号
+        conn.username = username
+        online_users[username] = conn
+        # 接管旧连接不算重新上线；多进程模式下由代理进程确认后广播上线
+        version = directory.add(username) if current is None and cluster is None else None
+    if version is not None:
+        publish_presence("online", username, version)
+    if current is None and cluster is not None:
+        cluster.claim(username, token or "", session.token if framed else "", framed)
+    if current is not None:
+        current.close()  # 旧连接（如切换网络前的连接）被新连接接管
+    if replaced is not None:
+        discard_session(replaced)
+    metrics.inc("connections.login")
+    if not framed:
+        print(f"✅ {username} 上线 | 地址：{conn.addr} | 在线数：{len(online_users)}")
+        return True
+    replayed = session.attach(conn, handled if resume else 0,
+                              (SESSION, pack_fields(session.token, int(resume), handled if resume else 0), 0))
+    if resume:
+        metrics.inc("session.resumed")
+        metrics.inc("session.replayed", replayed)
+        print(f"🔄 {username} 恢复会话，补发 {replayed} 帧 | 地址：{conn.addr} | 在线数：{len(online_users)}")
+    else:
+        print(f"✅ {username} 上线 | 地址：{conn.addr} | 在线数：{len(online_users)}")
+    return True
+
+
+def logout(conn):
+    """注销下线用户；新版客户端意外断开时保留会话等待恢复（同一连接只处理一次）"""
+    if not conn.username:
+        print(f"🔌 {conn.addr} 下线")
+        return
+    heartbeats.cancel(conn)
+    session = conn.session
+    version = None
+    with lock:
+        if conn.logged_out:
+            return
+        conn.logged_out = True
+        directory.unsubscribe(conn)
+        replaced = online_users.get(conn.username) is not conn
+        if replaced:
+            session = None  # 已被新连接接管
+        else:
+            del online_users[conn.username]
+            if cluster is None:
+                version = directory.remove(conn.username)
+        if session is not None and sessions.get(conn.username) is session:
+            if conn.clean_exit:
+                del sessions[conn.username]
+            else:
+                session.detach(conn)
+                detached_sessions[conn.username] = session
+    if version is not None:
+        publish_presence("offline", conn.username, version)
+    if cluster is not None and not replaced:
+        cluster.release(conn.username)
+    if replaced:
+        print(f"🔁 {conn.username} 旧连接已关闭 | 地址：{conn.addr}")
+    else:
+        print(f"🔌 {conn.username} 下线 | 在线数：{len(online_users)}")
+
+
+def discard_session(session):
+    """会话作废：未确认的消息转存为离线消息（可能与客户端已收到的重复，宁多勿漏）"""
+    messages = [message for message in session.close() if message[0] in STORABLE]
+    while messages and messages[0][0] == IMAGE_DATA:
+        messages.pop(0)  # 开头的图片头已被确认，残缺的数据块无法单独投递
+    if not messages or offline is None or not offline.known(session.username):
+        return
+    box = offline.mailbox(session.username)
+    with box.lock:
+        offline.store(box, messages)
+    metrics.inc("session.discarded_messages", len(messages))
+
+
+def sweep_sessions():
+    """清理超过恢复时间的会话"""
+    now = time.time()
+    with lock:
+        expired = [session for session in detached_sessions.values() if session.expired(now)]
+        for session in expired:
+            del detached_sessions[session.username]
+            if sessions.get(session.username) is session:
+                del sessions[session.username]
+    for session in expired:
+        discard_session(session)
+
+
+def detached_session(username):
+    """断线后仍在恢复时间内的会话，没有返回 None"""
+    with lock:
+        session = detached_sessions.get(username)
+        if session is None or not session.expired():
+            return session
+    sweep_sessions()
+    return None
+
+
+def evict(username):
+    """多进程模式：用户已在其他工作进程上线，关闭本进程的旧连接并作废旧会话（未确认的消息转存离线）"""
+    with lock:
+        conn = online_users.get(username)
+        session = sessions.pop(username, None)
+        detached_sessions.pop(username, None)
+    if conn is not None:
+        conn.clean_exit = True
+        conn.close()
+    if session is not None:
+        discard_session(session)
+
+
+def reject(username):
+    """多进程模式：代理进程裁定用户名已在其他工作进程上线，断开本进程刚登录的连接"""
+    conn = find_user(username)
+    if conn is None:
+        return
+    metrics.inc("connections.rejected")
+    conn.notice("用户名已被占用")
+    conn.clean_exit = True
+    conn.close()
+    print(f"⚠️ {conn.addr} 尝试使用重复用户名：{username}")
+
+
+def deliver(target, messages, encoded=None, remote=True):
+    """把一组消息交给目标用户：在线时放入其发送队列，登录过但不在线时存入离线队列
+
+    返回 "online"、"offline"、"full"（离线消息空间已满）或 None（用户不存在）。
+    encoded 见 Connection.write_encoded。remote=False 表示不再转给其他工作进程（用于处理转来的消息）。
+    """
+    target_conn = find_user(target)
+    if target_conn is None:
+        session = detached_session(target)
+        if session is not None and session.push(messages, encoded):
+            return "online"  # 对方断线重连中，恢复会话后补发
+        if remote and cluster is not None and cluster.is_remote(target):
+            cluster.route([target], messages)
+            return "online"
+    if target_conn is None and offline is not None and offline.known(target):
+        box = offline.mailbox(target)
+        with box.lock:  # 与上线时的离线投递互斥，保证离线消息先于新消息送达
+            target_conn = find_user(target)
+            if target_conn is None:
+                if offline.store(box, messages):
+                    metrics.inc("offline.stored")
+                    return "offline"
+                metrics.inc("offline.rejected")
+                return "full"
+    if target_conn is None:
+        metrics.inc("relay.target_offline")
+        return None
+    target_conn.send_many(messages, encoded)
+    return "online"
+
+
+def fan_out(targets, messages, exclude=None):
+    """一组消息发给多个用户，返回 {投递结果: 人数}
+
+    在线用户在一次加锁中全部取出，每种协议只编码一次；不在线的逐个走 deliver（恢复中的会话或离线保存）。
+    多进程模式下在其他工作进程上的成员合并成一次转发，由代理进程按进程分组。
+    """
+    encoded = {}
+    with lock:
+        conns = [(target, online_users.get(target)) for target in targets if target != exclude]
+    counts = {}
+    remote = []
+    for target, target_conn in conns:
+        if target_conn is not None:
+            target_conn.send_many(messages, encoded)
+            status = "online"
+        elif cluster is not None and cluster.is_remote(target):
+            remote.append(target)
+            status = "online"
+        else:
+            status = deliver(target, messages, encoded)
+        counts[status] = counts.get(status, 0) + 1
+    if remote:
+        cluster.route(remote, messages, store=True)
+    metrics.inc("group.deliveries", len(conns))
+    return counts
+
+
+def relay_to(target, mtype, payload):
+    """转发一条消息，返回值同 deliver"""
+    status = deliver(target, [(mtype, payload, 0)])
+    if status == "online":
+        metrics.inc(f"relay.{TYPE_NAMES[mtype]}")
+    return status
+
+
+def notify_delivery(conn, target, status, sent_text=None):
+    """按投递结果给发送方提示"""
+    if status == "online":
+        if sent_text:
+            conn.notice(sent_text)
+    elif status == "offline":
+        conn.notice(f"{target} 不在线，已离线保存，对方上线后送达")
+    elif status == "full":
+        conn.notice(f"{target} 不在线，离线消息空间已满，发送失败")
+    else:
+        conn.notice(f"{target} 不在线/不存在")
+
+
+def login_with_offline(conn, username, token=None, handled=0):
+    """登记上线并投递离线消息（持有信箱锁，期间发给该用户的消息排在离线消息之后）"""
+    offline.register(username)
+    box = offline.mailbox(username)
+    with box.lock:
+        if not login(conn, username, token, handled):
+            return False
+        count = offline.deliver(box, conn.send_many)
+        if count:
+            metrics.inc("offline.delivered", count)
+            conn.notice(f"以上为 {count} 条离线消息")
+            print(f"📬 {username} 收到 {count} 条离线消息")
+    return True
+
+
+def handle_hello(conn, frame):
+    """处理握手帧，成功返回 True"""
+    if frame.type != HELLO:
+        conn.notice("未接收到用户名")
+        return False
+    fields = bytes(frame.payload).decode("utf-8", "replace").split("|", 2)
+    if conn.codec.name == "framed" and len(fields) > 1:
+        # 支持会话恢复的客户端发送“用户名|令牌|已处理帧数”，新会话的令牌为空
+        username, token, handled = fields + [""] * (3 - len(fields))
+    else:
+        username, token, handled = bytes(frame.payload).decode("utf-8", "replace"), None, "0"
+    username = username.strip()
+    if not username:
+        print(f"❌ {conn.addr} 连接初始化异常：未接收到用户名")
+        return False
+    handled = int(handled) if handled.isdigit() else 0
+    if offline is None:
+        ok = login(conn, username, token, handled)
+    else:
+        ok = login_with_offline(conn, username, token, handled)
+    if not ok:
+        conn.notice("用户名已被占用")
+        print(f"⚠️ {conn.addr} 尝试使用重复用户名：{username}")
+        return False
+    mine = groups.groups_of(username)
+    if mine and conn.codec.name == "framed":
+        conn.send(GROUP, pack_fields("mine", ",".join(mine)))
+    if conn.codec.name == "framed":
+        heartbeats.schedule(conn, conn.last_seen + HEARTBEAT_IDLE)
+    else:  # 旧版客户端不认识 PING，只做空闲超时检查
+        heartbeats.schedule(conn, conn.last_seen + LEGACY_IDLE_TIMEOUT)
+    return True
+
+
+def handle_image(conn, frame):
+    """图片头：记录目标，等待图片数据"""
+    target_user, img_filename, img_size = unpack_fields(frame.payload, 3)
+    reachable = (find_user(target_user) is not None or (cluster is not None and cluster.is_remote(target_user))
+                 or (offline is not None and offline.known(target_user)))
+    size = int(img_size or 0)
+    if not reachable:
+        conn.notice(f"{target_user} 不在线/不存在")
+    elif not 0 < size <= MAX_IMAGE_SIZE:
+        conn.notice(f"图片大小无效或超过上限（{MAX_IMAGE_SIZE // (1024 * 1024)} MB），未转发")
+        reachable = False
+    # 目标为 None 时只数字节、不缓存，数据收完即丢弃
+    conn.image = {"target": target_user if reachable else None, "filename": img_filename,
+                  "size": size, "chunks": [], "recv_size": 0}
+
+
+def handle_image_data(conn, frame):
+    """图片数据：收齐后整体放入目标的发送队列（缓存不超过声明的大小）"""
+    image = conn.image
+    if image is None:
+        return
+    image["recv_size"] += len(frame.payload)
+    if image["target"] is not None:
+        if image["recv_size"] > image["size"]:
+            image["target"] = None
+            image["chunks"] = []
+            conn.notice("图片数据超出声明的大小，未转发")
+        else:
+            image["chunks"].append(frame.payload)
+    if not frame.flags & FLAG_LAST and image["recv_size"] < image["size"]:
+        return
+
+    conn.image = None
+    if image["target"] is None:
+        return
+    target_user = image["target"]
+    messages = [(IMAGE, pack_fields(conn.username, image["filename"], image["recv_size"]), 0)]
+    last = len(image["chunks"]) - 1
+    messages += [(IMAGE_DATA, chunk, FLAG_LAST if i == last else 0) for i, chunk in enumerate(image["chunks"])]
+    status = deliver(target_user, messages)
+    if status != "online":
+        notify_delivery(conn, target_user, status)
+        return
+    metrics.inc("relay.image")
+    metrics.inc("image.bytes", image["recv_size"])
+    if image["recv_size"] == image["size"]:
+        conn.notice("图片转发成功")
+    else:
+        conn.notice("图片转发不完整")
+    print(f"📷 {conn.username} 向 {target_user} 发送图片：{image['filename']}")
+
+
+# ---------------------- 文件传输 ----------------------
+def send_online(target, messages, remote=True):
+    """只投递给在线（或断线重连中）的用户，不存离线消息，成功返回 True"""
+    target_conn = find_user(target)
+    if target_conn is not None:
+        target_conn.send_many(messages)
+        return True
+    session = detached_session(target)
+    if session is not None and session.push(messages):
+        return True
+    if remote and cluster is not None and cluster.is_remote(target):
+        cluster.route([target], messages)
+        return True
+    return False
+
+
+def route_transfer(conn, transfer_id, role):
+    """按传输编号查找对方（conn 必须是该传输的 role 一方），没有返回 None"""
+    with lock:
+        transfer = transfers.get(transfer_id)
+        if transfer is None or transfer[role] != conn.username:
+            return None
+        transfer["touched"] = time.time()
+        return transfer["target" if role == "sender" else "sender"]
+
+
+def handle_file_offer(conn, frame):
+    """发起/重新发起文件传输：登记路由并转给接收方，对方不在线时让发送方暂停"""
+    target, transfer_id, filename, size, crc, digest = unpack_fields(frame.payload, 6)
+    if len(transfer_id) != 32 or not size.isdigit() or not crc.isdigit():
+        conn.notice("文件传输请求格式错误")
+        return
+    target_conn = find_user(target)
+    legacy = target_conn.codec.name != "framed" if target_conn is not None else (
+        cluster is not None and not cluster.is_framed(target))
+    if legacy:
+        conn.send(FILE_CANCEL, pack_fields(transfer_id, f"{target} 的客户端版本不支持文件传输"))
+        return
+    now = time.time()
+    with lock:
+        for stale in [tid for tid, transfer in transfers.items() if now - transfer["touched"] > TRANSFER_TTL]:
+            del transfers[stale]
+        transfer = resumed = transfers.get(transfer_id)
+        if transfer is None:
+            if sum(1 for t in transfers.values() if t["sender"] == conn.username) >= MAX_TRANSFERS_PER_USER:
+                transfer_id = None
+            else:
+                transfers[transfer_id] = {"sender": conn.username, "target": target, "size": int(size),
+                                          "touched": now}
+        elif transfer["sender"] != conn.username or transfer["target"] != target:
+            transfer_id = None
+        else:
+            transfer["touched"] = now
+    if transfer_id is None:
+        conn.notice("同时进行的文件传输过多或传输编号冲突")
+        return
+    offer = pack_fields(conn.username, transfer_id, filename, size, crc, digest)
+    if not send_online(target, [(FILE_OFFER, offer, 0)]):
+        conn.send(FILE_CANCEL, pack_fields(transfer_id, CANCEL_OFFLINE))
+        return
+    if resumed is None:
+        print(f"📁 {conn.username} 向 {target} 发送文件：{filename}（{size} 字节）")
+
+
+def handle_file_chunk(conn, frame):
+    """文件数据块：原样转给接收方"""
+    if len(frame.payload) < CHUNK_HEADER.size:
+        return
+    transfer_id = bytes(frame.payload[:16]).hex()
+    target = route_transfer(conn, transfer_id, "sender")
+    if target is None:
+        conn.send(FILE_CANCEL, pack_fields(transfer_id, "传输已失效"))
+    elif send_online(target, [(FILE_CHUNK, frame.payload, 0)]):
+        metrics.inc("file.bytes", len(frame.payload) - CHUNK_HEADER.size)
+    else:
+        conn.send(FILE_CANCEL, pack_fields(transfer_id, CANCEL_OFFLINE))
+
+
+def handle_file_ack(conn, frame):
+    """接收方的确认/重发请求：转给发送方，全部收到后清除路由"""
+    transfer_id, offset, resend = unpack_fields(frame.payload, 3)
+    sender = route_transfer(conn, transfer_id, "target")
+    if sender is None:
+        return
+    if not send_online(sender, [(FILE_ACK, frame.payload, 0)]):
+        conn.send(FILE_CANCEL, pack_fields(transfer_id, CANCEL_OFFLINE))
+        return
+    finish_transfer(transfer_id, offset, resend)
+
+
+def finish_transfer(transfer_id, offset, resend):
+    """确认已收到全部数据时清除路由"""
+    with lock:
+        transfer = transfers.get(transfer_id)
+        if transfer is not None and resend != "1" and offset.isdigit() and int(offset) >= transfer["size"]:
+            del transfers[transfer_id]
+            metrics.inc("file.completed")
+
+
+def handle_file_cancel(conn, frame):
+    """任一方取消：转给另一方并清除路由"""
+    transfer_id, _ = unpack_fields(frame.payload, 2)
+    with lock:
+        transfer = transfers.get(transfer_id)
+        if transfer is None or conn.username not in (transfer["sender"], transfer["target"]):
+            return
+        del transfers[transfer_id]
+    other = transfer["target"] if conn.username == transfer["sender"] else transfer["sender"]
+    send_online(other, [(FILE_CANCEL, frame.payload, 0)])
+
+
+def track_transfer(target, mtype, payload):
+    """多进程模式：其他工作进程转来的传输帧同步到本进程的路由表（发送方和接收方可能不在同一进程）"""
+    if mtype == FILE_OFFER:
+        sender, transfer_id, _, size, _, _ = unpack_fields(payload, 6)
+        with lock:
+            transfer = transfers.get(transfer_id)
+            if transfer is None:
+                transfers[transfer_id] = {"sender": sender, "target": target, "size": int(size or 0),
+                                          "touched": time.time()}
+            else:
+                transfer["touched"] = time.time()
+    elif mtype == FILE_ACK:
+        finish_transfer(*unpack_fields(payload, 3))
+    elif mtype == FILE_CANCEL:
+        transfer_id, _ = unpack_fields(payload, 2)
+        with lock:
+            transfers.pop(transfer_id, None)
+
+
+# ---------------------- 在线状态 ----------------------
+def publish_presence(kind, username, version):
+    """把一次上线/下线通知订阅者（只编码一次）"""
+    with lock:
+        conns = directory.subscribers(username)
+    if not conns:
+        return
+    messages = [(PRESENCE, pack_fields(kind, version, username), 0)]
+    encoded = {}
+    for conn in conns:
+        conn.send_many(messages, encoded)
+    metrics.inc("presence.deltas", len(conns))
+
+
+def handle_presence(conn, frame):
+    """订阅/取消订阅在线状态，或分页查询在线名单"""
+    action, arg, rest, limit = unpack_fields(frame.payload, 4)
+    if action == "subscribe":
+        watch = None if arg == ALL else [name for name in rest.split(",") if name]
+        with lock:
+            names, version = directory.subscribe(conn, watch)
+        pages = [names[i:i + SNAPSHOT_PAGE] for i in range(0, len(names), SNAPSHOT_PAGE)] or [[]]
+        last = len(pages) - 1
+        conn.send_many([(PRESENCE, pack_fields("snapshot", version, ",".join(page)), FLAG_LAST if i == last else 0)
+                        for i, page in enumerate(pages)])
+    elif action == "unsubscribe":
+        with lock:
+            directory.unsubscribe(conn)
+    elif action == "query":
+        offset = int(rest) if rest.isdigit() else 0
+        with lock:
+            total, names = directory.query(arg, offset, int(limit) if limit.isdigit() else SNAPSHOT_PAGE)
+        conn.send(PRESENCE, pack_fields("page", total, offset, ",".join(names)))
+    else:
+        conn.notice(f"未知的在线状态操作：{action}")
+
+
+# ---------------------- 心跳 ----------------------
+def check_heartbeats(now=None):
+    """每个刻度由服务端调用一次：空闲的连接发 PING，PING 之后仍没有任何数据的断开；旧版客户端空闲过久直接断开"""
+    now = time.monotonic() if now is None else now
+    for conn in heartbeats.expire(now):
+        if conn.closed:
+            continue
+        idle = now - conn.last_seen
+        if conn.codec.name != "framed":
+            if idle < LEGACY_IDLE_TIMEOUT:
+                heartbeats.schedule(conn, conn.last_seen + LEGACY_IDLE_TIMEOUT)
+            else:
+                metrics.inc("heartbeat.evicted")
+                print(f"💀 {conn.username} 超过 {int(idle)} 秒没有任何数据（旧版客户端），断开连接")
+                conn.abort()
+        elif idle < HEARTBEAT_IDLE:
+            heartbeats.schedule(conn, conn.last_seen + HEARTBEAT_IDLE)  # 期间收到过数据，顺延
+        elif idle < HEARTBEAT_IDLE + HEARTBEAT_TIMEOUT:
+            if not conn.over_limit(HEADER_SIZE):  # 队列已满时不排队等待，只等对方的数据
+                conn.send(PING)
+                metrics.inc("heartbeat.pings")
+            heartbeats.schedule(conn, conn.last_seen + HEARTBEAT_IDLE + HEARTBEAT_TIMEOUT)
+        else:
+            metrics.inc("heartbeat.evicted")
+            print(f"💀 {conn.username} 超过 {int(idle)} 秒没有响应，断开连接")
+            conn.abort()
+
+
+# ---------------------- 群组 ----------------------
+def handle_group(conn, frame):
+    """群组管理：创建/加入/退出后回复自己所在的群组，members 回复成员名单"""
+    action, name = unpack_fields(frame.payload, 2)
+    name = name.strip()
+    if action == "members":
+        members = groups.members(name)
+        if members is None:
+            conn.notice(f"群组 {name} 不存在")
+        else:
+            conn.send(GROUP, pack_fields("members", name, ",".join(members)))
+        return
+    if cluster is not None:
+        cluster.group_op(conn.username, action, name)  # 由代理进程修改名单并回复
+        return
+    if action == "create":
+        error = groups.create(name, conn.username)
+    elif action == "join":
+        error = groups.join(name, conn.username)
+    elif action == "leave":
+        error = groups.leave(name, conn.username)
+    else:
+        error = f"未知的群组操作：{action}"
+    if error:
+        conn.notice(error)
+        return
+    print(f"👥 {conn.username} {action} 群组 {name}")
+    conn.send(GROUP, pack_fields("mine", ",".join(groups.groups_of(conn.username))))
+
+
+def handle_group_msg(conn, frame):
+    """群消息：编码一次，扇出给其他成员"""
+    name, content = unpack_fields(frame.payload, 2)
+    members = groups.members(name)
+    if members is None or not groups.is_member(name, conn.username):
+        conn.notice(f"不在群组 {name} 中，无法发言")
+        return
+    counts = fan_out(members, [(GROUP_MSG, pack_fields(name, conn.username, content), 0)], exclude=conn.username)
+    metrics.inc("relay.group_msg")
+    if archive is not None:
+        archive.record(conn.username, name, content, group=True)
+    offline_count = counts.get("offline", 0)
+    conn.notice(f"群消息已发送（在线 {counts.get('online', 0)} 人" +
+                (f"，离线保存 {offline_count} 人）" if offline_count else "）"))
+
+
+def admit(conn, frame):
+    """限速：返回处理该帧前要等待的秒数，None 表示已丢弃（等待由读线程/读协程负责，不持有任何锁）"""
+    if limiter is None:
+        return 0.0
+    if conn.limits is None:
+        conn.limits = limiter.user(conn.username)
+    name, delay = limiter.check(conn.limits, frame.type)
+    if delay is None:
+        metrics.inc(f"ratelimit.rejected.{name}")
+        if limiter.should_notify(conn.limits):
+            conn.notice(f"发送过于频繁，部分{CLASSES[name][3]}已被丢弃，请稍后再试")
+    elif delay:
+        metrics.inc(f"ratelimit.throttled.{name}")
+        metrics.observe("ratelimit.delay", delay)
+    return delay
+
+
+def handle_frame(conn, frame):
+    """处理一帧消息并记录处理耗时，返回 False 表示应断开连接"""
+    start = time.perf_counter()
+    mtype = frame.type
+    result = dispatch_frame(conn, frame)
+    if mtype in FRAME_COUNTERS:
+        metrics.inc(FRAME_COUNTERS[mtype])
+        metrics.observe(HANDLE_TIMERS[mtype], time.perf_counter() - start)
+    return result
+
+
+def dispatch_frame(conn, frame):
+    """按消息类型处理"""
+    mtype = frame.type
+    if mtype == IMAGE:
+        handle_image(conn, frame)
+    elif mtype == IMAGE_DATA:
+        handle_image_data(conn, frame)
+    elif mtype == FILE_CHUNK:
+        handle_file_chunk(conn, frame)
+    elif mtype == FILE_ACK:
+        handle_file_ack(conn, frame)
+    elif mtype == FILE_OFFER:
+        handle_file_offer(conn, frame)
+    elif mtype == FILE_CANCEL:
+        handle_file_cancel(conn, frame)
+    elif mtype == GROUP_MSG:
+        handle_group_msg(conn, frame)
+    elif mtype == GROUP:
+        handle_group(conn, frame)
+    elif mtype == TEXT:
+        target, content = unpack_fields(frame.payload, 2)
+        status = relay_to(target, TEXT, pack_fields(conn.username, content))
+        if archive is not None and status in ("online", "offline"):
+            archive.record(conn.username, target, content)
+        notify_delivery(conn, target, status, "消息已发送")
+    elif mtype == FRIEND_REQ:
+        target, _ = unpack_fields(frame.payload, 2)
+        status = relay_to(target, FRIEND_REQ, pack_fields(conn.username))
+        notify_delivery(conn, target, status, "好友申请已发送")
+    elif mtype == FRIEND_REPLY:
+        target, content = unpack_fields(frame.payload, 2)
+        status = relay_to(target, FRIEND_REPLY, pack_fields(conn.username, content))
+        notify_delivery(conn, target, status)
+    elif mtype == PRESENCE:
+        handle_presence(conn, frame)
+    elif mtype == HISTORY:
+        if archive is None:
+            conn.notice("服务端未开启消息存档")
+        else:
+            archive.request(conn.username, groups, unpack_fields(frame.payload, 5), conn.send_many)
+    elif mtype == USER_QUERY:
+        with lock:
+            online_list = list(directory.names)
+        conn.send(USER_LIST, ",".join(online_list))
+    elif mtype == STATS:
+        if is_admin(conn):
+            conn.send(STATS, metrics.render_text())
+        else:
+            conn.notice("无权限查看服务端指标")
+    elif mtype == PING:
+        conn.send(PONG)
+    elif mtype == ACK:
+        handled = bytes(frame.payload).decode("ascii", "replace")
+        if conn.session is not None and handled.isdigit():
+            conn.session.ack(int(handled))
+    elif mtype == OFFLINE:
+        conn.clean_exit = True
+        return False
+    elif mtype == 0:
+        conn.notice("消息格式错误（类型|目标|内容）")
+    return True
+
+
+def is_admin(conn):
+    """本机连接或 --admin 指定的用户可以查看指标"""
+    host = conn.addr[0] if isinstance(conn.addr, tuple) else conn.addr
+    return host in LOCAL_ADDRS or conn.username in admin_users
+
+
+def backlog_stats():
+    """各连接发送队列积压情况（查看指标时计算）"""
+    with lock:
+        conns = list(online_users.values())
+    backlog = sorted(((conn.outbox_bytes, conn.username) for conn in conns), reverse=True)
+    return {"policy": backpressure, "limit": outbox_limit, "total_bytes": sum(size for size, _ in backlog),
+            "top": [f"{name}:{size}" for size, name in backlog[:metrics.TOP_BACKLOG] if size]}
+
+
+metrics.gauge("connections.active", lambda: len(online_users))
+metrics.gauge("outbox.backlog", backlog_stats)
+metrics.gauge("sessions", lambda: {"total": len(sessions), "detached": len(detached_sessions)})
+metrics.gauge("file.transfers", lambda: len(transfers))
+metrics.gauge("heartbeat.watched", lambda: len(heartbeats))
+metrics.gauge("groups", lambda: groups.stats())
+metrics.gauge("presence", lambda: directory.stats())
+metrics.gauge("offline", lambda: offline.stats() if offline is not None else None)
+metrics.gauge("ratelimit", lambda: limiter.stats() if limiter is not None else None)
+metrics.gauge("archive", lambda: archive.stats() if archive is not None else None)
+metrics.gauge("cluster", lambda: cluster.stats() if cluster is not None else None)
+
+
+def broadcast_shutdown():
+    """通知所有在线用户服务端即将关闭，断开连接并按正常下线注销（多进程模式下同时释放在线登记）"""
+    with lock:
+        conns = list(online_users.values())
+        for conn in conns:
+            directory.unsubscribe(conn)  # 所有人都在下线，不再互相推送下线通知
+    for conn in conns:
+        try:
+            conn.notice("服务端即将关闭，连接断开")
+            conn.close()
+        except Exception:
+            pass
+        conn.clean_exit = True  # 服务端退出后会话无法恢复，不再保留
+        logout(conn)
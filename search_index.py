@@ -0,0 +1,296 @@
+"""
+聊天记录全文索引（客户端使用）
+
+倒排索引：词 → 按编号递增的记录列表。中文（含日文、韩文）没有空格分词，连续的汉字按单字和相邻两字
+（bigram）建索引，查询时两字以上的关键词拆成 bigram 求交集；英文和数字转小写后按整词索引。
+发送者也作为一个词（前缀 \0）建索引，按日期和会话过滤用每条记录的时间和会话编号。
+
+索引只保存每条记录在日志中的位置，不保存正文：候选记录按位置读出原文确认确实包含关键词
+（bigram 交集可能误中），所以查询只读命中的几行，不扫描全部历史。
+
+索引跟随日志增量维护：写线程每写一批就把新记录加进来；异常退出或索引还没加载时写入的部分，
+下次加载时按各日志已索引到的偏移补上。同步服务端存档时会话日志可能按时间整个重写，这时该会话的记录
+整体重新索引。索引在第一次搜索时才加载，不影响连接速度。
+"""
+import itertools
+import json
+import marshal
+import os
+import re
+import threading
+from array import array
+from bisect import bisect_left
+
+INDEX_FILE = "search.idx"
+FORMAT_VERSION = 1
+SEARCH_LIMIT = 200  # 每次最多返回的条数
+SENDER_PREFIX = "\0"
+CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af"  # 假名、汉字、兼容汉字、韩文
+TOKEN_RE = re.compile(f"([{CJK}]+)|([0-9a-z_]+)")
+FILE_RECORD_RE = re.compile(r"^\[(图片|文件)\](.*?):(.*)$")
+TEXT_RECORD_RE = re.compile(r"^\[(.*?)\] (.*)$", re.S)
+
+
+def split_record(record):
+    """记录 → (发送者, 要索引的文字)；图片/文件记录索引文件名"""
+    match = FILE_RECORD_RE.match(record)
+    if match:
+        return match.group(2), f"{match.group(1)} {os.path.basename(match.group(3))}"
+    match = TEXT_RECORD_RE.match(record)
+    if match:
+        return match.group(1), match.group(2)
+    return "", record
+
+
+def tokenize(text):
+    """建索引用：汉字的单字和 bigram，英文数字的整词"""
+    tokens = set()
+    for match in TOKEN_RE.finditer(text.lower()):
+        run = match.group(1)
+        if run:
+            tokens.update(run)
+            tokens.update(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.add(match.group(2))
+    return tokens
+
+
+def query_tokens(text):
+    """查询用：汉字只取 bigram（单个汉字取单字），必须全部命中"""
+    tokens = set()
+    for match in TOKEN_RE.finditer(text.lower()):
+        run = match.group(1)
+        if run and len(run) == 1:
+            tokens.add(run)
+        elif run:
+            tokens.update(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.add(match.group(2))
+    return tokens
+
+
+class SearchIndex:
+    """单个用户全部会话的倒排索引（线程安全）"""
+
+    def __init__(self, root):
+        self.path = os.path.join(root, INDEX_FILE)
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.dirty = False
+        self._reset()
+
+    def _reset(self):
+        self.peers = []  # 会话编号 → 会话对象
+        self.peer_ids = {}
+        self.indexed = {}  # {会话对象: 日志中已索引到的字节偏移}
+        self.doc_peer = array("I")  # 记录编号 → 会话编号
+        self.doc_offset = array("q")  # 记录编号 → 在日志中的偏移
+        self.doc_time = array("d")
+        self.postings = {}  # {词: array(记录编号)}
+
+    # ---------------------- 加载/保存 ----------------------
+    def load(self, paths):
+        """加载保存的索引，再补上各日志中还没索引的部分（paths 为 {会话对象: 日志路径}）"""
+        with self.lock:
+            if self.loaded:
+                return
+            try:
+                with open(self.path, "rb") as f:
+                    self._restore(marshal.load(f))
+            except (OSError, EOFError, ValueError, TypeError, KeyError):
+                self._reset()  # 没有索引或已损坏：从日志重建
+            if any(os.path.getsize(path) < self.indexed.get(peer, 0) for peer, path in paths.items()):
+                self._reset()  # 有日志被截短过，保存的位置全部作废
+            for peer, path in paths.items():
+                self._catch_up(peer, path)
+            self.loaded = True
+
+    def _restore(self, data):
+        if data["version"] != FORMAT_VERSION:
+            raise ValueError("索引格式已变化")
+        self.peers = data["peers"]
+        self.peer_ids = {peer: i for i, peer in enumerate(self.peers)}
+        self.indexed = data["indexed"]
+        self.doc_peer = array("I", data["doc_peer"])
+        self.doc_offset = array("q", data["doc_offset"])
+        self.doc_time = array("d", data["doc_time"])
+        self.postings = {token: array("I", ids) for token, ids in data["postings"].items()}
+
+    def save(self):
+        """有新内容时原子地保存索引"""
+        with self.lock:
+            if not self.loaded or not self.dirty:
+                return
+            data = marshal.dumps({
+                "version": FORMAT_VERSION, "peers": self.peers, "indexed": self.indexed,
+                "doc_peer": self.doc_peer.tobytes(), "doc_offset": self.doc_offset.tobytes(),
+                "doc_time": self.doc_time.tobytes(),
+                "postings": {token: ids.tobytes() for token, ids in self.postings.items()},
+            })
+            self.dirty = False
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+    # ---------------------- 增量维护 ----------------------
+    def add_lines(self, peer, path, start, lines):
+        """写线程：lines（编码后的日志行）刚写在 path 的 start 处；索引未加载时什么也不做"""
+        with self.lock:
+            if not self.loaded:
+                return
+            indexed = self.indexed.get(peer, 0)
+            if indexed > start:
+                return  # 加载时已经补过
+            if indexed < start:
+                self._catch_up(peer, path)  # 前面有没索引的部分，直接从日志补
+                return
+            for line in lines:
+                self._add_line(peer, start, line)
+                start += len(line)
+            self.indexed[peer] = start
+
+    def reindex(self, peer, path):
+        """写线程：peer 的日志被整个重写后，去掉它的旧记录并从头重新索引；
+        索引未加载时删掉保存的索引文件（其中的位置已经作废），下次加载时从日志重建
+        """
+        with self.lock:
+            if not self.loaded:
+                try:
+                    os.remove(self.path)
+                except FileNotFoundError:
+                    pass
+                return
+            peer_id = self.peer_ids.get(peer)
+            if peer_id is not None:
+                # 换成新数组而不是原地修改，进行中的查询仍按旧数组取完候选
+                keep = [doc for doc, doc_peer in enumerate(self.doc_peer) if doc_peer != peer_id]
+                renumber = {doc: i for i, doc in enumerate(keep)}
+                self.doc_peer = array("I", (self.doc_peer[doc] for doc in keep))
+                self.doc_offset = array("q", (self.doc_offset[doc] for doc in keep))
+                self.doc_time = array("d", (self.doc_time[doc] for doc in keep))
+                postings = {}
+                for token, ids in self.postings.items():
+                    kept = array("I", (renumber[doc] for doc in ids if doc in renumber))
+                    if kept:
+                        postings[token] = kept
+                self.postings = postings
+            self.indexed[peer] = 0
+            self._catch_up(peer, path)
+            self.dirty = True
+
+    def _catch_up(self, peer, path):
+        """从已索引的偏移读到日志末尾（只读完整的行）"""
+        offset = self.indexed.get(peer, 0)
+        try:
+            with open(path, "rb") as f:
+                f.seek(offset)
+                data = f.read()
+        except OSError:
+            return
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines(keepends=True):
+            self._add_line(peer, offset, line)
+            offset += len(line)
+        self.indexed[peer] = offset
+
+    def _add_line(self, peer, offset, line):
+        try:
+            entry = json.loads(line)
+            timestamp, record = float(entry["t"]), entry["m"]
+        except (ValueError, KeyError, TypeError):
+            return  # 异常退出时留下的半行
+        peer_id = self.peer_ids.get(peer)
+        if peer_id is None:
+            peer_id = self.peer_ids[peer] = len(self.peers)
+            self.peers.append(peer)
+        doc = len(self.doc_peer)
+        self.doc_peer.append(peer_id)
+        self.doc_offset.append(offset)
+        self.doc_time.append(timestamp)
+        sender, text = split_record(record)
+        for token in tokenize(text) | {SENDER_PREFIX + sender}:
+            ids = self.postings.get(token)
+            if ids is None:
+                ids = self.postings[token] = array("I")
+            ids.append(doc)
+        self.dirty = True
+
+    # ---------------------- 查询 ----------------------
+    def search(self, paths, keyword="", sender="", peer="", since=None, until=None, limit=SEARCH_LIMIT):
+        """按关键词/发送者/会话/时间范围查询，返回 [(会话对象, 时间, 记录)]，最新的在前
+
+        候选记录每次取 limit 条去读原文确认，凑够 limit 条就停，常见词也不会把命中的记录全部读一遍。
+        """
+        self.load(paths)
+        terms = keyword.lower().split()
+        with self.lock:
+            tokens = set()
+            for term in terms:
+                tokens |= query_tokens(term)
+            if sender:
+                tokens.add(SENDER_PREFIX + sender)
+            lists = [self.postings.get(token) for token in tokens]
+            peer_id = self.peer_ids.get(peer) if peer else None
+            if None in lists or (peer and peer_id is None):
+                return []
+            docs = (self.doc_peer, self.doc_offset, self.doc_time)
+            candidates = self._candidates(lists, docs, peer_id, since, until)
+        doc_peer, doc_offset, _ = docs
+        results = []
+        while len(results) < limit:
+            # 写线程只会在末尾追加（重新索引时换成新数组），分批取候选期间不影响已取到的编号
+            with self.lock:
+                batch = [(self.peers[doc_peer[doc]], doc_offset[doc])
+                         for doc in itertools.islice(candidates, limit)]
+            if not batch:
+                break
+            self._verify(batch, paths, terms, results, limit)
+        results.sort(key=lambda result: result[1], reverse=True)
+        return results
+
+    def _candidates(self, lists, docs, peer_id, since, until):
+        """从新到旧产生同时出现在所有列表中、且符合会话和时间条件的记录编号"""
+        doc_peer, _, doc_time = docs
+        if lists:
+            lists.sort(key=len)
+            order = reversed(lists[0])
+        else:
+            order = range(len(doc_peer) - 1, -1, -1)
+        for doc in order:
+            if peer_id is not None and doc_peer[doc] != peer_id:
+                continue
+            timestamp = doc_time[doc]
+            if (since is not None and timestamp < since) or (until is not None and timestamp >= until):
+                continue
+            for ids in lists[1:]:
+                i = bisect_left(ids, doc)
+                if i == len(ids) or ids[i] != doc:
+                    break
+            else:
+                yield doc
+
+    def _verify(self, batch, paths, terms, results, limit):
+        """读出候选记录的原文，包含每个关键词的加入 results"""
+        files = {}
+        try:
+            for peer, offset in batch:
+                f = files.get(peer)
+                if f is None:
+                    f = files[peer] = open(paths[peer], "rb")
+                f.seek(offset)
+                try:
+                    entry = json.loads(f.readline())
+                except ValueError:
+                    continue
+                text = split_record(entry["m"])[1].lower()
+                if all(term in text for term in terms):
+                    results.append((peer, entry["t"], entry["m"]))
+                    if len(results) >= limit:
+                        break
+        finally:
+            for f in files.values():
+                f.close()
+
+    def stats(self):
+        return {"records": len(self.doc_peer), "tokens": len(self.postings), "peers": len(self.peers)}
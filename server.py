@@ -1,122 +1,209 @@
+import argparse
 import socket
 import threading
 import signal
 import sys
-import struct
 import time
 
+import metrics
+import protocol
+import relay
+from groups import GROUPS_FILE, GroupRegistry
+from archive import ARCHIVE_DIR, Archive
+from offline_queue import OFFLINE_DIR, OfflineQueue
+from rate_limit import POLICIES, RateLimiter, parse_limit
+
 HOST = "0.0.0.0"
 PORT = 8888
-online_users = {}  # {用户名: 客户端socket}
+RECV_SIZE = 65536
+IOV_MAX = 1024  # sendmsg 一次最多的缓冲块数
 is_running = True
-lock = threading.Lock()
+
+
+def send_buffers(sock, buffers):
+    """用 sendmsg 一次发出多块数据（不拼接），没发完时从断点继续；没有 sendmsg 的平台拼接后发送"""
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(buffers))
+        metrics.inc("write.calls")
+        return
+    views = [memoryview(buf) for buf in buffers]
+    i = 0
+    while i < len(views):
+        sent = sock.sendmsg(views[i:i + IOV_MAX])
+        metrics.inc("write.calls")
+        while i < len(views) and sent >= views[i].nbytes:
+            sent -= views[i].nbytes
+            i += 1
+        if sent:
+            views[i] = views[i][sent:]
+
+
+class ThreadConnection(relay.Connection):
+    """线程模式的连接：读线程处理消息，专属写线程负责发送"""
+
+    def __init__(self, sock, addr, codec):
+        super().__init__(addr, codec)
+        self.sock = sock
+        self.cond = threading.Condition()
+        self.writer_thread = threading.Thread(target=self.writer_loop, daemon=True)
+        self.writer_thread.start()
+
+    def write_many(self, chunks):
+        size = sum(len(chunk) for chunk in chunks)
+        with self.cond:
+            if self.closed:
+                return
+            if self.over_limit(size):
+                if relay.backpressure == "drop_oldest":
+                    self.drop_oldest(size)
+                elif relay.backpressure == "block":
+                    # 在发送方的线程里等待，发送方自然被限速；等太久说明对方已卡死
+                    metrics.inc("backpressure.blocked")
+                    start = time.perf_counter()
+                    ok = self.cond.wait_for(lambda: self.closed or not self.over_limit(size), relay.BLOCK_TIMEOUT)
+                    metrics.observe("backpressure.block_wait", time.perf_counter() - start)
+                    if self.closed:
+                        return
+                    if not ok:
+                        self.slow_consumer(f"等待超过 {relay.BLOCK_TIMEOUT} 秒")
+                        return
+                else:
+                    self.slow_consumer("发送队列已满")
+                    return
+            self.outbox.append((chunks, size))
+            self.outbox_bytes += size
+            self.cond.notify_all()
+
+    def writer_loop(self):
+        """写线程：取出队列中的全部数据依次发送，关闭后发完剩余数据再断开（socket 由读线程关闭）"""
+        try:
+            while True:
+                with self.cond:
+                    while not self.outbox and not self.closed:
+                        self.cond.wait()
+                    if not self.outbox:
+                        break
+                    groups = list(self.outbox)
+                    self.outbox.clear()
+                metrics.inc("write.groups", len(groups))
+                if not relay.coalesce:
+                    for chunks, size in groups:
+                        for data in chunks:
+                            self.sock.sendall(data)
+                            metrics.inc("write.calls")
+                        self.sent(size)
+                    continue
+                batch, batch_size = [], 0
+                for chunks, size in groups:
+                    batch.extend(chunks)
+                    batch_size += size
+                    if batch_size >= relay.COALESCE_BYTES:
+                        send_buffers(self.sock, batch)
+                        self.sent(batch_size)
+                        batch, batch_size = [], 0
+                if batch:
+                    send_buffers(self.sock, batch)
+                    self.sent(batch_size)
+        except OSError:
+            pass
+        finally:
+            with self.cond:
+                self.closed = True
+                self.outbox.clear()
+                self.outbox_bytes = 0
+                self.cond.notify_all()
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)  # 唤醒阻塞在 recv 上的读线程
+            except OSError:
+                pass
+
+    def sent(self, size):
+        """已发出 size 字节，唤醒等待队列腾出空间的发送方"""
+        with self.cond:
+            self.outbox_bytes -= size
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def abort(self):
+        with self.cond:
+            self.closed = True
+            self.outbox.clear()
+            self.outbox_bytes = 0
+            self.cond.notify_all()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)  # 打断写线程的 sendall 和读线程的 recv
+        except OSError:
+            pass
+
+
+def recv_frames(conn):
+    """读取一批数据并解析成帧，连接关闭返回 None
+
+    正在接收大帧（图片数据）时直接 recv_into 到该帧的缓冲，收齐后原样转发，不再逐块拼接。
+    """
+    pending = conn.parser.pending_view() if conn.codec is protocol.FramedCodec else None
+    if pending is not None and len(pending) > RECV_SIZE:
+        nbytes = conn.sock.recv_into(pending)
+        if not nbytes:
+            return None
+        conn.last_seen = time.monotonic()
+        metrics.inc("bytes.in", nbytes)
+        return conn.parser.commit(nbytes)
+    data = conn.sock.recv(RECV_SIZE)
+    if not data:
+        return None
+    conn.last_seen = time.monotonic()
+    metrics.inc("bytes.in", len(data))
+    return conn.parser.feed(data)
 
 
 def handle_client(client_socket, client_addr):
     """处理客户端连接"""
-    username = None
+    conn = None
     try:
         client_socket.settimeout(5.0)
-        username_data = client_socket.recv(1024).decode("utf-8").strip()
-        if not username_data:
-            raise Exception("未接收到用户名")
-        username = username_data
-
-        with lock:
-            if username in online_users:
-                client_socket.send("用户名已被占用".encode("utf-8"))
-                client_socket.close()
-                print(f"⚠️ {client_addr} 尝试使用重复用户名：{username}")
-                return
-            online_users[username] = client_socket
+        data = client_socket.recv(65536)
+        codec, data = protocol.detect_codec(data)
+        while codec is None:
+            more = client_socket.recv(65536)
+            if not more:
+                raise Exception("未接收到用户名")
+            codec, data = protocol.detect_codec(data + more)
+        conn = ThreadConnection(client_socket, client_addr, codec)
 
-        print(f"✅ {username} 上线 | 地址：{client_addr} | 在线数：{len(online_users)}")
-        client_socket.settimeout(300.0)
+        frames = conn.parser.feed(data)
+        while not frames:
+            data = client_socket.recv(65536)
+            if not data:
+                raise Exception("未接收到用户名")
+            frames = conn.parser.feed(data)
+        if not relay.handle_hello(conn, frames[0]):
+            return
+        client_socket.settimeout(None)  # 之后的空闲检测由心跳时间轮负责，读线程一直阻塞在 recv 上
 
+        frames = frames[1:]
         while is_running:
             try:
-                msg = client_socket.recv(1024).decode("utf-8").strip()
-                if not msg:
-                    break
-
-                if msg.startswith("image|"):
-                    parts = msg.split("|", 2)
-                    if len(parts) >= 3:
-                        target_user = parts[1]
-                        img_filename = parts[2]
-                        with lock:
-                            if target_user in online_users:
-                                online_users[target_user].send(f"image|{username}|{img_filename}".encode("utf-8"))
-                                img_size_data = client_socket.recv(4)
-                                if len(img_size_data) != 4:
-                                    client_socket.send("图片大小数据不完整".encode("utf-8"))
-                                    continue
-                                online_users[target_user].send(img_size_data)
-                                img_size = struct.unpack("!I", img_size_data)[0]
-
-                                client_socket.settimeout(30.0)
-                                online_users[target_user].settimeout(30.0)
-                                recv_size = 0
-                                while recv_size < img_size:
-                                    recv_data = client_socket.recv(1024)
-                                    if not recv_data:
-                                        break
-                                    online_users[target_user].send(recv_data)
-                                    recv_size += len(recv_data)
-
-                                if recv_size == img_size:
-                                    client_socket.send("图片转发成功".encode("utf-8"))
-                                else:
-                                    client_socket.send("图片转发不完整".encode("utf-8"))
-                                print(f"📷 {username} 向 {target_user} 发送图片：{img_filename}")
-                            else:
-                                client_socket.send(f"{target_user} 不在线/不存在".encode("utf-8"))
-                        client_socket.settimeout(300.0)
-                        if target_user in online_users:
-                            online_users[target_user].settimeout(300.0)
-                    continue
-
-                parts = msg.split("|", 2)
-                if len(parts) < 3:
-                    client_socket.send("消息格式错误（类型|目标|内容）".encode("utf-8"))
-                    continue
-
-                msg_type, target, content = parts[0], parts[1], parts[2]
-
-                if msg_type == "text":
-                    with lock:
-                        if target in online_users:
-                            online_users[target].send(f"[{username}] {content}".encode("utf-8"))
-                            client_socket.send("消息已发送".encode("utf-8"))
-                        else:
-                            client_socket.send(f"{target} 不在线/不存在".encode("utf-8"))
-                elif msg_type == "friend_req":
-                    with lock:
-                        if target in online_users:
-                            online_users[target].send(f"friend_req|{username}".encode("utf-8"))
-                            client_socket.send("好友申请已发送".encode("utf-8"))
-                        else:
-                            client_socket.send(f"{target} 不在线/不存在".encode("utf-8"))
-                elif msg_type == "friend_reply":
-                    with lock:
-                        if target in online_users:
-                            online_users[target].send(f"friend_reply|{username}|{content}".encode("utf-8"))
-                        else:
-                            client_socket.send(f"{target} 不在线/不存在".encode("utf-8"))
-                elif msg_type == "user_query":
-                    with lock:
-                        online_list = ",".join(online_users.keys())
-                    client_socket.send(f"user_list|{online_list}".encode("utf-8"))
-                elif msg_type == "offline":
+                for frame in frames:
+                    delay = relay.admit(conn, frame)
+                    if delay is None:
+                        continue
+                    if delay:
+                        time.sleep(delay)
+                    if not relay.handle_frame(conn, frame):
+                        return
+                frames = recv_frames(conn)
+                if frames is None:
                     break
-
-            except socket.timeout:
-                continue
             except ConnectionResetError:
-                print(f"🔌 {username} 连接被客户端重置")
+                print(f"🔌 {conn.username} 连接被客户端重置")
                 break
             except Exception as e:
-                print(f"⚠️ {username} 消息处理异常：{str(e)}")
+                print(f"⚠️ {conn.username} 消息处理异常：{str(e)}")
                 break
 
     except socket.timeout:
@@ -124,17 +211,38 @@ def handle_client(client_socket, client_addr):
     except Exception as e:
         print(f"❌ {client_addr} 连接初始化异常：{str(e)}")
     finally:
-        with lock:
-            if username in online_users:
-                del online_users[username]
-        try:
+        if conn is not None:
+            relay.logout(conn)
+            conn.close()
+            conn.writer_thread.join(5.0)
             client_socket.close()
-        except:
-            pass
-        if username:
-            print(f"🔌 {username} 下线 | 在线数：{len(online_users)}")
         else:
             print(f"🔌 {client_addr} 下线")
+            try:
+                client_socket.close()
+            except:
+                pass
+
+
+def worker_arguments(argv):
+    """主进程的命令行参数去掉 --workers 后传给工作进程，工作进程统一使用协程模式"""
+    args = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == "--workers":
+            skip = True
+        elif not arg.startswith("--workers="):
+            args.append(arg)
+    return args + ["--mode", "async"]
+
+
+def heartbeat_loop():
+    """心跳线程：每个时间轮刻度检查一次到期的连接"""
+    while is_running:
+        time.sleep(relay.heartbeats.tick)
+        relay.check_heartbeats()
 
 
 def graceful_exit(signum, frame):
@@ -142,22 +250,103 @@ def graceful_exit(signum, frame):
     global is_running
     print("\n📤 服务端正在退出...")
     is_running = False
-
-    with lock:
-        for sock in online_users.values():
-            try:
-                sock.send("服务端即将关闭，连接断开".encode("utf-8"))
-                time.sleep(0.1)
-                sock.close()
-            except:
-                pass
-        online_users.clear()
-
+    relay.broadcast_shutdown()
+    time.sleep(0.2)  # 留时间让写线程发出关闭通知
+    if relay.archive is not None:
+        relay.archive.close()  # 写完队列中还没落盘的存档
     print("✅ 服务端已安全退出")
     sys.exit(0)
 
 
+def rate_limit_arg(text):
+    """--rate-limit 的参数解析（出错时显示具体原因）"""
+    try:
+        return parse_limit(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="局域网聊天服务端")
+    parser.add_argument("--mode", choices=["thread", "async"], default="thread",
+                        help="thread：每连接一个线程（默认）；async：asyncio 事件循环，适合大量连接")
+    parser.add_argument("--host", default=HOST, help=f"监听地址（默认 {HOST}）")
+    parser.add_argument("--port", type=int, default=PORT, help=f"监听端口（默认 {PORT}）")
+    parser.add_argument("--metrics-port", type=int, help="在本机该端口提供 HTTP 指标（/metrics、/metrics.json；多进程模式下第 i 个工作进程用该端口 + i）")
+    parser.add_argument("--admin", action="append", default=[], help="允许远程查看 STATS 指标的用户名（可重复）")
+    parser.add_argument("--backpressure", choices=relay.BACKPRESSURE_POLICIES, default=relay.backpressure,
+                        help="接收方发送队列满时：block 让发送方等待（默认）；drop_oldest 丢弃最早的消息；disconnect 断开接收方")
+    parser.add_argument("--outbox-limit-mb", type=float, default=relay.OUTBOX_LIMIT / 1024 / 1024,
+                        help="每个连接的发送队列上限（MB，默认 16）")
+    parser.add_argument("--offline-dir", default=OFFLINE_DIR, help=f"离线消息目录（默认 {OFFLINE_DIR}）")
+    parser.add_argument("--no-offline", action="store_true", help="不保存离线消息（对方不在线时直接提示失败）")
+    parser.add_argument("--offline-days", type=float, default=7, help="离线消息保留天数（默认 7）")
+    parser.add_argument("--offline-user-mb", type=float, default=64, help="每个用户离线消息上限（MB，默认 64）")
+    parser.add_argument("--offline-total-mb", type=float, default=1024, help="离线消息总上限（MB，默认 1024）")
+    parser.add_argument("--archive-dir", default=ARCHIVE_DIR, help=f"消息存档目录（默认 {ARCHIVE_DIR}）")
+    parser.add_argument("--no-archive", action="store_true", help="不存档转发的消息（客户端无法从服务端同步聊天记录）")
+    parser.add_argument("--rate-limit", action="append", type=rate_limit_arg, default=[], metavar="类别=速率/突发",
+                        help="调整某类消息每个用户的限速（可重复），类别为 message、social、query、history 或 total，"
+                             "如 --rate-limit message=10/30")
+    parser.add_argument("--rate-policy", choices=POLICIES, default="throttle",
+                        help="超出限速时：throttle 放慢该用户的处理（默认，需等待超过 1 秒时丢弃）；reject 直接丢弃并提示")
+    parser.add_argument("--no-rate-limit", action="store_true", help="不限速（压力测试用）")
+    parser.add_argument("--no-coalesce", action="store_true",
+                        help="关闭写合并和 TCP_NODELAY，逐块发送（与默认方式对比测试用）")
+    parser.add_argument("--groups-file", default=GROUPS_FILE, help=f"群组名单文件（默认 {GROUPS_FILE}，为空则不保存）")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="多进程模式：启动 N 个协程模式的工作进程共用端口（SO_REUSEPORT），主进程负责进程间转发")
+    parser.add_argument("--broker-socket", help="多进程模式的进程间通信套接字路径（默认在临时目录）")
+    parser.add_argument("--worker-id", type=int, help=argparse.SUPPRESS)  # 由主进程启动工作进程时传入
+    args = parser.parse_args()
+    HOST, PORT = args.host, args.port
+    relay.admin_users.update(args.admin)
+    relay.backpressure = args.backpressure
+    relay.outbox_limit = int(args.outbox_limit_mb * 1024 * 1024)
+    relay.coalesce = not args.no_coalesce
+    if not args.no_rate_limit:
+        relay.limiter = RateLimiter({name: (rate, burst) for name, rate, burst in args.rate_limit}, args.rate_policy)
+
+    if args.worker_id is not None:
+        # 工作进程：群组和在线名单是代理进程的副本，离线消息交给代理进程读写
+        import async_server
+        import cluster
+        relay.cluster = cluster.WorkerLink(args.worker_id, args.broker_socket)
+        if not args.no_offline:
+            relay.offline = cluster.OfflineProxy(relay.cluster, args.offline_dir)
+        if not args.no_archive:
+            relay.archive = cluster.ArchiveProxy(relay.cluster)
+        if args.metrics_port:
+            metrics.serve_http(args.metrics_port + args.worker_id)
+        async_server.run(HOST, PORT, relay.cluster)
+        sys.exit(0)
+
+    offline = None
+    if not args.no_offline:
+        offline = OfflineQueue(args.offline_dir, max_age=args.offline_days * 86400,
+                               max_user_bytes=int(args.offline_user_mb * 1024 * 1024),
+                               max_total_bytes=int(args.offline_total_mb * 1024 * 1024))
+    archive = None if args.no_archive else Archive(args.archive_dir)
+    if args.workers > 1:
+        import cluster
+        cluster.run(args.broker_socket or cluster.default_socket_path(PORT), args.workers,
+                    worker_arguments(sys.argv[1:]), args.groups_file or None, offline, archive)
+        if archive is not None:
+            archive.close()
+        sys.exit(0)
+    relay.groups = GroupRegistry(args.groups_file or None)
+    relay.offline = offline
+    relay.archive = archive
+    if args.metrics_port:
+        metrics.serve_http(args.metrics_port)
+
+    if args.mode == "async":
+        import async_server
+        async_server.run(HOST, PORT)
+        if archive is not None:
+            archive.close()
+        sys.exit(0)
+
     signal.signal(signal.SIGINT, graceful_exit)
     signal.signal(signal.SIGTERM, graceful_exit)
 
@@ -178,10 +367,13 @@ if __name__ == "__main__":
     print(f"🚀 服务端启动成功 | 局域网IP：{local_ip}:{PORT}")
     print("💡 按 Ctrl+C 优雅退出")
     print("=" * 50)
+    threading.Thread(target=heartbeat_loop, daemon=True).start()
 
     while is_running:
         try:
             client_socket, client_addr = server_socket.accept()
+            if relay.coalesce:
+                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             threading.Thread(target=handle_client, args=(client_socket, client_addr), daemon=True).start()
         except socket.timeout:
             continue
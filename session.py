@@ -0,0 +1,108 @@
+"""
+会话恢复（服务端使用，仅新版分帧协议）
+
+客户端在 HELLO 中带上“用户名|令牌|已处理帧数”表示支持会话（新会话令牌为空）。
+服务端发给客户端的每一帧（SESSION 本身除外）按发送顺序隐式编号 1、2、3 ...，客户端
+定期用 ACK 回报已处理的帧数，服务端据此丢弃回放缓冲中已确认的帧。连接意外断开后会话
+保留 RESUME_WINDOW 秒，期间发给该用户的消息继续进入回放缓冲；客户端带着令牌和已处理帧数
+重连时，只回放对方没处理的帧，不需要重新登录、重新拉取。
+
+回放缓冲超过 REPLAY_MAX_BYTES 时丢弃最旧的帧并标记为不可恢复，客户端下次重连按新会话处理。
+"""
+import secrets
+import threading
+import time
+from collections import deque
+
+from protocol import ACK, PING, PONG, SESSION
+
+RESUME_WINDOW = 120  # 断开后保留会话的时间（秒）
+REPLAY_MAX_BYTES = 8 * 1024 * 1024  # 每个会话回放缓冲上限
+UNSEQUENCED = (SESSION, ACK, PING, PONG)  # 不参与编号的消息类型
+
+
+class Session:
+    """一个用户的会话：编号、回放缓冲和当前绑定的连接"""
+
+    def __init__(self, username):
+        self.username = username
+        self.token = secrets.token_hex(16)
+        self.lock = threading.Lock()  # 编号与写入发送队列必须一起完成，保证编号顺序即发送顺序
+        self.conn = None  # 当前连接，断开期间为 None
+        self.sent = 0  # 已编号的帧数
+        self.replay = deque()  # 未确认的帧 (序号, 类型, 负载, 标志)
+        self.replay_bytes = 0
+        self.resumable = True
+        self.detached_at = None
+        self.closed = False  # 已作废，不再接收消息
+
+    def push(self, messages, encoded=None):
+        """编号并发给当前连接；断开期间只放入回放缓冲，放不下时返回 False（不编号）
+
+        encoded 为群发时共享的编码结果（见 Connection.write_encoded）。
+        """
+        with self.lock:
+            if self.closed:
+                return False
+            size = sum(len(payload) for _, payload, _ in messages)
+            if self.conn is None and self.replay_bytes + size > REPLAY_MAX_BYTES:
+                return False
+            for mtype, payload, flags in messages:
+                if mtype in UNSEQUENCED:
+                    continue
+                if isinstance(payload, str):
+                    payload = payload.encode("utf-8")
+                self.sent += 1
+                self.replay.append((self.sent, mtype, payload, flags))
+                self.replay_bytes += len(payload)
+            while self.replay_bytes > REPLAY_MAX_BYTES and self.replay:
+                self.replay_bytes -= len(self.replay.popleft()[2])
+                self.resumable = False
+            if self.conn is not None:
+                self.conn.write_encoded(messages, encoded)
+            return True
+
+    def ack(self, handled):
+        """客户端已处理 handled 帧，丢弃回放缓冲中已确认的部分"""
+        with self.lock:
+            while self.replay and self.replay[0][0] <= handled:
+                self.replay_bytes -= len(self.replay.popleft()[2])
+
+    def can_resume(self, token, handled):
+        """令牌正确且客户端缺的帧都还在回放缓冲里"""
+        if not self.resumable or not secrets.compare_digest(token, self.token):
+            return False
+        if handled > self.sent:
+            return False
+        oldest = self.replay[0][0] if self.replay else self.sent + 1
+        return handled >= oldest - 1
+
+    def attach(self, conn, handled, first_frame):
+        """绑定新连接：先发 first_frame（SESSION），再回放 handled 之后的帧"""
+        with self.lock:
+            while self.replay and self.replay[0][0] <= handled:
+                self.replay_bytes -= len(self.replay.popleft()[2])
+            self.conn = conn
+            self.detached_at = None
+            conn.session = self
+            conn.write_encoded([first_frame] + [(mtype, payload, flags) for _, mtype, payload, flags in self.replay])
+            return len(self.replay)
+
+    def detach(self, conn):
+        """连接意外断开：保留会话等待恢复"""
+        with self.lock:
+            if self.conn is conn:
+                self.conn = None
+                self.detached_at = time.time()
+
+    def expired(self, now=None):
+        return self.detached_at is not None and (now or time.time()) - self.detached_at > RESUME_WINDOW
+
+    def close(self):
+        """作废会话，返回未确认的帧（转存离线消息用）"""
+        with self.lock:
+            self.closed = True
+            messages = [(mtype, payload, flags) for _, mtype, payload, flags in self.replay]
+            self.replay.clear()
+            self.replay_bytes = 0
+            return messages
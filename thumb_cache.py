@@ -0,0 +1,200 @@
+"""
+缩略图两级缓存（客户端使用）
+
+一级：内存 LRU，按字节数限制总大小；二级：磁盘缓存，文件名为“原图内容哈希_宽x高.png”，
+重启后不必再从原图重新缩放。同一张图片换了文件名（或被转发多次）也只缩放一次。
+
+解码和缩放在后台线程池中进行（JPEG 使用 draft 模式直接按缩小比例解码），结果放入队列，
+由 Tk 主线程调用 drain() 生成 PhotoImage 并回调，界面线程和网络接收线程都不会被大图卡住。
+"""
+import hashlib
+import os
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageTk
+
+CACHE_DIR = "thumb_cache"
+MEMORY_LIMIT = 32 * 1024 * 1024  # 内存缓存上限（字节）
+DISK_LIMIT = 128 * 1024 * 1024  # 磁盘缓存上限（字节），启动时清理最久未用的
+HASH_BLOCK = 1024 * 1024
+WORKERS = min(4, os.cpu_count() or 1)
+
+
+def make_thumbnail(image_path, max_width, max_height):
+    """从原图生成缩略图（等比缩放，不放大）"""
+    img = Image.open(image_path)
+    if img.format == "JPEG":
+        img.draft(img.mode, (max_width, max_height))  # 解码时直接按 1/2、1/4、1/8 缩小
+    width, height = img.size
+    scale = min(max_width / width, max_height / height, 1)
+    new_size = (max(1, int(width * scale)), max(1, int(height * scale)))
+    return img.resize(new_size, Image.Resampling.LANCZOS)
+
+
+class ThumbnailCache:
+    """内存 LRU + 磁盘两级缩略图缓存"""
+
+    def __init__(self, cache_dir=CACHE_DIR, memory_limit=MEMORY_LIMIT, disk_limit=DISK_LIMIT):
+        self.cache_dir = cache_dir
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.memory = OrderedDict()  # {(内容哈希, 宽, 高): (缩略图, PhotoImage, 字节数)}
+        self.memory_bytes = 0
+        self.hashes = {}  # {(路径, 修改时间, 文件大小): 内容哈希}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="thumb")
+        self.results = queue.Queue()  # 后台生成好的缩略图，等主线程取走
+        self.pending = {}  # {(路径, 宽, 高): [回调]}，同一图片的重复请求合并
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self.prune_disk()
+
+    def file_key(self, image_path):
+        st = os.stat(image_path)
+        return os.path.abspath(image_path), st.st_mtime_ns, st.st_size
+
+    def content_hash(self, image_path):
+        """原图内容哈希（按路径+修改时间记忆，避免重复读文件）"""
+        key = self.file_key(image_path)
+        with self.lock:
+            digest = self.hashes.get(key)
+        if digest is None:
+            h = hashlib.sha1()
+            with open(image_path, "rb") as f:
+                for block in iter(lambda: f.read(HASH_BLOCK), b""):
+                    h.update(block)
+            digest = h.hexdigest()
+            with self.lock:
+                self.hashes[key] = digest
+        return digest
+
+    def disk_path(self, digest, max_width, max_height):
+        return os.path.join(self.cache_dir, f"{digest}_{max_width}x{max_height}.png")
+
+    def load_thumbnail(self, image_path, max_width, max_height):
+        """取缩略图（PIL 图片）：先查磁盘缓存，没有再从原图生成并写入磁盘"""
+        digest = self.content_hash(image_path)
+        path = self.disk_path(digest, max_width, max_height)
+        try:
+            img = Image.open(path)
+            img.load()
+            os.utime(path)  # 更新访问时间，清理时保留常用的
+            with self.lock:
+                self.disk_hits += 1
+            return digest, img
+        except (OSError, ValueError):
+            pass
+
+        img = make_thumbnail(image_path, max_width, max_height)
+        with self.lock:
+            self.misses += 1
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            img.save(tmp_path, "PNG")
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return digest, img
+
+    def peek(self, image_path, max_width=150, max_height=150):
+        """只查内存缓存（不读取图片内容），命中返回 (缩略图, PhotoImage)，否则返回 None"""
+        try:
+            file_key = self.file_key(image_path)
+        except OSError:
+            return None
+        with self.lock:
+            digest = self.hashes.get(file_key)
+            entry = self.memory.get((digest, max_width, max_height)) if digest else None
+            if entry is None:
+                return None
+            self.memory.move_to_end((digest, max_width, max_height))
+            self.memory_hits += 1
+            return entry[0], entry[1]
+
+    def request(self, image_path, max_width, max_height, callback):
+        """异步取缩略图：在线程池中解码缩放，完成后由 drain() 在主线程回调 callback(缩略图, PhotoImage)"""
+        job = (os.path.abspath(image_path), max_width, max_height)
+        with self.lock:
+            if job in self.pending:
+                self.pending[job].append(callback)
+                return
+            self.pending[job] = [callback]
+        self.executor.submit(self._load_job, job)
+
+    def _load_job(self, job):
+        image_path, max_width, max_height = job
+        try:
+            digest, img = self.load_thumbnail(image_path, max_width, max_height)
+            self.results.put((job, (digest, max_width, max_height), img, None))
+        except Exception as e:
+            self.results.put((job, None, None, e))
+
+    def drain(self, limit=16):
+        """主线程调用：为后台完成的缩略图生成 PhotoImage 并执行回调，返回处理条数"""
+        count = 0
+        while count < limit:
+            try:
+                job, key, img, error = self.results.get_nowait()
+            except queue.Empty:
+                break
+            count += 1
+            with self.lock:
+                callbacks = self.pending.pop(job, [])
+            if error is not None:
+                print(f"⚠️ 图片加载失败：{job[0]}：{str(error)}")
+                continue
+            tk_img = ImageTk.PhotoImage(img)
+            self.put(key, img, tk_img)
+            for callback in callbacks:
+                callback(img, tk_img)
+        return count
+
+    def put(self, key, img, tk_img):
+        """放入内存缓存，超出上限时淘汰最久未用的"""
+        nbytes = img.width * img.height * 4 * 2  # PIL 图片 + Tk 图片各约 4 字节/像素
+        with self.lock:
+            old = self.memory.pop(key, None)
+            if old is not None:
+                self.memory_bytes -= old[2]
+            self.memory[key] = (img, tk_img, nbytes)
+            self.memory_bytes += nbytes
+            while self.memory_bytes > self.memory_limit and len(self.memory) > 1:
+                _, (_, _, evicted) = self.memory.popitem(last=False)
+                self.memory_bytes -= evicted
+
+    def prune_disk(self):
+        """磁盘缓存超过上限时删除最久未用的文件"""
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if name.endswith(".tmp"):
+                os.remove(path)
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.disk_limit:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    def stats(self):
+        """命中统计"""
+        with self.lock:
+            return {"memory_hits": self.memory_hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                    "memory_entries": len(self.memory), "memory_bytes": self.memory_bytes}
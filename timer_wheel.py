@@ -0,0 +1,64 @@
+"""
+哈希时间轮（服务端使用）
+
+所有连接的心跳期限放在同一个时间轮里，代替每个 socket 各自的超时：时间轮分成 slots 个槽，
+每槽 tick 秒，到期时刻落在第 (到期时刻 // tick) % slots 个槽。登记、取消都是 O(1)，
+每个 tick 只检查转到的那一个槽，超过一圈的期限留在槽中等下一圈。
+
+连接收到数据时只更新自己的 last_seen，不动时间轮；到期时再按 last_seen 判断是否真的空闲，
+没到期的重新登记（惰性延期），所以每收一批数据的开销只是一次赋值。
+"""
+import threading
+import time
+
+TICK = 1.0  # 每槽秒数
+SLOTS = 512  # 槽数（一圈约 8.5 分钟）
+
+
+class TimerWheel:
+    """到期时刻 → 对象的哈希时间轮（线程安全）"""
+
+    def __init__(self, tick=TICK, slots=SLOTS, now=None):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.deadlines = {}  # {对象: 到期时刻}
+        self.slot_of = {}  # {对象: 所在槽号}
+        self.cursor = int((time.monotonic() if now is None else now) // tick)  # 尚未处理完的最早刻度
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def schedule(self, item, deadline):
+        """登记（或改期）item 在 deadline 到期"""
+        with self.lock:
+            self._remove(item)
+            slot = max(int(deadline // self.tick), self.cursor) % len(self.slots)
+            self.slots[slot].add(item)
+            self.deadlines[item] = deadline
+            self.slot_of[item] = slot
+
+    def cancel(self, item):
+        with self.lock:
+            self._remove(item)
+
+    def _remove(self, item):
+        slot = self.slot_of.pop(item, None)
+        if slot is not None:
+            self.slots[slot].discard(item)
+            del self.deadlines[item]
+
+    def expire(self, now=None):
+        """转到 now，取出已到期的对象（从时间轮中移除）"""
+        now = time.monotonic() if now is None else now
+        due = []
+        with self.lock:
+            last = int(now // self.tick)
+            # 落后超过一圈时每个槽只需处理一次
+            for tick in range(max(self.cursor, last - len(self.slots) + 1), last + 1):
+                slot = self.slots[tick % len(self.slots)]
+                for item in [item for item in slot if self.deadlines[item] <= now]:
+                    self._remove(item)
+                    due.append(item)
+            self.cursor = last  # 当前刻度的槽里可能还有稍后到期的，下次再检查一遍
+        return due